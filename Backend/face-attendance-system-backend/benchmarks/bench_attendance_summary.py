@@ -0,0 +1,94 @@
+"""
+Cost of a student's attendance summary against a stand-in database of a
+campus: the old loop that queried the subject's sessions and re-read the
+student's whole attendance history once per enrolled subject, against the
+current get_attendance_summary (history read once, subject sessions read
+concurrently and cached), cold and with warm caches.
+
+Run from the backend directory (needs firebase_admin installed, nothing is sent to Firebase):
+    python -m benchmarks.bench_attendance_summary --subjects 300 --sessions-per-subject 60 --enrolled 8
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.fake_firebase import FakeDatabase, fake_firebase_database
+
+
+def summary_before(fake, student_id, student_email):
+    """ get_attendance_summary before it was restructured """
+    student_ref = fake.reference("users").order_by_child("email").equal_to(student_email).get()
+    subjects_enrolled = []
+    for _, student_data in student_ref.items():
+        subjects_enrolled = student_data.get('subjects', [])
+    attendance_summary = {}
+    for subject in subjects_enrolled:
+        sessions_ref = fake.reference("attendance_sessions").order_by_child('subjectId').equal_to(subject).get()
+        session_ids = [session_key for session_key in sessions_ref.keys()]
+        total_classes = len(session_ids)
+        attended_sessions = fake.reference(f"student_attendance/{student_id}").get() or {}
+        attended_classes = sum(1 for session_id in attended_sessions if session_id in session_ids)
+        attendance_percentage = (attended_classes / total_classes) * 100 if total_classes > 0 else 0
+        attendance_summary[subject] = {
+            'attendancePercentage': attendance_percentage,
+            'totalClasses': total_classes,
+            'attendedClasses': attended_classes,
+        }
+    return attendance_summary, subjects_enrolled
+
+
+def populate(fake, args):
+    rng = np.random.default_rng(0)
+    subjects = [f"Subject {i:04d}" for i in range(args.subjects)]
+    enrolled = [subjects[i] for i in rng.choice(args.subjects, args.enrolled, replace=False)]
+    fake.root["users"] = {"student": {"name": "Student", "email": "student@example.com", "role": "student",
+                                      "subjects": enrolled}}
+    sessions, attended = {}, {}
+    for subject in subjects:
+        for i in range(args.sessions_per_subject):
+            key = f"-{subject.replace(' ', '')}-{i:04d}"
+            sessions[key] = {"subjectId": subject, "teacherId": "teacher", "teacherMail": "teacher@example.com",
+                             "date": "2024-01-01", "active": False, "createdAt": "2024-01-01T09:00:00"}
+            if subject in enrolled and rng.random() < args.attendance:
+                attended[key] = True
+    fake.root["attendance_sessions"] = sessions
+    fake.root["student_attendance"] = {"student": attended}
+
+
+def measure(fake, summary):
+    fake.calls.clear()
+    fake.bytes_read = 0
+    start = time.perf_counter()
+    result = summary()
+    return result, 1000 * (time.perf_counter() - start), fake.reads(), fake.bytes_read
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=300, help="subjects on campus")
+    parser.add_argument("--sessions-per-subject", type=int, default=60)
+    parser.add_argument("--enrolled", type=int, default=8, help="subjects the student is enrolled in")
+    parser.add_argument("--attendance", type=float, default=0.8)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated round trip to Firebase")
+    args = parser.parse_args()
+
+    fake = FakeDatabase()
+    firebase_db = fake_firebase_database(fake)
+    populate(fake, args)
+    fake.latency = args.latency_ms / 1000
+
+    print(f"{args.subjects} subjects x {args.sessions_per_subject} sessions, student enrolled in {args.enrolled}, "
+          f"{args.latency_ms:.0f} ms per round trip")
+    expected, *before = measure(fake, lambda: summary_before(fake, "student", "student@example.com"))
+    runs = [("before", before)]
+    for name in ("after, cold", "after, warm"):
+        result, *after = measure(fake, lambda: firebase_db.get_attendance_summary("student", "student@example.com"))
+        assert result == expected
+        runs.append((name, after))
+    for name, (ms, reads, bytes_read) in runs:
+        print(f"{name:12s} {ms:7.1f} ms  reads {reads:3d}  downloaded {bytes_read / 1024:7.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
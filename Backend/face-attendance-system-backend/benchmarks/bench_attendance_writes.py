@@ -0,0 +1,70 @@
+"""
+A class walking in: students are recognized over a few seconds and marked
+from the frame handler. Compares the old synchronous push() + set() per record
+with the write-behind buffer of FirebaseDatabase, reporting the time the
+handler is blocked per mark, the round trips, flush latency and queue depth,
+and checks every record is in the database once the session ends.
+
+Run from the backend directory (needs firebase_admin installed, nothing is sent to Firebase):
+    python -m benchmarks.bench_attendance_writes --students 40 --seconds 3 --latency-ms 20
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.fake_firebase import FakeDatabase, fake_firebase_database
+from modules.collections_format import AttendanceRecord
+from modules.migrate_attendance_records import is_push_key_record
+
+
+def record_synchronously(fake, session_id, student_id):
+    """ What record_attendance did before the buffer """
+    record = AttendanceRecord(sessionId=session_id, studentId=student_id)
+    fake.reference("attendance_records").push().set(record.to_dict())
+
+
+def run(args, buffered):
+    fake = FakeDatabase(args.latency_ms / 1000)
+    firebase_db = fake_firebase_database(fake, flush_records=args.flush_records, flush_ms=args.flush_ms)
+    rng = np.random.default_rng(0)
+    arrivals = np.sort(rng.uniform(0, args.seconds, args.students))
+    blocked, depths = [], []
+    start = time.perf_counter()
+    for student, arrival in enumerate(arrivals):
+        time.sleep(max(0.0, arrival - (time.perf_counter() - start)))
+        mark_start = time.perf_counter()
+        if buffered:
+            firebase_db.record_attendance("session", f"student{student}")
+        else:
+            record_synchronously(fake, "session", f"student{student}")
+        blocked.append(1000 * (time.perf_counter() - mark_start))
+        depths.append(firebase_db.attendance_writes.stats()["queue_depth"])
+    firebase_db.end_attendance_session("session")
+    firebase_db.attendance_writes.stop()
+    records = fake.root.get("attendance_records", {})
+    # Push keys hold one record each, session nodes one record per student
+    written = sum(1 if is_push_key_record(record) else len(record) for record in records.values())
+    return np.array(blocked), fake, firebase_db.attendance_writes.stats(), max(depths), written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=40)
+    parser.add_argument("--seconds", type=float, default=3.0, help="time over which the class walks in")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated round trip to Firebase")
+    parser.add_argument("--flush-records", type=int, default=50)
+    parser.add_argument("--flush-ms", type=float, default=500.0)
+    args = parser.parse_args()
+
+    print(f"{args.students} students over {args.seconds:.0f}s, {args.latency_ms:.0f} ms per round trip, "
+          f"flush every {args.flush_records} records or {args.flush_ms:.0f} ms")
+    for name, buffered in (("synchronous", False), ("write-behind", True)):
+        blocked, fake, stats, depth, written = run(args, buffered)
+        print(f"{name:12s} blocked per mark p50 {np.median(blocked):6.2f} ms  max {blocked.max():6.2f} ms  "
+              f"round trips {fake.writes() - 1:3d}  flushes {stats['flushes']:2d}  "
+              f"avg flush {stats['avg_flush_ms']:5.1f} ms  max queue {depth:2d}  records written {written}")
+
+
+if __name__ == "__main__":
+    main()
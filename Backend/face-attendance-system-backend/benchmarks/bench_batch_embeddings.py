@@ -0,0 +1,69 @@
+"""
+Compares the per-face FaceNet loop (FaceRecognition.get_embeddings) with the
+batched path (FaceRecognition.get_embeddings_batch) on the CPU, or on --device.
+
+Run from the backend directory:
+    python -m benchmarks.bench_batch_embeddings --faces 10 20 40 --batch-sizes 8 16 32
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from modules.ml_utils import FaceRecognition
+
+
+def synthetic_frame(number_of_faces, height=720, width=1280, seed=0):
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    sizes = rng.integers(60, 140, size=number_of_faces)
+    x1 = rng.integers(0, width - 140, size=number_of_faces)
+    y1 = rng.integers(0, height - 140, size=number_of_faces)
+    boxes = np.stack([x1, y1, x1 + sizes, y1 + sizes], axis=1).astype(np.float32)
+    return img, boxes
+
+
+def time_call(fn, repeats):
+    fn()  # warm up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--faces", type=int, nargs="+", default=[1, 10, 20, 40])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--device", default="cpu", help="torch device the models and engine are built on")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    recognizer = FaceRecognition(device=torch.device(args.device))
+    recognizer.load_embedding_model()
+
+    print(f"{'faces':>6} {'mode':>12} {'ms/frame':>10} {'ms/face':>9} {'speedup':>8}")
+    for number_of_faces in args.faces:
+        img, boxes = synthetic_frame(number_of_faces)
+        loop = time_call(lambda: recognizer.get_embeddings(img, boxes), args.repeats)
+        print(f"{number_of_faces:>6} {'loop':>12} {loop * 1e3:>10.1f} {loop * 1e3 / number_of_faces:>9.2f} {1.0:>8.2f}")
+
+        for batch_size in args.batch_sizes:
+            batched = time_call(lambda: recognizer.get_embeddings_batch(img, boxes, batch_size), args.repeats)
+            print(f"{number_of_faces:>6} {f'batch={batch_size}':>12} {batched * 1e3:>10.1f} "
+                  f"{batched * 1e3 / number_of_faces:>9.2f} {loop / batched:>8.2f}")
+
+        # Both paths must produce the same embeddings
+        reference = np.concatenate(recognizer.get_embeddings(img, boxes), axis=0)
+        batched = recognizer.get_embeddings_batch(img, boxes)
+        print(f"       max abs difference loop vs batch: {np.abs(reference - batched).max():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Sweeps the MTCNN detection scale and minimum face size on sample classroom
+frames and reports detection latency against recall. Recall is measured
+against the boxes found at full resolution with MTCNN's default settings
+(IoU >= 0.5), unless a label file with ground-truth boxes is given.
+
+Run from the backend directory:
+    python -m benchmarks.bench_detection_scale data/classroom_frames --scales 1 0.75 0.5 0.35 0.25 --min-face-sizes 20 40 80
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from modules.face_tracker import box_iou
+from modules.ml_utils import FaceRecognition
+
+
+def load_frames(directory: Path):
+    paths = sorted(p for p in directory.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+    return [(p.name, cv2.cvtColor(cv2.imread(str(p)), cv2.COLOR_BGR2RGB)) for p in paths]
+
+
+def recall(reference, boxes, iou_threshold=0.5):
+    if len(reference) == 0:
+        return 1.0
+    if boxes is None or len(boxes) == 0:
+        return 0.0
+    return float(np.mean(box_iou(reference, boxes).max(axis=1) >= iou_threshold))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames", type=Path, help="directory of classroom frames")
+    parser.add_argument("--labels", type=Path, default=None, help='JSON {"frame.jpg": [[x1, y1, x2, y2], ...]}')
+    parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.35, 0.25])
+    parser.add_argument("--min-face-sizes", type=int, nargs="+", default=[20, 40, 80])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    recognizer = FaceRecognition()
+    if args.labels:
+        labels = json.loads(args.labels.read_text())
+        reference = {name: np.array(labels.get(name, []), dtype=np.float32).reshape(-1, 4) for name, _ in frames}
+    else:
+        recognizer.configure_detection(1.0, 20)
+        reference = {}
+        for name, img in frames:
+            boxes = recognizer.detect_face_locations_mtcnn(img)
+            reference[name] = np.empty((0, 4)) if boxes is None else boxes
+
+    print(f"frames: {len(frames)}  reference faces: {sum(len(b) for b in reference.values())}")
+    print(f"{'scale':>6} {'min face':>9} {'ms/frame':>9} {'recall':>7}")
+    for min_face_size in args.min_face_sizes:
+        for scale in args.scales:
+            recognizer.configure_detection(scale, min_face_size)
+            timings, recalls = [], []
+            for name, img in frames:
+                recognizer.detect_face_locations_mtcnn(img)  # warm up
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    boxes = recognizer.detect_face_locations_mtcnn(img)
+                    timings.append(time.perf_counter() - start)
+                recalls.append(recall(reference[name], boxes))
+            print(f"{scale:>6.2f} {min_face_size:>9} {np.median(timings) * 1e3:>9.1f} {np.mean(recalls):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Per-face latency and throughput of the embedding model under each engine
+(eager PyTorch, frozen TorchScript, ONNX Runtime) on CPU.
+
+Run from the backend directory:
+    python -m benchmarks.bench_embedding_engines --batch-sizes 1 8 32 --threads 4
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from facenet_pytorch import InceptionResnetV1
+
+from modules.embedding_engines import engines, load_embedding_engine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", nargs="+", default=list(engines), choices=engines)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    model = InceptionResnetV1(pretrained="vggface2").eval().to(device)
+
+    print(f"{'engine':>12} {'batch':>6} {'p50 ms/face':>12} {'p95 ms/face':>12} {'faces/s':>9}")
+    for name in args.engines:
+        engine = load_embedding_engine(model, device, name)
+        for batch_size in args.batch_sizes:
+            faces = torch.rand(batch_size, 3, 160, 160)
+            engine(faces)  # warm up
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                engine(faces)
+                timings.append((time.perf_counter() - start) / batch_size)
+            p50, p95 = np.percentile(timings, [50, 95]) * 1e3
+            print(f"{name:>12} {batch_size:>6} {p50:>12.2f} {p95:>12.2f} {1e3 / p50:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
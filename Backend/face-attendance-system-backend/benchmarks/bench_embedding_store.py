@@ -0,0 +1,66 @@
+"""
+Rebuilds a gallery of 100k embeddings into every FAISS index type from the
+embedding store and compares it with the old route of reading the vectors back
+out of the previous index: time to get the vectors, how far they are from the
+registered embeddings, and the bulk build itself.
+
+Run from the backend directory:
+    python -m benchmarks.bench_embedding_store --gallery 100000 --directory /var/tmp/gallery
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from modules.embedding_store import EmbeddingStore
+from modules.faiss_utils import FAISS, dimension, index_types, index_vectors
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=100000)
+    parser.add_argument("--dtype", default="float32", choices=("float32", "float16"))
+    parser.add_argument("--types", nargs="+", default=list(index_types), choices=index_types)
+    parser.add_argument("--directory", type=Path, help="where to write the gallery, defaults to a temporary directory")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = normalized(rng.standard_normal((args.gallery, dimension)))
+    ids = [f"student{i}@example.com" for i in range(args.gallery)]
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        gallery = FAISS(Path(directory), fsync=False, embedding_dtype=args.dtype)
+        gallery.update_index(vectors, ids)
+        gallery.checkpoint()
+        checkpoint = gallery.current_checkpoint()
+        size_mb = sum(path.stat().st_size for path in checkpoint.glob("embed*")) / 2 ** 20
+
+        start = time.perf_counter()
+        store = EmbeddingStore.load(checkpoint)
+        stored, labels = store.all()
+        store_s = time.perf_counter() - start
+        store_error = np.abs(stored[np.argsort(labels)] - vectors).max()
+
+        print(f"gallery {args.gallery}  store {args.dtype} {size_mb:.0f} MB  load {store_s:.2f}s  max error {store_error:.1e}")
+        print(f"{'type':>9} {'rebuild s':>10} {'checkpoint s':>13} {'read back s':>12} {'read back error':>16}")
+        for index_type in args.types:
+            start = time.perf_counter()
+            build_s = gallery.rebuild(index_type)
+            checkpoint_s = time.perf_counter() - start - build_s
+
+            # What rebuilding the next index cost before the store: reconstructing every vector from this one
+            start = time.perf_counter()
+            read_back, read_labels = index_vectors(gallery.snapshot.index)
+            read_s = time.perf_counter() - start
+            read_error = np.abs(read_back[np.argsort(read_labels)] - vectors).max()
+            print(f"{index_type:>9} {build_s:10.2f} {checkpoint_s:13.2f} {read_s:12.2f} {read_error:16.1e}")
+
+
+if __name__ == "__main__":
+    main()
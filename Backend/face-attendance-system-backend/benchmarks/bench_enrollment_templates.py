@@ -0,0 +1,80 @@
+"""
+Compares the ways of storing a registration's capture steps on a synthetic
+gallery where every student has one embedding per pose (straight, left, right,
+up, down) and is later seen at a random pose:
+  single     only step0, what registration used to store
+  prototype  normalized mean of the steps (ENROLLMENT_TEMPLATES=prototype)
+  medoid     the step closest to the others (ENROLLMENT_TEMPLATES=medoid)
+  all        every step, top-k voting at search time (ENROLLMENT_TEMPLATES=all)
+Reports gallery size, search time per frame, match rate and false matches of
+faces that were never registered.
+
+Run from the backend directory:
+    python -m benchmarks.bench_enrollment_templates --students 20000 --steps 5
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from modules.faiss_utils import FAISS, aggregate_templates, dimension, vote
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=20000)
+    parser.add_argument("--steps", type=int, default=5, help="capture steps per registration")
+    parser.add_argument("--queries", type=int, default=3000)
+    parser.add_argument("--faces", type=int, default=30, help="faces per frame for the latency numbers")
+    parser.add_argument("--pose", type=float, default=0.03, help="per-dimension spread caused by head pose")
+    parser.add_argument("--noise", type=float, default=0.02, help="per-dimension capture noise")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--votes", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    identities = normalized(rng.standard_normal((args.students, dimension)))
+    poses = args.pose * rng.standard_normal((args.students, args.steps, dimension))
+    captures = normalized(identities[:, None] + poses + args.noise * rng.standard_normal(poses.shape))
+    emails = [f"student{i}@example.com" for i in range(args.students)]
+
+    # Known faces at an unseen pose, plus strangers
+    truth = rng.integers(0, args.students, args.queries)
+    unseen_pose = args.pose * rng.standard_normal((args.queries, dimension))
+    known = normalized(identities[truth] + unseen_pose + args.noise * rng.standard_normal((args.queries, dimension)))
+    strangers = normalized(rng.standard_normal((args.queries, dimension)))
+
+    print(f"students {args.students}  steps {args.steps}  queries {args.queries}")
+    print(f"{'mode':>10} {'vectors':>8} {'frame ms':>9} {'match rate':>11} {'false match':>12}")
+    for mode in ("single", "prototype", "medoid", "all"):
+        with tempfile.TemporaryDirectory() as directory:
+            gallery = FAISS(directory, fsync=False)
+            if mode == "single":
+                gallery.update_index(captures[:, 0], emails)
+            else:
+                gallery.update_index([aggregate_templates(steps, mode) for steps in captures], emails)
+
+            def identify(embeddings):
+                if mode == "all":
+                    return vote(*gallery.search(embeddings, args.votes, args.threshold))
+                return gallery.search(embeddings, 1, args.threshold)
+
+            start = time.perf_counter()
+            for first in range(0, args.queries, args.faces):
+                identify(known[first:first + args.faces])
+            frame_ms = 1000 * (time.perf_counter() - start) / -(-args.queries // args.faces)
+
+            labels, _, accepted = identify(known)
+            match_rate = float(np.mean(accepted[:, 0] & (labels[:, 0] == truth)))
+            _, _, stranger_accepted = identify(strangers)
+            print(f"{mode:>10} {gallery.stats()['vectors']:>8} {frame_ms:>9.2f} {match_rate:>11.3f} "
+                  f"{float(np.mean(stranger_accepted[:, 0])):>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
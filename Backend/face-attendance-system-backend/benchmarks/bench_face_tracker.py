@@ -0,0 +1,46 @@
+"""
+Simulates a steady classroom stream (faces jittering by a few pixels, the odd
+student moving or walking in) and reports how many faces the FaceTracker sends
+to FaceNet and FAISS compared with embedding every face on every frame.
+
+Run from the backend directory:
+    python -m benchmarks.bench_face_tracker --faces 30 --frames 600
+"""
+import argparse
+
+import numpy as np
+
+from modules.face_tracker import FaceTracker
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--faces", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--jitter", type=float, default=2.0, help="pixel noise on every box per frame")
+    parser.add_argument("--move-probability", type=float, default=0.002, help="chance a face moves per frame")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    size = rng.uniform(50, 110, size=args.faces)
+    origin = np.stack([rng.uniform(0, 1800, args.faces), rng.uniform(0, 950, args.faces)], axis=1)
+    tracker = FaceTracker()
+
+    embedded = 0
+    for _ in range(args.frames):
+        moved = rng.random(args.faces) < args.move_probability
+        origin[moved] += rng.uniform(-80, 80, size=(moved.sum(), 2))
+        jittered = origin + rng.normal(0, args.jitter, size=origin.shape)
+        boxes = np.concatenate([jittered, jittered + size[:, None]], axis=1)
+
+        indices = tracker.assign(boxes)
+        embedded += len(indices)
+        tracker.update_identities(np.zeros((len(indices), 512)), [f"student{i}" for i in indices], [0.1] * len(indices))
+
+    total = args.faces * args.frames
+    print(f"faces seen: {total}  embedded: {embedded}  reduction: {total / max(embedded, 1):.1f}x")
+    print(tracker.stats())
+
+
+if __name__ == "__main__":
+    main()
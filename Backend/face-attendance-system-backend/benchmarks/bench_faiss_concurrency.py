@@ -0,0 +1,103 @@
+"""
+Stress test of the gallery under mixed load: search threads query continuously
+while registration threads arrive in bursts. Reports search tail latency with
+no registrations, with registrations against the lock-free snapshots, and with
+searches taking the writer lock (what a plain reader/writer lock would cost),
+plus how many registrations each snapshot swap absorbed. Every search result is
+checked against the IDs of the snapshot it ran on.
+
+Run from the backend directory:
+    python -m benchmarks.bench_faiss_concurrency --gallery 20000 --seconds 5
+"""
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from modules.faiss_utils import FAISS, dimension, search_index
+
+
+def run(gallery, queries, faces, args, register, locked):
+    """ Returns the search latencies in ms and the number of inconsistent results """
+    stop = threading.Event()
+    latencies, errors = [], [0]
+    registered = iter(range(1 << 62))
+
+    def searcher(seed):
+        rng = np.random.default_rng(seed)
+        own = []
+        while not stop.is_set():
+            batch = queries[rng.integers(0, len(queries), args.batch)]
+            start = time.perf_counter()
+            if locked:
+                with gallery._lock:
+                    snapshot = gallery.snapshot
+                    labels, _, accepted = search_index(snapshot, batch, 1, 0.6)
+            else:
+                snapshot = gallery.snapshot
+                labels, _, accepted = search_index(snapshot, batch, 1, 0.6)
+            own.append(1000 * (time.perf_counter() - start))
+            errors[0] += int(np.sum(labels[:, 0] >= len(snapshot.ids)))
+        latencies.extend(own)
+
+    def registrar(seed):
+        rng = np.random.default_rng(seed)
+        while not stop.is_set():
+            for _ in range(args.burst):
+                i = next(registered)
+                gallery.replace(f"new{i}@example.com", faces[i % len(faces)])
+            stop.wait(rng.exponential(args.burst_interval))
+
+    threads = [threading.Thread(target=searcher, args=(i,)) for i in range(args.searchers)]
+    if register:
+        threads += [threading.Thread(target=registrar, args=(100 + i,)) for i in range(args.registrars)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies), errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=20000)
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--searchers", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=4, help="faces per search, like one frame")
+    parser.add_argument("--registrars", type=int, default=4)
+    parser.add_argument("--burst", type=int, default=5, help="registrations per burst and registrar")
+    parser.add_argument("--burst-interval", type=float, default=0.2, help="mean seconds between bursts")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.gallery, dimension)).astype(np.float32)
+    ids = [f"student{i}@example.com" for i in range(args.gallery)]
+    queries = vectors[rng.integers(0, args.gallery, 1000)] + 0.01
+    faces = rng.standard_normal((1000, dimension)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as directory:
+        gallery = FAISS(Path(directory), fsync=True, index_type=args.index_type)
+        gallery.update_index(vectors, ids)
+        gallery.checkpoint()
+
+        print(f"gallery {args.gallery} ({args.index_type})  {args.searchers} searchers x {args.batch} faces  "
+              f"{args.registrars} registrars x {args.burst} every ~{args.burst_interval}s")
+        for name, register, locked in (("idle", False, False), ("snapshots", True, False), ("writer lock", True, True)):
+            before = gallery.stats()
+            latencies, errors = run(gallery, queries, faces, args, register, locked)
+            after = gallery.stats()
+            batches = after["batches"] - before["batches"]
+            changes = after["seq"] - before["seq"]
+            print(f"{name:12s} searches {len(latencies):7d}  p50 {np.median(latencies):7.2f} ms  "
+                  f"p99 {np.percentile(latencies, 99):7.2f} ms  max {latencies.max():8.2f} ms  "
+                  f"registrations {changes:5d} in {batches:4d} swaps  bad results {errors}")
+
+
+if __name__ == "__main__":
+    main()
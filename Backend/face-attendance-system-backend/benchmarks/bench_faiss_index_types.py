@@ -0,0 +1,67 @@
+"""
+Builds every FAISS index type over the same synthetic gallery and reports build
+time, serialized size, recall@1 against the exact flat index and query latency
+for a frame of faces, so FAISS_INDEX_TYPE / FAISS_NPROBE / FAISS_EF_SEARCH can
+be picked for a given gallery size.
+
+Run from the backend directory:
+    python -m benchmarks.bench_faiss_index_types --gallery 100000 --queries 1000
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from modules.faiss_utils import configure_search, create_index, dimension, index_types, index_type_of
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--faces", type=int, default=30, help="faces per frame for the latency numbers")
+    parser.add_argument("--noise", type=float, default=0.03, help="per-dimension noise between a query and its identity")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--types", nargs="+", default=list(index_types), choices=index_types)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    gallery = normalized(rng.standard_normal((args.gallery, dimension)))
+    labels = np.arange(args.gallery, dtype=np.int64)
+    truth = rng.integers(0, args.gallery, args.queries)
+    queries = normalized(gallery[truth] + args.noise * rng.standard_normal((args.queries, dimension)))
+
+    exact = create_index("flat", gallery, labels)
+    _, expected = exact.search(queries, 1)
+
+    print(f"gallery {args.gallery}  queries {args.queries}  nprobe {args.nprobe}  efSearch {args.ef_search}")
+    print(f"{'type':>9} {'build s':>8} {'size MB':>8} {'recall@1':>9} {'frame ms':>9} {'face ms':>8}")
+    for index_type in args.types:
+        start = time.perf_counter()
+        index = create_index(index_type, gallery, labels)
+        build_s = time.perf_counter() - start
+        configure_search(index, args.nprobe, args.ef_search)
+        if index_type_of(index) != index_type:
+            print(f"{index_type:>9} needs at least the IVF training size, built {index_type_of(index)} instead")
+
+        _, found = index.search(queries, 1)
+        recall = float(np.mean(found[:, 0] == expected[:, 0]))
+
+        frames = [queries[i:i + args.faces] for i in range(0, len(queries), args.faces)]
+        start = time.perf_counter()
+        for frame in frames:
+            index.search(frame, 1)
+        frame_ms = 1000 * (time.perf_counter() - start) / len(frames)
+
+        size_mb = faiss.serialize_index(index).nbytes / 2 ** 20
+        print(f"{index_type:>9} {build_s:>8.1f} {size_mb:>8.1f} {recall:>9.3f} {frame_ms:>9.2f} {frame_ms / args.faces:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Loads one checkpointed gallery in several worker processes, once read into
+private memory and once memory-mapped (FAISS_MMAP=1), and reports per-worker
+startup time and memory. Pss splits shared pages between the processes that
+map them, so it shows what each worker really costs. Cold runs evict the
+checkpoint files from the page cache first.
+
+Run from the backend directory (keep --directory on a real disk, not tmpfs):
+    python -m benchmarks.bench_faiss_mmap --gallery 200000 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from modules.faiss_utils import FAISS, dimension
+
+
+def memory_mb() -> dict:
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss", "Anonymous"):
+                fields[name] = int(value.split()[0]) / 1024
+    return fields
+
+
+def evict(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+
+def worker(directory, mmap, query, ready, results):
+    start = time.perf_counter()
+    gallery = FAISS(directory, mmap=mmap)
+    gallery.search(query, 1)
+    load_s = time.perf_counter() - start
+    ready.wait()  # Measure once every worker has loaded, so the shared pages are counted for all of them
+    results.put((load_s, memory_mb()))
+
+
+def run(directory, mmap, workers, cold, query):
+    if cold:
+        evict(directory)
+    context = multiprocessing.get_context("fork")
+    ready, results = context.Barrier(workers), context.Queue()
+    processes = [context.Process(target=worker, args=(directory, mmap, query, ready, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    load_s = np.mean([load for load, _ in measured])
+    mean = {name: np.mean([memory[name] for _, memory in measured]) for name in ("Rss", "Pss", "Anonymous")}
+    print(f"{'mmap' if mmap else 'read':>5} {'cold' if cold else 'warm':>5} {load_s:>8.2f} "
+          f"{mean['Rss']:>8.0f} {mean['Pss']:>8.0f} {mean['Anonymous']:>8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=200000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--directory", default=".", help="where the temporary gallery is written")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_faiss_mmap_", dir=args.directory)
+    try:
+        rng = np.random.default_rng(0)
+        gallery = FAISS(directory, fsync=False)
+        gallery.update_index(rng.standard_normal((args.gallery, dimension)).astype(np.float32),
+                             [f"student{i}@example.com" for i in range(args.gallery)])
+        gallery.checkpoint()
+        del gallery
+        query = rng.standard_normal((1, dimension)).astype(np.float32)
+
+        print(f"gallery {args.gallery}  workers {args.workers}  (per worker, MB)")
+        print(f"{'load':>5} {'cache':>5} {'start s':>8} {'Rss':>8} {'Pss':>8} {'private':>8}")
+        for mmap in (False, True):
+            for cold in (True, False):
+                run(directory, mmap, args.workers, cold, query)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares identifying the faces of a frame one get_person_id call at a time with
+a single FAISS.search call over the whole (N, 512) matrix, for galleries of
+1k, 10k and 100k identities.
+
+Run from the backend directory:
+    python -m benchmarks.bench_faiss_search --faces 30 --galleries 1000 10000 100000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from modules.faiss_utils import FAISS, dimension
+
+
+def random_embeddings(rng, count) -> np.ndarray:
+    embeddings = rng.standard_normal((count, dimension)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def build_gallery(rng, size, directory) -> Tuple[FAISS, np.ndarray]:
+    """ A flat gallery of size random students in directory instead of data/faiss, and their embeddings """
+    gallery = FAISS(Path(directory), fsync=False)
+    embeddings = random_embeddings(rng, size)
+    gallery.update_index(embeddings, [f"student{i}@example.com" for i in range(size)])
+    return gallery, embeddings
+
+
+def time_per_frame(fn, repeats) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return 1000.0 * (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--faces", type=int, default=30, help="faces per frame")
+    parser.add_argument("--galleries", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in args.galleries:
+        with tempfile.TemporaryDirectory() as directory:
+            gallery, embeddings = build_gallery(rng, size, directory)
+            # Half of the faces are noisy copies of enrolled students, the rest are strangers
+            known = embeddings[:args.faces // 2] + 0.01 * rng.standard_normal((args.faces // 2, dimension))
+            queries = np.concatenate([known, random_embeddings(rng, args.faces - len(known))]).astype(np.float32)
+
+            def one_by_one():
+                return [gallery.get_person_id(query, 1, args.threshold) for query in queries]
+
+            def batched():
+                labels, distances, accepted = gallery.search(queries, 1, args.threshold)
+                return gallery.ids_for(np.where(accepted[:, 0], labels[:, 0], -1))
+
+            matched_loop = sum(len(people) for people in one_by_one())
+            matched_batch = sum(1 for person_id in batched() if person_id)
+            assert matched_loop == matched_batch, (matched_loop, matched_batch)
+
+            loop_ms = time_per_frame(one_by_one, args.repeats)
+            batch_ms = time_per_frame(batched, args.repeats)
+            print(f"gallery {size:>7}  faces {args.faces}  matched {matched_batch:>3}  "
+                  f"per-face {loop_ms:7.2f} ms  batched {batch_ms:7.2f} ms  speedup {loop_ms / batch_ms:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Firebase reads of a class being marked from a frame stream, with the user and
+subject caches of FirebaseDatabase off (ttl 0) and on. Every frame marks every
+student of the class through mark_attendance_by_email, as happens whenever the
+small local_cache of modules/utils.py misses. Halfway through, a student is
+enrolled in another subject to check the write invalidates their cached user.
+
+Run from the backend directory (needs firebase_admin installed, nothing is sent to Firebase):
+    python -m benchmarks.bench_firebase_cache --students 30 --frames 20 --latency-ms 20
+"""
+import argparse
+import time
+
+from benchmarks.fake_firebase import FakeDatabase, fake_firebase_database
+
+
+def run(args, cache_ttl):
+    fake = FakeDatabase()
+    firebase_db = fake_firebase_database(fake, cache_ttl=cache_ttl)
+    firebase_db.register_user("Teacher", "teacher@example.com", "secret", "teacher")
+    teacher_id = next(iter(fake.root["users"]))
+    firebase_db.add_subject("Physics", teacher_id, "teacher@example.com")
+    firebase_db.add_subject("Chemistry", teacher_id, "teacher@example.com")
+    emails = [f"student{i}@example.com" for i in range(args.students)]
+    for email in emails:
+        firebase_db.register_user(email.split("@")[0], email, "secret", "student")
+        firebase_db.enroll_student_in_subject(email, "Physics")
+    firebase_db.start_attendance_session("Physics", teacher_id, "teacher@example.com")
+    # Measure the per-face lookup path the caches serve, not the roster preloaded for the session
+    firebase_db.session_rosters.clear()
+
+    fake.latency = args.latency_ms / 1000
+    fake.calls.clear()
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        if frame == args.frames // 2:
+            firebase_db.enroll_student_in_subject(emails[0], "Chemistry")
+        for email in emails:
+            firebase_db.mark_attendance_by_email(email, teacher_id)
+    seconds = time.perf_counter() - start
+    subjects = firebase_db.find_users_by_email(emails[0]).popitem()[1]["subjects"]
+    return fake, firebase_db, seconds, subjects == ["Physics", "Chemistry"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated round trip to Firebase")
+    parser.add_argument("--ttl", type=float, default=300.0)
+    args = parser.parse_args()
+
+    marks = args.students * args.frames
+    print(f"{args.students} students x {args.frames} frames, {args.latency_ms:.0f} ms per round trip")
+    for name, ttl in (("no cache", 0.0), ("cache", args.ttl)):
+        fake, firebase_db, seconds, fresh = run(args, ttl)
+        stats = firebase_db.cache_stats()
+        lookups = sum(stats[cache]["misses"] for cache in ("users_by_email", "users_by_id", "subjects_by_name"))
+        print(f"{name:9s} user/subject reads {lookups:5d}  all reads {fake.reads():5d}  "
+              f"reads per mark {fake.reads() / marks:5.2f}  {1000 * seconds / marks:6.1f} ms per mark  "
+              f"hit rate {stats['hit_rate']:6.1%}  reads saved {stats['firebase_reads_saved']:5d}  "
+              f"enrollment visible {fresh}")
+
+
+if __name__ == "__main__":
+    main()
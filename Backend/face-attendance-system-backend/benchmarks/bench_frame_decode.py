@@ -0,0 +1,83 @@
+"""
+Per-frame time and allocations of the frame decode paths:
+    - convert_binary_to_rgb: PIL decode, NumPy copy, cvtColor into a third buffer, plus the
+      np.array copy detection used to make
+    - decode_frame: np.frombuffer + cv2.imdecode, optionally at a reduced size, with the
+      detection downscale written into a reused buffer
+
+Allocations are counted with tracemalloc, which sees NumPy and OpenCV output arrays.
+
+Run from the backend directory:
+    python -m benchmarks.bench_frame_decode --image classroom.jpg --detection-scale 0.5
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from modules.ml_utils import FaceRecognition
+
+
+def measure(fn, repeats):
+    fn()  # warm up, also fills reused buffers
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "traceback")
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    peak_bytes = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    return elapsed, blocks, peak_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="JPEG classroom frame, random 1280x720 noise when omitted")
+    parser.add_argument("--detection-scale", type=float, default=0.5)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            data = f.read()
+    else:
+        img = np.random.default_rng(0).integers(0, 256, size=(720, 1280, 3), dtype=np.uint8)
+        data = cv2.imencode(".jpg", img)[1].tobytes()
+
+    recognizer = FaceRecognition()
+
+    def old_path():
+        img = recognizer.convert_binary_to_rgb(data)
+        img = np.array(img)
+        return cv2.resize(img, None, fx=args.detection_scale, fy=args.detection_scale, interpolation=cv2.INTER_AREA)
+
+    print(f"{'path':>24} {'ms/frame':>9} {'allocs':>7} {'MB':>7} {'frame':>12}")
+    elapsed, blocks, size = measure(old_path, args.repeats)
+    print(f"{'convert_binary_to_rgb':>24} {elapsed * 1e3:>9.2f} {blocks:>7} {size / 1e6:>7.2f} {'full':>12}")
+
+    for reduction in (1, 2, 4, 8):
+        recognizer.requested_decode_reduction = reduction
+        recognizer.configure_detection(args.detection_scale, recognizer.min_face_size)
+        if recognizer.decode_reduction != reduction:
+            continue
+
+        def new_path():
+            img = recognizer.decode_frame(data)
+            return recognizer.downscale_for_detection(img, recognizer._scratch("detection", img))
+
+        elapsed, blocks, size = measure(new_path, args.repeats)
+        shape = recognizer.decode_frame(data).shape
+        print(f"{f'decode_frame 1/{reduction}':>24} {elapsed * 1e3:>9.2f} {blocks:>7} {size / 1e6:>7.2f} "
+              f"{f'{shape[1]}x{shape[0]}':>12}")
+
+
+if __name__ == "__main__":
+    main()
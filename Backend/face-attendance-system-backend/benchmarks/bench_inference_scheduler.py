@@ -0,0 +1,86 @@
+"""
+Throughput of the cross-client InferenceScheduler against inline per-frame
+processing, with 1 to N simulated camera streams sending JPEG frames.
+Firebase marking is replaced by a no-op so only decode, MTCNN and FaceNet are timed.
+
+Run from the backend directory:
+    python -m benchmarks.bench_inference_scheduler --image classroom.jpg --streams 1 5 10
+"""
+import argparse
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from modules.inference_scheduler import InferenceScheduler
+from modules.ml_utils import FaceRecognition
+
+
+def load_frame(path):
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def finish_frame(client_id, img, boxes, embeddings, teacher_id):
+    return len(embeddings)
+
+
+def run_inline(recognizer, data, streams, duration):
+    processed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for _ in range(streams):
+            img = recognizer.decode_frame(data)
+            boxes, embeddings = recognizer.get_face_location_and_embeddings(img)
+            finish_frame(None, img, boxes, embeddings, None)
+            processed += 1
+    return processed / duration
+
+
+def run_scheduler(recognizer, data, streams, duration, max_batch_size, max_wait_ms):
+    scheduler = InferenceScheduler(recognizer, finish_frame, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms).start()
+    done = threading.Semaphore(0)
+    stop = threading.Event()
+
+    def client(client_id):
+        # Each stream waits for its previous frame, like the frontend's `processing` flag
+        while not stop.is_set():
+            scheduler.submit(client_id, data, None, lambda *_: done.release())
+            done.acquire()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    stats = scheduler.stats()
+    scheduler.stop()
+    return stats["frames_processed"] / duration, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="JPEG classroom frame, random noise when omitted")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    recognizer = FaceRecognition()
+    data = load_frame(args.image)
+
+    print(f"{'streams':>8} {'inline fps':>11} {'batched fps':>12} {'avg batch':>10} {'max depth':>10}")
+    for streams in args.streams:
+        inline = run_inline(recognizer, data, streams, args.duration)
+        batched, stats = run_scheduler(recognizer, data, streams, args.duration, args.max_batch_size, args.max_wait_ms)
+        print(f"{streams:>8} {inline:>11.1f} {batched:>12.1f} {stats['avg_batch_size']:>10.2f} {stats['max_queue_depth']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Scaling of the InferenceWorkerPool from 1 to N worker processes. Each run
+splits the machine's cores evenly between workers and drives the pool with
+one simulated camera stream per worker slot, one frame in flight per stream.
+The motion gate is disabled so every frame is fully processed.
+
+Run from the backend directory:
+    python -m benchmarks.bench_inference_workers --image classroom.jpg --max-workers 4
+"""
+import argparse
+import os
+import threading
+import time
+
+os.environ.setdefault("MOTION_GATE_THRESHOLD", "0")
+
+import cv2
+import numpy as np
+
+from modules.inference_workers import InferenceWorkerPool
+
+
+def load_frame(path):
+    if path:
+        return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+    return np.random.default_rng(0).integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+
+
+def run(img, workers, threads_per_worker, streams, duration):
+    pool = InferenceWorkerPool(workers, threads_per_worker=threads_per_worker).start()
+    stop = threading.Event()
+    processed = [0] * streams
+
+    def client(client_id):
+        done = threading.Event()
+
+        def on_result(*_):
+            processed[client_id] += 1
+            done.set()
+
+        while not stop.is_set():
+            done.clear()
+            pool.submit(client_id, img, on_result)
+            done.wait()
+
+    # Warm up every worker once before timing
+    for client_id in range(streams):
+        warm = threading.Event()
+        pool.submit(client_id, img, lambda *_: warm.set())
+        warm.wait()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    pool.stop()
+    return sum(processed) / duration, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="classroom frame, random noise when omitted")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--streams-per-worker", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=15.0)
+    args = parser.parse_args()
+
+    img = load_frame(args.image)
+    cores = os.cpu_count() or 1
+    baseline = None
+    print(f"{'workers':>8} {'threads':>8} {'fps':>8} {'speedup':>8} {'latency ms':>11}")
+    for workers in range(1, args.max_workers + 1):
+        threads_per_worker = max(1, cores // workers)
+        fps, stats = run(img, workers, threads_per_worker, workers * args.streams_per_worker, args.duration)
+        baseline = baseline or fps
+        print(f"{workers:>8} {threads_per_worker:>8} {fps:>8.1f} {fps / baseline:>8.2f} {stats['avg_latency_ms']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
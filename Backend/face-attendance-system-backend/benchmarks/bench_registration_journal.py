@@ -0,0 +1,74 @@
+"""
+Registration latency with a gallery of 50k enrolled faces: the old path that
+rewrote face_index.index and face_ids.npy on every registration against the
+journal append, plus the cost of one background checkpoint and of a restart
+that replays the journal.
+
+Run from the backend directory:
+    python -m benchmarks.bench_registration_journal --gallery 50000 --registrations 50
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from modules.faiss_utils import FAISS, dimension
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=50000)
+    parser.add_argument("--registrations", type=int, default=50)
+    parser.add_argument("--no-fsync", action="store_true", help="skip fsync on journal appends")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.gallery, dimension)).astype(np.float32)
+    ids = [f"student{i}@example.com" for i in range(args.gallery)]
+    new_faces = rng.standard_normal((args.registrations, dimension)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+
+        # Before: append to a flat index and rewrite both files
+        index = faiss.IndexFlatL2(dimension)
+        index.add(vectors)
+        rewrite_ms = []
+        for i, face in enumerate(new_faces):
+            start = time.perf_counter()
+            index.add(face[None])
+            ids.append(f"new{i}@example.com")
+            faiss.write_index(index, str(directory / "face_index.index"))
+            np.save(str(directory / "face_ids.npy"), np.array(ids))
+            rewrite_ms.append(1000 * (time.perf_counter() - start))
+        ids = ids[:args.gallery]
+
+        # After: journal append, the gallery is checkpointed once up front
+        gallery_dir = directory / "journaled"
+        gallery = FAISS(gallery_dir, fsync=not args.no_fsync)
+        gallery.update_index(vectors, ids)
+        gallery.checkpoint()
+        journal_ms = []
+        for i, face in enumerate(new_faces):
+            start = time.perf_counter()
+            gallery.replace(f"new{i}@example.com", face)
+            journal_ms.append(1000 * (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        FAISS(gallery_dir)
+        replay_s = time.perf_counter() - start
+        start = time.perf_counter()
+        gallery.checkpoint()
+        checkpoint_s = time.perf_counter() - start
+
+    print(f"gallery {args.gallery}  registrations {args.registrations}")
+    print(f"full rewrite   p50 {np.median(rewrite_ms):8.2f} ms  p99 {np.percentile(rewrite_ms, 99):8.2f} ms")
+    print(f"journal append p50 {np.median(journal_ms):8.2f} ms  p99 {np.percentile(journal_ms, 99):8.2f} ms")
+    print(f"startup with {args.registrations} journaled registrations: {replay_s:.2f}s  background checkpoint: {checkpoint_s:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Searches a frame of faces against the whole campus gallery and against the
+roster of one subject. Reports the per-frame search time, the one-off cost of
+building the roster at session start and how many faces of students from other
+courses the full gallery would still match.
+
+Run from the backend directory:
+    python -m benchmarks.bench_roster_search --gallery 100000 --roster 60
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from modules.faiss_utils import FAISS, dimension
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery", type=int, default=100000)
+    parser.add_argument("--roster", type=int, default=60, help="students enrolled in the subject")
+    parser.add_argument("--faces", type=int, default=30, help="faces per frame")
+    parser.add_argument("--outsiders", type=int, default=5, help="faces per frame from students of other courses")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--index-type", default="flat")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = normalized(rng.standard_normal((args.gallery, dimension)))
+    emails = [f"student{i}@example.com" for i in range(args.gallery)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        gallery = FAISS(directory, fsync=False, index_type=args.index_type)
+        gallery.update_index(vectors, emails)
+
+        enrolled = rng.choice(args.gallery, args.roster, replace=False)
+        start = time.perf_counter()
+        roster = gallery.restrict([emails[i] for i in enrolled])
+        build_ms = 1000 * (time.perf_counter() - start)
+
+        others = np.setdiff1d(np.arange(args.gallery), enrolled)
+        frames = []
+        for _ in range(args.frames):
+            faces = np.concatenate([rng.choice(enrolled, args.faces - args.outsiders), rng.choice(others, args.outsiders)])
+            frames.append(normalized(vectors[faces] + 0.02 * rng.standard_normal((len(faces), dimension))))
+
+        for name, searched, vectors in (("full gallery", gallery, gallery.stats()["vectors"]),
+                                        ("roster", roster, roster.index.ntotal)):
+            matched_outsiders = 0
+            start = time.perf_counter()
+            for frame in frames:
+                labels, _, accepted = searched.search(frame, 1, 0.8)
+                matched_outsiders += int(accepted[args.faces - args.outsiders:, 0].sum())
+            frame_ms = 1000 * (time.perf_counter() - start) / len(frames)
+            print(f"{name:>12}: {vectors:>7} vectors  {frame_ms:8.3f} ms/frame  "
+                  f"faces of other courses matched: {matched_outsiders}/{args.outsiders * args.frames}")
+        print(f"roster build at session start: {build_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
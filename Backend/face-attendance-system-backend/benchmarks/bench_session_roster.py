@@ -0,0 +1,64 @@
+"""
+Firebase round trips of marking a class from a frame stream, through the old
+per-face lookups (user, the teacher's sessions, the session node) and through
+the roster preloaded when the session starts.
+
+Run from the backend directory (needs firebase_admin installed, nothing is sent to Firebase):
+    python -m benchmarks.bench_session_roster --students 30 --frames 20 --campus 2000 --latency-ms 20
+"""
+import argparse
+import time
+
+from benchmarks.fake_firebase import FakeDatabase, fake_firebase_database
+
+
+def run(args, preload):
+    fake = FakeDatabase()
+    firebase_db = fake_firebase_database(fake)
+    firebase_db.register_user("Teacher", "teacher@example.com", "secret", "teacher")
+    teacher_id = next(iter(fake.root["users"]))
+    firebase_db.add_subject("Physics", teacher_id, "teacher@example.com")
+    for i in range(args.campus):
+        fake.reference("users").push({"name": f"student{i}", "email": f"student{i}@example.com", "role": "student",
+                                      "subjects": ["Physics"] if i < args.students else []})
+    fake.reference(f"subjects/{next(iter(fake.root['subjects']))}").update(
+        {"students": [f"student{i}@example.com" for i in range(args.students)]})
+    for _ in range(args.past_sessions):
+        fake.reference("attendance_sessions").push({"subjectId": "Physics", "teacherId": teacher_id, "active": False})
+
+    fake.latency = args.latency_ms / 1000
+    fake.calls.clear()
+    firebase_db.start_attendance_session("Physics", teacher_id, "teacher@example.com")
+    start_reads = fake.reads()
+    if not preload:
+        firebase_db.session_rosters.clear()
+
+    fake.calls.clear()
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        for i in range(args.students):
+            firebase_db.mark_attendance_by_email(f"student{i}@example.com", teacher_id)
+    # Marks are buffered, count the multi-location updates they go out in
+    firebase_db.attendance_writes.flush()
+    return fake, start_reads, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--campus", type=int, default=2000, help="students in the users node")
+    parser.add_argument("--past-sessions", type=int, default=100, help="earlier sessions of the teacher")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated round trip to Firebase")
+    args = parser.parse_args()
+
+    marks = args.students * args.frames
+    print(f"{args.students} students x {args.frames} frames, {args.latency_ms:.0f} ms per round trip")
+    for name, preload in (("per face", False), ("preloaded", True)):
+        fake, start_reads, seconds = run(args, preload)
+        print(f"{name:9s} reads at start {start_reads:3d}  reads per mark {fake.reads() / marks:5.2f}  "
+              f"writes per mark {fake.writes() / marks:5.2f}  {1000 * seconds / marks:6.1f} ms per mark")
+
+
+if __name__ == "__main__":
+    main()
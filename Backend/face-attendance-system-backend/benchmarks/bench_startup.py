@@ -0,0 +1,66 @@
+"""
+Start-up cost of server.py in the full and the API-only mode. Starts the server
+under `python -X importtime`, polls GET / until it answers and reports the
+time to first request, the total import time and the heaviest top-level
+imports. Needs the same Data/service_account.json as a normal start.
+
+Run from the backend directory:
+    python -m benchmarks.bench_startup --top 8
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+
+import_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def run(mode_env, port_url, timeout):
+    env = {**os.environ, **mode_env, "PYTHONUNBUFFERED": "1"}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "server.py"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    first_request = None
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                urllib.request.urlopen(port_url, timeout=1).read()
+                first_request = time.perf_counter() - start
+                break
+            except OSError:
+                time.sleep(0.05)
+    finally:
+        process.terminate()
+        _, stderr = process.communicate()
+
+    top_level = {}
+    for match in import_line.finditer(stderr):
+        cumulative, indent, module = int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 1:
+            top_level[module] = top_level.get(module, 0) + cumulative
+    return first_request, top_level
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5001/")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--top", type=int, default=8)
+    args = parser.parse_args()
+
+    for name, env in (("full", {"API_ONLY": "0"}), ("api-only", {"API_ONLY": "1"})):
+        first_request, imports = run(env, args.url, args.timeout)
+        heavy = {m: imports.get(m, 0) for m in ("torch", "faiss", "facenet_pytorch", "cv2")}
+        print(f"== {name}")
+        print(f"time to first request: {first_request:.2f}s" if first_request else "server did not answer")
+        print(f"total import time: {sum(imports.values()) / 1e6:.2f}s  "
+              + "  ".join(f"{m}: {us / 1e6:.2f}s" for m, us in heavy.items()))
+        for module, us in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {us / 1e6:>7.3f}s  {module}")
+
+
+if __name__ == "__main__":
+    main()
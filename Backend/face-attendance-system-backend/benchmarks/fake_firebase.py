@@ -0,0 +1,174 @@
+"""
+In-memory stand-in for firebase_admin.db used by the database benchmarks. Every
+call that would be a round trip to the Realtime Database sleeps for a fixed
+latency and is counted, so benchmarks can report both.
+"""
+import copy
+import itertools
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import modules.firebase_utils as firebase_utils
+
+
+class FakeQuery:
+    def __init__(self, db, path, child):
+        self.db = db
+        self.path = path
+        self.child = child  # None orders by key
+        self.filters = []
+        self.limit = None
+
+    def equal_to(self, value):
+        self.filters.append(lambda v: v == value)
+        return self
+
+    def start_at(self, value):
+        self.filters.append(lambda v: v is not None and v >= value)
+        return self
+
+    def end_at(self, value):
+        self.filters.append(lambda v: v is not None and v <= value)
+        return self
+
+    def limit_to_first(self, limit):
+        self.limit = limit
+        return self
+
+    def ordered_by(self, key, value):
+        if self.child is None:
+            return key
+        return value.get(self.child) if isinstance(value, dict) else None
+
+    def select(self, node):
+        items = [(key, value) for key, value in (node or {}).items()
+                 if all(test(self.ordered_by(key, value)) for test in self.filters)]
+        if self.child is None:
+            items.sort(key=lambda item: item[0])
+        return OrderedDict(items[:self.limit])
+
+    def get(self):
+        # Filtered before it is copied, like the server filters before it sends
+        return self.db.read(self.path, "query", self.select)
+
+
+class FakeReference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path.strip("/")
+        self.key = self.path.rsplit("/", 1)[-1] if self.path else None
+
+    def child(self, path):
+        return FakeReference(self.db, f"{self.path}/{path}")
+
+    def get(self):
+        return self.db.read(self.path, "get")
+
+    def order_by_child(self, child):
+        return FakeQuery(self.db, self.path, child)
+
+    def order_by_key(self):
+        return FakeQuery(self.db, self.path, None)
+
+    def push(self, value=""):
+        key = f"-key{next(self.db.keys):012d}"
+        self.db.write({f"{self.path}/{key}": value}, "push")
+        return FakeReference(self.db, f"{self.path}/{key}")
+
+    def set(self, value):
+        self.db.write({self.path: value}, "set")
+
+    def update(self, values):
+        self.db.write({f"{self.path}/{key}".strip("/"): value for key, value in values.items()}, "update")
+
+    def delete(self):
+        self.db.write({self.path: None}, "delete")
+
+    def transaction(self, transaction_update):
+        # A read and a conditional write, like the round trips firebase_admin makes
+        value = transaction_update(self.db.read(self.path, "get"))
+        self.db.write({self.path: value}, "transaction")
+        return value
+
+
+class FakeDatabase:
+    """ Stands in for the firebase_admin.db module """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Arguments:
+            latency: seconds every round trip takes
+        """
+        self.latency = latency
+        self.root = {}
+        self.calls = Counter()
+        self.bytes_read = 0
+        self.keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def reference(self, path=""):
+        return FakeReference(self, path)
+
+    def _node(self, path, create=False):
+        node = self.root
+        for part in filter(None, path.split("/")):
+            if not isinstance(node, dict) or (part not in node and not create):
+                return None
+            node = node.setdefault(part, {})
+        return node
+
+    def read(self, path, kind, select=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[kind] += 1
+            node = self._node(path)
+            if select is not None:
+                node = select(node)
+            node = copy.deepcopy(node) if node != {} else None
+            self.bytes_read += len(json.dumps(node))
+            return node
+
+    def write(self, values, kind):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[kind] += 1
+            for path, value in values.items():
+                parent, _, key = path.rpartition("/")
+                if value is None or value == {}:
+                    node = self._node(parent)
+                    if isinstance(node, dict):
+                        node.pop(key, None)
+                else:
+                    self._node(parent, create=True)[key] = copy.deepcopy(value)
+
+    def reads(self) -> int:
+        return self.calls["get"] + self.calls["query"]
+
+    def writes(self) -> int:
+        return sum(self.calls.values()) - self.reads()
+
+
+def fake_firebase_database(fake: FakeDatabase, **kwargs) -> firebase_utils.FirebaseDatabase:
+    """ Builds a FirebaseDatabase that talks to the fake instead of the Realtime Database """
+    firebase_utils.db = fake
+    database = firebase_utils.FirebaseDatabase.__new__(firebase_utils.FirebaseDatabase)
+    original = firebase_utils.credentials, firebase_utils.firebase_admin
+
+    class NoCredentials:
+        @staticmethod
+        def Certificate(path):
+            return None
+
+    class NoApp:
+        @staticmethod
+        def initialize_app(*args, **kwargs):
+            return None
+
+    firebase_utils.credentials, firebase_utils.firebase_admin = NoCredentials, NoApp
+    try:
+        database.__init__(**kwargs)
+    finally:
+        firebase_utils.credentials, firebase_utils.firebase_admin = original
+    return database
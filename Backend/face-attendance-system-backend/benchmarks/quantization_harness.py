@@ -0,0 +1,98 @@
+"""
+Accuracy and latency harness for the static INT8 embedding engine.
+
+Runs a labelled set of face crops (one folder per student email) through the
+fp32 eager model and an INT8 engine and reports:
+    - cosine drift between fp32 and INT8 embeddings of the same crop
+    - match rate at the 0.8 distance threshold used by process_image_and_mark_attendance,
+      searched against the FAISS gallery (data/faiss) or, with --self-gallery, against
+      a gallery built from the first fp32 crop of every identity
+    - per-face latency of both engines
+
+Run from the backend directory:
+    python -m benchmarks.quantization_harness data/labelled_faces --engine int8_static
+"""
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+import torch
+from facenet_pytorch import InceptionResnetV1
+
+from modules.embedding_engines import load_embedding_engine, load_face_crops
+from modules.faiss_utils import FAISS
+
+distance_threshold = 0.8
+
+
+def load_labelled_crops(root: Path):
+    faces, labels = [], []
+    for identity in sorted(p for p in root.iterdir() if p.is_dir()):
+        crops = load_face_crops(identity)
+        faces.append(crops)
+        labels.extend([identity.name] * len(crops))
+    return torch.cat(faces), np.array(labels)
+
+
+def embed(engine, faces, batch_size=32):
+    timings, embeddings = [], []
+    for start in range(0, len(faces), batch_size):
+        batch = faces[start:start + batch_size]
+        began = time.perf_counter()
+        embeddings.append(engine(batch))
+        timings.append((time.perf_counter() - began) / len(batch))
+    return np.concatenate(embeddings).astype(np.float32), np.median(timings) * 1e3
+
+
+def match_rate(index, gallery_ids, embeddings, labels):
+    distances, indices = index.search(embeddings, 1)
+    accepted = distances[:, 0] <= distance_threshold
+    predicted = np.array([gallery_ids[i] if i >= 0 else "" for i in indices[:, 0]])
+    return float(np.mean(accepted & (predicted == labels))), float(np.mean(accepted & (predicted != labels)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crops", type=Path, help="directory with one sub-directory of face crops per student email")
+    parser.add_argument("--engine", default="int8_static", choices=["int8_static"])
+    parser.add_argument("--self-gallery", action="store_true", help="build the gallery from the labelled set")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    model = InceptionResnetV1(pretrained="vggface2").eval().to(device)
+    fp32 = load_embedding_engine(model, device, "eager")
+    int8 = load_embedding_engine(model, device, args.engine)
+
+    faces, labels = load_labelled_crops(args.crops)
+    fp32_embeddings, fp32_ms = embed(fp32, faces)
+    int8_embeddings, int8_ms = embed(int8, faces)
+
+    if args.self_gallery:
+        _, first = np.unique(labels, return_index=True)
+        index = faiss.IndexFlatL2(fp32_embeddings.shape[1])
+        index.add(fp32_embeddings[first])
+        gallery_ids = labels[first]
+    else:
+        gallery = FAISS(writer=False)  # Only searched, the server keeps writing data/faiss
+        index, gallery_ids = gallery.snapshot, np.array(gallery.snapshot.ids)
+
+    cosine = np.sum(fp32_embeddings * int8_embeddings, axis=1) / (
+        np.linalg.norm(fp32_embeddings, axis=1) * np.linalg.norm(int8_embeddings, axis=1))
+    fp32_correct, fp32_wrong = match_rate(index, gallery_ids, fp32_embeddings, labels)
+    int8_correct, int8_wrong = match_rate(index, gallery_ids, int8_embeddings, labels)
+
+    print(f"crops: {len(labels)}  identities: {len(np.unique(labels))}  gallery size: {index.ntotal}")
+    print(f"cosine fp32 vs {args.engine}: mean {cosine.mean():.4f}  p5 {np.percentile(cosine, 5):.4f}  min {cosine.min():.4f}")
+    print(f"{'engine':>14} {'match rate':>11} {'false match':>12} {'ms/face':>8}")
+    print(f"{'fp32':>14} {fp32_correct:>11.3f} {fp32_wrong:>12.3f} {fp32_ms:>8.2f}")
+    print(f"{args.engine:>14} {int8_correct:>11.3f} {int8_wrong:>12.3f} {int8_ms:>8.2f}")
+    print(f"match rate change: {int8_correct - fp32_correct:+.3f}  speedup: {fp32_ms / int8_ms:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
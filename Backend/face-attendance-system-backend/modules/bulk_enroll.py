@@ -0,0 +1,201 @@
+"""
+Offline enrollment of a whole intake from photos on disk.
+
+Photos come from a directory, either one folder per student named by email
+(photos/alice@uni.edu/1.jpg, photos/alice@uni.edu/2.jpg) or one file per photo
+named by email (photos/alice@uni.edu.jpg), or from a CSV manifest with an
+email and a path column (paths relative to the manifest, several rows per
+student allowed). Photos are decoded in background threads, run through MTCNN
+and FaceNet a chunk at a time and every student lands in the FAISS index in one
+batch followed by one checkpoint. Run it while the server is stopped, the
+server reads the new checkpoint when it starts.
+
+Run from the backend directory:
+    python -m modules.bulk_enroll photos/ --report failures.csv
+    python -m modules.bulk_enroll intake.csv --chunk-size 64
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import argparse
+import csv
+import time
+
+import cv2
+import numpy as np
+
+image_suffixes = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+no_face = "no face"
+multiple_faces = "multiple faces"
+unreadable = "unreadable image"
+
+
+def find_photos(source: Path) -> List[Tuple[str, Path]]:
+    """
+    Lists the photos to enroll
+    Arguments:
+        source: photo directory or CSV manifest with email and path columns
+    Returns:
+        photos: list of (email, path), grouped by email
+    """
+    source = Path(source)
+    photos = []
+    if source.is_file():
+        with open(source, newline="") as f:
+            for row in csv.DictReader(f):
+                photos.append((row["email"].strip(), source.parent / row["path"].strip()))
+    else:
+        for path in sorted(source.iterdir()):
+            if path.is_dir():
+                photos.extend((path.name, photo) for photo in sorted(path.iterdir()) if photo.suffix.lower() in image_suffixes)
+            elif path.suffix.lower() in image_suffixes:
+                photos.append((path.stem, path))
+    photos.sort(key=lambda photo: photo[0])
+    return photos
+
+
+def read_photo(path: Path, max_side: int) -> np.ndarray:
+    """ Decodes a photo to RGB, downscaled so its longer side is at most max_side, None when it cannot be read """
+    img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    scale = max_side / max(img.shape[:2])
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def chunks(photos, chunk_size: int, max_side: int, decoders: int) -> Iterator[List[Tuple[str, Path, np.ndarray]]]:
+    """ Yields chunks of decoded photos, the next chunk decodes in the background while the current one is embedded """
+    with ThreadPoolExecutor(decoders) as pool:
+        pending = None
+        for start in range(0, len(photos) + chunk_size, chunk_size):
+            chunk = photos[start:start + chunk_size]
+            decoding = [pool.submit(read_photo, path, max_side) for _, path in chunk] if chunk else None
+            if pending is not None:
+                yield [(email, path, future.result()) for (email, path), future in pending]
+            pending = list(zip(chunk, decoding)) if chunk else None
+
+
+def largest_face(boxes, multiple_face_ratio: float):
+    """
+    Picks the face to enroll from the boxes found in a photo
+    Returns:
+        box: the largest box, None when the photo has no face or a second face is too large to be background
+        error: None, no_face or multiple_faces
+    """
+    if boxes is None or len(boxes) == 0:
+        return None, no_face
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(areas)[::-1]
+    if len(boxes) > 1 and areas[order[1]] >= multiple_face_ratio * areas[order[0]]:
+        return None, multiple_faces
+    return boxes[order[0]], None
+
+
+def embed_chunk(recognizer, chunk, max_side: int, multiple_face_ratio: float):
+    """
+    Detects and embeds the faces of a chunk of photos, one MTCNN pass and one batched FaceNet run
+    Returns:
+        embedded: list of (email, embedding)
+        failures: list of (email, path, reason)
+    """
+    failures, readable = [], []
+    for email, path, img in chunk:
+        if img is None:
+            failures.append((email, path, unreadable))
+        else:
+            readable.append((email, path, img))
+    if not readable:
+        return [], failures
+
+    # Padding every photo at its right and bottom edges to one canvas keeps the box coordinates and lets MTCNN take
+    # the whole chunk as a single batch
+    canvases = np.zeros((len(readable), max_side, max_side, 3), dtype=np.uint8)
+    for canvas, (_, _, img) in zip(canvases, readable):
+        canvas[:img.shape[0], :img.shape[1]] = img
+    faces, emails = [], []
+    for (email, path, img), boxes in zip(readable, recognizer.detect_face_locations_mtcnn_batch(list(canvases))):
+        box, error = largest_face(boxes, multiple_face_ratio)
+        if error is not None:
+            failures.append((email, path, error))
+            continue
+        faces.append(recognizer.crop_faces(img, box[None]))
+        emails.append(email)
+    if not faces:
+        return [], failures
+    embeddings = recognizer.embed_faces(np.concatenate(faces))
+    return list(zip(emails, embeddings)), failures
+
+
+def bulk_enroll(source: Path, chunk_size: int = 32, max_side: int = 1024, multiple_face_ratio: float = 0.25,
+                decoders: int = 4, dry_run: bool = False) -> Tuple[int, List[Tuple[str, Path, str]]]:
+    """
+    Enrolls every student of a photo directory or manifest, replacing earlier registrations of the same emails
+    Arguments:
+        source: photo directory or CSV manifest
+        chunk_size: photos detected and embedded together
+        max_side: photos are downscaled to at most this many pixels on their longer side before detection
+        multiple_face_ratio: a photo is rejected when its second largest face has at least this fraction of the
+            area of the largest one, smaller faces are taken for people in the background
+        decoders: threads decoding photos
+        dry_run: report what would be enrolled without touching the index
+    Returns:
+        enrolled: number of students written to the index
+        failures: list of (email, path, reason) of every photo that was skipped
+    """
+    from modules.faiss_utils import aggregate_templates
+    from modules.utils import enrollment_templates, get_face_recognizer, get_faiss
+
+    photos = find_photos(source)
+    recognizer = get_face_recognizer()
+    start = time.perf_counter()
+    embeddings, failures = {}, []
+    done = 0
+    for chunk in chunks(photos, chunk_size, max_side, decoders):
+        embedded, chunk_failures = embed_chunk(recognizer, chunk, max_side, multiple_face_ratio)
+        for email, embedding in embedded:
+            embeddings.setdefault(email, []).append(embedding)
+        failures.extend(chunk_failures)
+        done += len(chunk)
+        elapsed = time.perf_counter() - start
+        print(f"{done}/{len(photos)} photos  {done / elapsed:.1f} photos/s  {len(failures)} skipped")
+
+    emails = list(embeddings)
+    templates = [aggregate_templates(np.stack(embeddings[email]), enrollment_templates) for email in emails]
+    if emails and not dry_run:
+        gallery = get_faiss()
+        gallery.update_index(templates, emails)
+        gallery.checkpoint(force=True)
+    print(f"Enrolled {len(emails)} students from {len(photos) - len(failures)} photos in "
+          f"{time.perf_counter() - start:.1f}s, {len(failures)} photos skipped")
+    return len(emails), failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll students in the face index from photos on disk")
+    parser.add_argument("source", type=Path, help="photo directory or CSV manifest with email and path columns")
+    parser.add_argument("--chunk-size", type=int, default=32)
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--multiple-face-ratio", type=float, default=0.25)
+    parser.add_argument("--decoders", type=int, default=4)
+    parser.add_argument("--report", type=Path, help="CSV to write the skipped photos to")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    _, failures = bulk_enroll(args.source, args.chunk_size, args.max_side, args.multiple_face_ratio, args.decoders,
+                              args.dry_run)
+    for email, path, reason in failures:
+        print(f"{reason:16s} {email} {path}")
+    if args.report:
+        with open(args.report, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["email", "path", "reason"])
+            writer.writerows(failures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+from pathlib import Path
+
+import copy
+import cv2
+import numpy as np
+import torch
+
+# Exported models are cached here so the export only happens once per torch version
+default_engine_cache = Path("data/models")
+# Face crops (one image per face) used to calibrate the static INT8 model
+default_calibration_dir = Path("data/calibration")
+# Dynamic INT8 quantization is not offered, it only reaches the final Linear layer of InceptionResnetV1 and runs
+# every convolution in fp32, so it is no faster than eager
+engines = ("eager", "torchscript", "onnx", "int8_static")
+face_size = 160
+
+
+class EagerEngine:
+    """ Runs the InceptionResnetV1 module as is """
+    name = "eager"
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(batch.to(self.device)).cpu().numpy()
+
+
+class TorchScriptEngine(EagerEngine):
+    """ Runs a traced and frozen TorchScript version of the model """
+    name = "torchscript"
+
+    @classmethod
+    def load(cls, model, device, cache_dir: Path = default_engine_cache):
+        path = cache_dir / f"inception_resnet_v1_vggface2_torch{torch.__version__.split('+')[0]}.pt"
+        if path.exists():
+            scripted = torch.jit.load(str(path), map_location=device)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            example = torch.rand(1, 3, face_size, face_size, device=device)
+            with torch.no_grad():
+                scripted = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+            scripted.save(str(path))
+            print(f"Exported TorchScript embedding model to {path}")
+        return cls(torch.jit.optimize_for_inference(scripted), device)
+
+
+class OnnxEngine:
+    """ Runs an exported ONNX graph of the model in ONNX Runtime (CPU) """
+    name = "onnx"
+    opset = 17
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        inputs = np.ascontiguousarray(batch.cpu().numpy(), dtype=np.float32)
+        return self.session.run(None, {self.input_name: inputs})[0]
+
+    @classmethod
+    def load(cls, model, device, cache_dir: Path = default_engine_cache, num_threads: int = 0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx engine needs onnxruntime, install it with `pip install onnxruntime`")
+
+        path = cache_dir / f"inception_resnet_v1_vggface2_opset{cls.opset}.onnx"
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            example = torch.rand(1, 3, face_size, face_size)
+            torch.onnx.export(
+                model.eval().cpu(), example, str(path),
+                input_names=["faces"], output_names=["embeddings"],
+                dynamic_axes={"faces": {0: "batch"}, "embeddings": {0: "batch"}},
+                opset_version=cls.opset,
+            )
+            model.to(device)
+            print(f"Exported ONNX embedding model to {path}")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        return cls(session)
+
+
+class QuantizedEngine(EagerEngine):
+    """
+    Runs a post-training static INT8 copy of the model on the CPU, every convolution and the final linear layer are
+    quantized with FX graph mode after calibrating on face crops
+    """
+    name = "int8_static"
+
+    @classmethod
+    def load(cls, model, cache_dir: Path = default_engine_cache, calibration_dir: Path = default_calibration_dir):
+        device = torch.device("cpu")
+        if "x86" in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = "x86"
+        model = copy.deepcopy(model).cpu().eval()
+
+        path = cache_dir / f"inception_resnet_v1_vggface2_int8_static_torch{torch.__version__.split('+')[0]}.pt"
+        if path.exists():
+            scripted = torch.jit.load(str(path), map_location=device)
+        else:
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+            calibration_faces = load_face_crops(calibration_dir)
+            if len(calibration_faces) == 0:
+                raise ValueError(f"int8_static needs face crops to calibrate on, none found in {calibration_dir}")
+            example = calibration_faces[:1]
+            prepared = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine), (example,))
+            with torch.no_grad():
+                for start in range(0, len(calibration_faces), 32):
+                    prepared(calibration_faces[start:start + 32])
+                scripted = torch.jit.freeze(torch.jit.trace(convert_fx(prepared), example))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            scripted.save(str(path))
+            print(f"Calibrated static INT8 embedding model on {len(calibration_faces)} faces, saved to {path}")
+        return cls(scripted, device)
+
+
+def load_face_crops(directory: Path, limit: int = None) -> torch.Tensor:
+    """
+    Loads face crops from a directory tree as a FaceNet input batch
+    Arguments:
+        directory: folder searched recursively for .jpg/.jpeg/.png files
+        limit: maximum number of crops
+    Returns:
+        faces: torch.Tensor (N, 3, 160, 160) float in [0, 1]
+    """
+    paths = sorted(p for p in Path(directory).rglob("*") if p.suffix.lower() in (".jpg", ".jpeg", ".png"))[:limit]
+    faces = np.empty((len(paths), face_size, face_size, 3), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        faces[i] = cv2.resize(cv2.cvtColor(cv2.imread(str(path)), cv2.COLOR_BGR2RGB), (face_size, face_size))
+    return torch.from_numpy(faces).permute(0, 3, 1, 2).float().div(255.0)
+
+
+def check_engine_parity(engine, model, device, batch_size: int = 8, tolerance: float = 1e-3) -> dict:
+    """
+    Compares the embeddings of an engine with the eager model on random faces
+    Arguments:
+        engine: callable returning (N, 512) embeddings for a (N, 3, 160, 160) tensor
+        model: eager InceptionResnetV1
+        device: torch.device
+        batch_size: number of random faces to compare
+        tolerance: largest allowed absolute difference, None only reports the drift
+    Returns:
+        report: dict with max_abs_diff and min_cosine
+    """
+    faces = torch.rand(batch_size, 3, face_size, face_size, generator=torch.Generator().manual_seed(0))
+    expected = EagerEngine(model, device)(faces)
+    actual = engine(faces)
+    max_abs_diff = float(np.abs(expected - actual).max())
+    cosine = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    report = {"engine": engine.name, "max_abs_diff": max_abs_diff, "min_cosine": float(cosine.min())}
+    if tolerance is not None and max_abs_diff > tolerance:
+        raise RuntimeError(f"{engine.name} embeddings differ from the eager model: {report}")
+    return report
+
+
+def load_embedding_engine(model, device, engine: str = "eager", cache_dir: Path = default_engine_cache,
+                          calibration_dir: Path = default_calibration_dir):
+    """
+    Builds the requested engine for the embedding model, exporting and caching it on first use
+    Arguments:
+        model: eager InceptionResnetV1 in eval mode
+        device: torch.device
+        engine: one of engines
+        cache_dir: directory for exported models
+        calibration_dir: face crops used to calibrate int8_static
+    Returns:
+        engine: callable taking a (N, 3, 160, 160) float tensor and returning (N, 512) np.ndarray
+    """
+    if engine == "eager":
+        return EagerEngine(model, device)
+    if engine == "torchscript":
+        loaded = TorchScriptEngine.load(model, device, cache_dir)
+    elif engine == "onnx":
+        loaded = OnnxEngine.load(model, device, cache_dir)
+    elif engine == "int8_static":
+        # Quantized models are expected to drift, measure it with benchmarks/quantization_harness.py
+        loaded = QuantizedEngine.load(model, cache_dir, calibration_dir)
+        print(f"Embedding engine drift: {check_engine_parity(loaded, model, device, tolerance=None)}")
+        return loaded
+    else:
+        raise ValueError(f"Unknown embedding engine '{engine}', expected one of {engines}")
+
+    print(f"Embedding engine parity: {check_engine_parity(loaded, model, device)}")
+    return loaded
@@ -0,0 +1,108 @@
+from pathlib import Path
+from typing import Tuple
+
+import json
+
+import numpy as np
+
+# Bumped whenever the layout of the files below changes
+store_format = 1
+embeddings_file_name = "embeddings.npy"
+embedding_labels_file_name = "embedding_labels.npy"
+embeddings_meta_file_name = "embeddings.json"
+
+
+class EmbeddingStore:
+    """
+    The face embeddings of the gallery as registered, independent of the index built from them. Row i of vectors
+    belongs to labels[i], the same int64 labels the FAISS index uses, and every row was produced by model_version.
+
+    A store is never changed once built: replaced returns a new store, so a store can be shared by a published
+    gallery snapshot and read without locking. Loaded stores are memory-mapped and cost no memory until read.
+    """
+
+    def __init__(self, model_version: str, dimension: int, dtype: str = "float32", vectors: np.ndarray = None,
+                 labels: np.ndarray = None):
+        """
+        Arguments:
+            model_version: name of the embedding model, stores of different models cannot be mixed
+            dimension: length of the embeddings
+            dtype: "float32", or "float16" to halve the size at a precision loss far below the match threshold
+            vectors: np.ndarray (N, dimension) of dtype
+            labels: np.ndarray (N,) int64
+        """
+        self.model_version = model_version
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.vectors = np.empty((0, dimension), dtype=self.dtype) if vectors is None else vectors
+        self.labels = np.empty(0, dtype=np.int64) if labels is None else labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def exists(directory: Path) -> bool:
+        return (Path(directory) / embeddings_meta_file_name).exists()
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "EmbeddingStore":
+        """
+        Reads a store written by save
+        Arguments:
+            directory: folder holding the store files
+            mmap: map the matrix read-only instead of reading it into memory
+        """
+        directory = Path(directory)
+        meta = json.loads((directory / embeddings_meta_file_name).read_text())
+        if meta["format"] != store_format:
+            raise ValueError(f"Embedding store format {meta['format']} in {directory} is not supported")
+        mmap_mode = "r" if mmap and meta["count"] else None
+        vectors = np.load(directory / embeddings_file_name, mmap_mode=mmap_mode)
+        labels = np.load(directory / embedding_labels_file_name)
+        return cls(meta["model_version"], meta["dimension"], meta["dtype"], vectors, labels)
+
+    def save(self, directory: Path):
+        """ Writes the store into a directory, the caller makes the files durable """
+        directory = Path(directory)
+        np.save(directory / embeddings_file_name, np.ascontiguousarray(self.vectors))
+        np.save(directory / embedding_labels_file_name, self.labels)
+        meta = {
+            "format": store_format,
+            "model_version": self.model_version,
+            "dimension": self.dimension,
+            "dtype": self.dtype.name,
+            "count": len(self),
+        }
+        (directory / embeddings_meta_file_name).write_text(json.dumps(meta))
+
+    def replaced(self, changes: dict) -> "EmbeddingStore":
+        """
+        Returns a store with the rows of some labels swapped out, one pass over the matrix however many labels change
+        Arguments:
+            changes: label -> np.ndarray (M, dimension) new embeddings of the label, None to drop it
+        """
+        if not changes:
+            return self
+        changed = np.fromiter(changes, dtype=np.int64, count=len(changes))
+        keep = ~np.isin(self.labels, changed)
+        added = [(label, rows) for label, rows in changes.items() if rows is not None and len(rows)]
+        vectors = np.concatenate([self.vectors[keep]] + [rows.astype(self.dtype) for _, rows in added])
+        labels = np.concatenate([self.labels[keep]] + [np.full(len(rows), label, dtype=np.int64) for label, rows in added])
+        return EmbeddingStore(self.model_version, self.dimension, self.dtype.name, vectors, labels)
+
+    def all(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            vectors: np.ndarray (N, dimension) float32
+            labels: np.ndarray (N,) int64
+        """
+        return np.ascontiguousarray(self.vectors, dtype=np.float32), self.labels
+
+    def vectors_for(self, labels) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            vectors: np.ndarray (M, dimension) float32, every embedding of the given labels
+            vector_labels: np.ndarray (M,) int64 label of each row
+        """
+        rows = np.flatnonzero(np.isin(self.labels, np.fromiter(labels, dtype=np.int64)))
+        return np.ascontiguousarray(self.vectors[rows], dtype=np.float32), self.labels[rows]
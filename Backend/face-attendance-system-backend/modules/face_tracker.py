@@ -0,0 +1,133 @@
+from typing import List
+
+import numpy as np
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """ Pairwise IoU between two sets of (x1, y1, x2, y2) boxes, shape (len(boxes_a), len(boxes_b)) """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-6)
+
+
+class Track:
+    def __init__(self, track_id: int, box):
+        self.track_id = track_id
+        self.box = box
+        self.verified_box = None    # box at the time the identity was last computed
+        self.embedding = None
+        self.person_id = ""         # email from the FAISS index, "" when unknown
+        self.distance = None
+        self.misses = 0
+        self.frames_since_verified = 0
+
+
+class FaceTracker:
+    """
+    IoU tracker over MTCNN boxes for one camera stream.
+    Every box is matched to a track, only new tracks, tracks that drifted away from the box they were
+    identified at and tracks due for re-verification need a new embedding and FAISS search.
+    """
+
+    def __init__(self, match_iou: float = 0.3, drift_iou: float = 0.6, max_misses: int = 5,
+                 reverify_every: int = 50, retry_unknown_every: int = 5):
+        """
+        Arguments:
+            match_iou: minimum IoU between a track and a box to continue the track
+            drift_iou: below this IoU with the verified box the track is identified again
+            max_misses: frames a track survives without a matching box
+            reverify_every: frames after which a known track is identified again
+            retry_unknown_every: frames after which an unknown track is identified again
+        """
+        self.match_iou = match_iou
+        self.drift_iou = drift_iou
+        self.max_misses = max_misses
+        self.reverify_every = reverify_every
+        self.retry_unknown_every = retry_unknown_every
+
+        self.tracks: List[Track] = []
+        self.current: List[Track] = []  # track of each box of the last frame, in box order
+        self._pending: List[Track] = []
+        self._next_track_id = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def assign(self, boxes) -> np.ndarray:
+        """
+        Matches the boxes of a new frame to tracks
+        Arguments:
+            boxes: bounding boxes of the frame (or None)
+        Returns:
+            indices: np.ndarray of the boxes that need an embedding, pass their embeddings to update_identities
+        """
+        boxes = np.empty((0, 4), dtype=np.float32) if boxes is None else np.asarray(boxes).reshape(-1, 4)
+        iou = box_iou(np.array([track.box for track in self.tracks]), boxes)
+
+        # Greedy matching, highest IoU first
+        matched_tracks, self.current = set(), [None] * len(boxes)
+        for t, b in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+            if iou[t, b] < self.match_iou:
+                break
+            if t in matched_tracks or self.current[b] is not None:
+                continue
+            matched_tracks.add(t)
+            self.current[b] = self.tracks[t]
+
+        for t, track in enumerate(self.tracks):
+            track.misses = 0 if t in matched_tracks else track.misses + 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        indices = []
+        for b, box in enumerate(boxes):
+            track = self.current[b]
+            if track is None:
+                track = self.current[b] = Track(self._next_track_id, box)
+                self._next_track_id += 1
+                self.tracks.append(track)
+            track.box = box
+            track.frames_since_verified += 1
+            if self._needs_identity(track):
+                indices.append(b)
+        self._pending = [self.current[b] for b in indices]
+
+        self.lookups += len(boxes)
+        self.hits += len(boxes) - len(indices)
+        return np.array(indices, dtype=np.int64)
+
+    def _needs_identity(self, track: Track) -> bool:
+        if track.verified_box is None:
+            return True
+        if box_iou(track.verified_box, track.box)[0, 0] < self.drift_iou:
+            return True
+        limit = self.reverify_every if track.person_id else self.retry_unknown_every
+        return track.frames_since_verified >= limit
+
+    def update_identities(self, embeddings, person_ids, distances):
+        """
+        Stores the identities of the boxes returned by the last assign call
+        Arguments:
+            embeddings: np.ndarray (N, 512)
+            person_ids: list of N emails, "" for unknown faces
+            distances: list of N distances (None for unknown faces)
+        """
+        for track, embedding, person_id, distance in zip(self._pending, embeddings, person_ids, distances):
+            track.embedding = embedding
+            track.person_id = person_id
+            track.distance = distance
+            track.verified_box = track.box
+            track.frames_since_verified = 0
+        self._pending = []
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self) -> dict:
+        return {"tracks": len(self.tracks), "lookups": self.lookups, "hits": self.hits, "hit_rate": self.hit_rate}
@@ -2,11 +2,191 @@ from pathlib import Path
 
 import faiss
 import numpy as np
-from typing import List 
+import os
+import shutil
+import threading
+import time
+from typing import List, Tuple
+
+from modules.embedding_store import EmbeddingStore
+from modules.registration_journal import RegistrationJournal, op_remove, op_replace
 # Initialize FAISS index
 dimension = 512  # Face encoding dimension
-default_faiss_idx = Path("data/faiss/face_index.index")
-default_faiss_ids = Path("data/faiss/face_ids.npy")
+default_faiss_dir = Path("data/faiss")
+default_faiss_idx = default_faiss_dir / "face_index.index"
+default_faiss_ids = default_faiss_dir / "face_ids.npy"
+# Registrations since the last checkpoint, replayed on top of it at startup
+journal_file_name = "registrations.journal"
+# Holds the name of the checkpoint directory to load, replaced atomically
+current_checkpoint_file_name = "CURRENT"
+# Embeddings of another model cannot be searched against these, see EmbeddingStore
+default_model_version = "facenet-vggface2"
+
+# flat is exact brute force, hnsw and the IVF types are approximate and meant for campus-wide galleries
+index_types = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+hnsw_m = 32
+hnsw_ef_construction = 80
+# HNSW graphs cannot delete: rows of removed or re-registered students stay in the graph, left out of searches,
+# until they make up this fraction of it and a fold rebuilds the graph
+hnsw_max_removed_fraction = 0.1
+removed_rows_file_name = "removed_rows.npy"
+# IVF indexes stay flat until this many vectors exist to train the coarse quantizer (and the 256 PQ centroids) on
+ivf_min_train_size = 10000
+pq_subquantizers = 64  # 8 dimensions per byte of code
+# How the embeddings of a registration's capture steps are stored, see aggregate_templates
+template_modes = ("prototype", "medoid", "all")
+# Vectors registered since the base index was built, they are searched exactly until a fold merges them into the base
+max_delta_vectors = 10000
+
+
+def create_index(index_type: str, vectors: np.ndarray = None, labels: np.ndarray = None) -> faiss.Index:
+    """
+    Builds an index of the given type, training it on the vectors when it needs training
+    Arguments:
+        index_type: one of index_types, IVF types fall back to flat while there are too few vectors to train
+        vectors: np.ndarray (N, 512) to add, None for an empty index
+        labels: np.ndarray (N,) int64 labels of the vectors
+    Returns:
+        index: flat and hnsw are wrapped in an IndexIDMap2, IVF indexes store the labels themselves
+    """
+    if index_type not in index_types:
+        raise ValueError(f"Unknown FAISS index type '{index_type}', expected one of {index_types}")
+    count = 0 if vectors is None else len(vectors)
+    if index_type in ("ivf_flat", "ivf_pq") and count >= ivf_min_train_size:
+        nlist = int(np.clip(4 * np.sqrt(count), 16, count // 39))
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_subquantizers, 8)
+        index.train(vectors)
+    elif index_type == "hnsw":
+        base = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        base.hnsw.efConstruction = hnsw_ef_construction
+        index = faiss.IndexIDMap2(base)
+    else:
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    if count:
+        index.add_with_ids(vectors, labels)
+    return index
+
+
+def index_type_of(index: faiss.Index) -> str:
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexIDMap2) and isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def index_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads every vector back out of an index, IVF-PQ vectors come back approximated by their codes
+    Returns:
+        vectors: np.ndarray (N, 512) float32
+        labels: np.ndarray (N,) int64
+    """
+    if isinstance(index, faiss.IndexIVF):
+        vectors, labels = np.empty((index.ntotal, dimension), dtype=np.float32), np.empty(index.ntotal, dtype=np.int64)
+        row = 0
+        for list_no in range(index.nlist):
+            size = index.invlists.list_size(list_no)
+            if size == 0:
+                continue
+            labels[row:row + size] = faiss.rev_swig_ptr(index.invlists.get_ids(list_no), size)
+            for offset in range(size):
+                index.reconstruct_from_offset(list_no, offset, faiss.swig_ptr(vectors[row + offset]))
+            row += size
+        return vectors, labels
+    vectors = index.index.reconstruct_n(0, index.ntotal) if index.ntotal else np.empty((0, dimension), dtype=np.float32)
+    return vectors, faiss.vector_to_array(index.id_map).astype(np.int64)
+
+
+def configure_search(index: faiss.Index, nprobe: int, ef_search: int):
+    """ Sets the query-time accuracy knobs, they are not all kept by write_index """
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(nprobe, index.nlist)
+    elif index_type_of(index) == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search
+
+
+def aggregate_templates(embeddings: np.ndarray, mode: str = "prototype") -> np.ndarray:
+    """
+    Turns the embeddings of one person's capture steps into the vectors stored for them
+    Arguments:
+        embeddings: np.ndarray (M, 512) L2-normalized FaceNet embeddings
+        mode: "prototype" (normalized mean), "medoid" (the template closest to the others) or "all"
+    Returns:
+        templates: np.ndarray (1, 512) for prototype and medoid, the M embeddings for all
+    """
+    if mode not in template_modes:
+        raise ValueError(f"Unknown template mode '{mode}', expected one of {template_modes}")
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, dimension)
+    if mode == "all" or len(embeddings) == 1:
+        return embeddings
+    if mode == "prototype":
+        mean = embeddings.mean(axis=0)
+        return (mean / max(np.linalg.norm(mean), 1e-12))[None]
+    distances = np.linalg.norm(embeddings[:, None] - embeddings[None], axis=2)
+    return embeddings[np.argmin(distances.sum(axis=1))][None]
+
+
+def vote(labels: np.ndarray, distances: np.ndarray, accepted: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Top-k voting over search results when every template of a person is stored: the label with the most accepted
+    templates among the k nearest wins, ties go to the closest one
+    Arguments:
+        labels, distances, accepted: (N, k) arrays returned by search
+    Returns:
+        labels: np.ndarray (N, 1) int64
+        distances: np.ndarray (N, 1) float32, distance of the winner's closest template
+        accepted: np.ndarray (N, 1) bool
+    """
+    winners = np.full((len(labels), 1), -1, dtype=np.int64)
+    winner_distances = np.full((len(labels), 1), np.inf, dtype=np.float32)
+    for row in range(len(labels)):
+        candidates = labels[row][accepted[row]]
+        if len(candidates) == 0:
+            continue
+        # Results are sorted by distance, so the first occurrence of each label is its closest template
+        unique, first, counts = np.unique(candidates, return_index=True, return_counts=True)
+        best = np.lexsort((first, -counts))[0]
+        winners[row, 0] = unique[best]
+        winner_distances[row, 0] = distances[row][accepted[row]][first[best]]
+    return winners, winner_distances, winners >= 0
+
+
+def copy_index(index: faiss.Index) -> faiss.Index:
+    """ Private, writable copy of an index, also of one mapped from a checkpoint """
+    # A clone of a mapped index still views the file, faiss aborts on writes to it
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def excluding(index: faiss.Index, labels: faiss.IDSelector) -> faiss.SearchParameters:
+    """
+    Search parameters of an index that leave out some labels, carrying the knobs set by configure_search. Made per
+    search: IndexIDMap2 swaps the selector of the parameters it is given while it searches.
+    """
+    selector = faiss.IDSelectorNot(labels)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if index_type_of(index) == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(index.index).hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_index(index, embeddings: np.ndarray, number_of_results: int = 1,
+                 distance_threshold: float = 0.6) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ One search over an (N, 512) matrix of a faiss index or a GallerySnapshot, see FAISS.search """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, dimension)
+    if len(embeddings) == 0 or index.ntotal == 0:
+        shape = (len(embeddings), number_of_results)
+        return np.full(shape, -1, dtype=np.int64), np.full(shape, np.inf, dtype=np.float32), np.zeros(shape, dtype=bool)
+    distances, labels = index.search(embeddings, number_of_results)
+    accepted = (labels >= 0) & (distances <= distance_threshold)
+    return labels, distances, accepted
 
 
 class Person:
@@ -16,50 +196,619 @@ class Person:
         self.distance = distance
 
 
+def stacked(changes: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Arguments:
+        changes: label -> np.ndarray (M, 512) vectors of the label, None for a removed label
+    Returns:
+        vectors: np.ndarray (N, 512) float32, the vectors of every label that was not removed
+        labels: np.ndarray (N,) int64 label of each row
+    """
+    added = [(label, rows) for label, rows in changes.items() if rows is not None and len(rows)]
+    if not added:
+        return np.empty((0, dimension), dtype=np.float32), np.empty(0, dtype=np.int64)
+    return (np.ascontiguousarray(np.concatenate([rows for _, rows in added]), dtype=np.float32),
+            np.concatenate([np.full(len(rows), label, dtype=np.int64) for label, rows in added]))
+
+
+class GallerySnapshot:
+    """
+    Published state of the gallery, never mutated once published, searches hold on to the one they started with.
+    index and embeddings are the base built by the last fold. changes holds every registration and removal since
+    (label -> vectors, None once removed) and delta is a small flat index over their vectors: searches leave the
+    labels of changes out of the base and merge in the delta, so a registration never copies the base. An HNSW base
+    can also hold removed_rows, graph rows whose vectors were folded away but cannot be deleted from the graph.
+    """
+    __slots__ = ("index", "ids", "embeddings", "seq", "changes", "delta", "ntotal", "removed_rows", "_changed",
+                 "_removed", "_labels")
+
+    def __init__(self, index: faiss.Index, ids, embeddings: EmbeddingStore, seq: int, changes: dict = None,
+                 hidden: int = 0, labels: dict = None, removed_rows: np.ndarray = None, removed: faiss.IDSelector = None):
+        """
+        Arguments:
+            index: base index
+            ids: label -> email
+            embeddings: store the base index was built from
+            seq: journal seq of the last change contained
+            changes: label -> np.ndarray (M, 512) or None, everything since the base
+            hidden: vectors of the base index belonging to labels of changes
+            labels: email -> label if already built
+            removed_rows: np.ndarray int64 rows of an HNSW base left out of searches
+            removed: IDSelectorBatch of removed_rows, shared by the snapshots of one base
+        """
+        self.index = index
+        self.ids = ids
+        self.embeddings = embeddings
+        self.seq = seq
+        self.changes = {} if changes is None else changes
+        self.delta = create_index("flat", *stacked(self.changes))
+        self.removed_rows = np.empty(0, dtype=np.int64) if removed_rows is None else removed_rows
+        self.ntotal = index.ntotal - len(self.removed_rows) - hidden + self.delta.ntotal
+        changed = np.fromiter(self.changes, dtype=np.int64, count=len(self.changes))
+        self._changed = faiss.IDSelectorBatch(changed) if len(changed) else None
+        self._removed = removed
+        self._labels = labels
+
+    @property
+    def labels(self) -> dict:
+        """ email -> label, built on first use so processes that only search never pay for it """
+        if self._labels is None:
+            self._labels = {str(email): label for label, email in enumerate(self.ids) if email}
+        return self._labels
+
+    def search(self, embeddings: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ faiss Index.search over the base and the delta, returns distances and labels """
+        if self._removed is not None:
+            distances, labels = self._search_graph(embeddings, k)
+        elif self._changed is not None:
+            distances, labels = self.index.search(embeddings, k, params=excluding(self.index, self._changed))
+        else:
+            distances, labels = self.index.search(embeddings, k)
+        if self.delta.ntotal:
+            delta_distances, delta_labels = self.delta.search(embeddings, k)
+            distances, labels = np.hstack((distances, delta_distances)), np.hstack((labels, delta_labels))
+            nearest = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            distances, labels = np.take_along_axis(distances, nearest, 1), np.take_along_axis(labels, nearest, 1)
+        return distances, labels
+
+    def _search_graph(self, embeddings: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Searches the graph of an HNSW base by row, removed rows share their label with the rows replacing them """
+        excluded = self._removed
+        if self._changed is not None:
+            excluded = faiss.IDSelectorOr(excluded, faiss.IDSelectorTranslated(self.index.id_map, self._changed))
+        graph = faiss.downcast_index(self.index.index)
+        params = faiss.SearchParametersHNSW(sel=faiss.IDSelectorNot(excluded), efSearch=graph.hnsw.efSearch)
+        distances, rows = graph.search(embeddings, k, params=params)
+        row_labels = faiss.rev_swig_ptr(self.index.id_map.data(), self.index.id_map.size())
+        return distances, np.where(rows >= 0, row_labels[rows], -1)
+
+    def vectors_for(self, labels) -> Tuple[np.ndarray, np.ndarray]:
+        """ See FAISS.vectors_for """
+        labels = set(labels)
+        vectors, vector_labels = self.embeddings.vectors_for(label for label in labels if label not in self.changes)
+        changed, changed_labels = stacked({label: self.changes[label] for label in labels if label in self.changes})
+        return np.concatenate((vectors, changed)), np.concatenate((vector_labels, changed_labels))
+
+
+class PendingChanges:
+    """ Changes of one caller waiting to be applied with the rest of the batch """
+
+    def __init__(self, changes):
+        self.changes = changes  # list of (op, person_id, encodings)
+        self.results = None
+        self.error = None
+        self.done = False
+
+
 class FAISS:
-    def __init__(self):
-        self.index = self.load_faiss_index()
-        self.ids = self.load_face_ids()
+    """
+    Face gallery keyed by email. Vectors live in the index under int64 labels, self.ids[label] is the email of
+    a label ("" once the student was removed) and self.labels is the reverse map. A student keeps its label across
+    re-registrations, so the gallery always holds exactly one set of vectors per student. self.embeddings keeps the
+    registered vectors themselves, every index type is built from it.
+
+    Searches never take a lock, they run against self.snapshot. Changes are queued and applied in batches by
+    whichever writer holds the lock: a batch only adds its changes to the delta of the next snapshot (see
+    GallerySnapshot), which is swapped in once every change of the batch is journaled. Checkpoints fold the delta
+    into a new base index without holding the writer lock.
+    """
+
+    def __init__(self, directory: Path = default_faiss_dir, fsync: bool = True, index_type: str = "flat",
+                 nprobe: int = 16, ef_search: int = 64, mmap: bool = False, model_version: str = default_model_version,
+                 embedding_dtype: str = "float32", writer: bool = True):
+        """
+        Arguments:
+            directory: folder holding the checkpoints and the registration journal
+            fsync: fsync every journal append, only turn off for benchmarks
+            index_type: one of index_types, an index of another type is re-indexed on load
+            nprobe: inverted lists visited per query by the IVF types
+            ef_search: candidate list size per query of hnsw
+            mmap: map the checkpoint files instead of reading them into private memory, processes on one host then
+                share a single copy of the gallery through the page cache
+            model_version: embedding model the registrations come from, stored with the embeddings
+            embedding_dtype: "float32" or "float16" storage of the embeddings of a new gallery
+            writer: False for a process that only searches a gallery written by another one, it reads the
+                checkpoint and journal without repairing or re-indexing them
+        """
+        if index_type not in index_types:
+            raise ValueError(f"Unknown FAISS index type '{index_type}', expected one of {index_types}")
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.mmap = mmap
+        self.model_version = model_version
+        self.embedding_dtype = embedding_dtype
+        self.directory = Path(directory)
+        self.journal = RegistrationJournal(self.directory / journal_file_name, dimension, fsync)
+        self._lock = threading.RLock()  # Held by the writer applying a batch
+        self._queue_lock = threading.Lock()
+        self._queue = []
+        self._checkpoint_lock = threading.Lock()  # Held while folding and writing a checkpoint, taken before _lock
+        self._checkpoint_due = threading.Event()
+        self._checkpointer = None
+        self._stopping = False
+        self.batches = 0
+        self.batched_changes = 0
+        self.load(repair=writer)
+
+    def load(self, repair: bool = True):
+        """
+        Loads the last checkpoint (or the files written before checkpoints existed) and replays the journal on top
+        Arguments:
+            repair: cut off a torn journal tail, only for the process that writes registrations
+        """
+        with self._lock:
+            self.journal.close()
+            checkpoint = self.current_checkpoint()
+            base = checkpoint if checkpoint else self.directory
+            # Only a gallery that was never checkpointed starts empty, a checkpoint is never silently replaced by one
+            self.index = self.load_faiss_index(base / default_faiss_idx.name, create=checkpoint is None)
+            self.ids = self.load_face_ids(base / default_faiss_ids.name)
+            self.checkpoint_seq = self.seq = int(checkpoint.name.split("-")[1]) if checkpoint else 0
+            migrated = self.migrate_legacy_index()
+            stored = self.load_embeddings(checkpoint)
+            self._base_counts = np.bincount(self.embeddings.labels)
+            self._removed_rows = self.load_removed_rows(checkpoint)
+            self._removed = faiss.IDSelectorBatch(self._removed_rows) if len(self._removed_rows) else None
+            self._labels = None
+            self._changes = {}
+            configure_search(self.index, self.nprobe, self.ef_search)
+            self._publish()
+
+            records = [record for record in self.journal.read(repair) if record[0] > self.checkpoint_seq]
+            for seq, _, op, person_id, encodings in records:
+                if op == op_replace:
+                    self._replace(person_id, encodings)
+                elif op == op_remove:
+                    self._remove(person_id)
+                self.seq = seq
+            if records:
+                print(f"Replayed {len(records)} registrations from {self.journal.path}")
+            self._publish()
+        reindex = index_type_of(self.index) != self._wanted_type(self.snapshot.ntotal)
+        if (migrated or not stored or reindex) and repair:
+            self.checkpoint(force=True)
+
+    def reload(self):
+        """ Re-reads the checkpoint and journal written by another process """
+        self.load(repair=False)
 
     # Function to load FAISS index
-    def load_faiss_index(self, index_file = default_faiss_idx):
+    def load_faiss_index(self, index_file = default_faiss_idx, create: bool = True):
         # Check and create the parent directory if not present
         if not index_file.parent.exists():
             index_file.parent.mkdir(parents=True)
         if index_file.exists():
+            if self.mmap:
+                return faiss.read_index(str(index_file), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
             return faiss.read_index(str(index_file))
+        elif not create:
+            raise FileNotFoundError(f"FAISS index {index_file} is missing")
         else:
             # Initialize a new FAISS index if it does not exist
-            return faiss.IndexFlatL2(dimension)
+            return create_index(self.index_type)
 
     # Function to load face IDs
     def load_face_ids(self, ids_file = default_faiss_ids):
         if ids_file.exists():
+            if self.mmap:
+                ids = np.load(ids_file, mmap_mode="r")  # Read-only, copied into a list before the first change
+                return ids if len(ids) else []
             return np.load(ids_file).tolist()  # Load as list for easy appending
         else:
             return []  # Return empty list if file does not exist
 
+    def load_embeddings(self, checkpoint: Path) -> bool:
+        """
+        Loads the embedding store of a checkpoint, galleries checkpointed before the store existed get one built from
+        the vectors of their index
+        Returns:
+            stored: False when the store was built and needs a checkpoint
+        """
+        if checkpoint and EmbeddingStore.exists(checkpoint):
+            self.embeddings = EmbeddingStore.load(checkpoint)
+            if self.embeddings.model_version != self.model_version:
+                print(f"Face embeddings in {checkpoint} come from {self.embeddings.model_version}, not "
+                      f"{self.model_version}, re-enroll the gallery before searching it with the new model")
+            return True
+        vectors, labels = index_vectors(self.index)
+        if isinstance(self.index, faiss.IndexIVFPQ):
+            print(f"Building the embedding store from IVF-PQ codes, {len(labels)} vectors are approximations")
+        self.embeddings = EmbeddingStore(self.model_version, dimension, self.embedding_dtype,
+                                         vectors.astype(self.embedding_dtype), labels)
+        return not len(labels)
+
+    def load_removed_rows(self, checkpoint: Path) -> np.ndarray:
+        """ Rows of the checkpointed HNSW graph left out of searches, see hnsw_max_removed_fraction """
+        if checkpoint and (checkpoint / removed_rows_file_name).exists() and index_type_of(self.index) == "hnsw":
+            return np.load(checkpoint / removed_rows_file_name)
+        return np.empty(0, dtype=np.int64)
+
+    def migrate_legacy_index(self) -> bool:
+        """
+        Converts an index written before labels existed (a bare IndexFlatL2 with one email per row, duplicates for
+        every re-registration) into the labelled layout, keeping the last registration of each student
+        Returns:
+            migrated: True when the index was converted and needs a checkpoint
+        """
+        if not isinstance(self.index, faiss.IndexFlatL2):
+            return False
+        vectors = self.index.reconstruct_n(0, self.index.ntotal) if self.index.ntotal else np.empty((0, dimension), dtype=np.float32)
+        last_row = {str(email): row for row, email in enumerate(self.ids)}
+        self.ids = list(last_row)
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+        if self.ids:
+            self.index.add_with_ids(vectors[list(last_row.values())], np.arange(len(self.ids), dtype=np.int64))
+        print(f"Migrated FAISS index from {len(vectors)} rows to {len(self.ids)} labelled students")
+        return True
+
+    @property
+    def labels(self) -> dict:
+        """ email -> label, built on first use so processes that only search never pay for it """
+        if self._labels is None:
+            if self.ids is self.snapshot.ids:
+                self._labels = self.snapshot.labels
+            else:
+                self._labels = {str(email): label for label, email in enumerate(self.ids) if email}
+        return self._labels
+
+    def _publish(self):
+        hidden = sum(int(self._base_counts[label]) for label in self._changes if label < len(self._base_counts))
+        self.snapshot = GallerySnapshot(self.index, self.ids, self.embeddings, self.seq, self._changes, hidden,
+                                        self._labels, self._removed_rows, self._removed)
 
-    def update_index(self, encodings: List[np.ndarray], ids: List[int]):
+    def _copy_on_write(self, students: bool = False):
         """
-        Update the FAISS faiss_index with the provided encodings and IDs.
+        Gives the current batch its own copy of the published changes before the first change, and of the IDs before
+        the first student is added or removed. Both only grow with the registrations since the last fold and the
+        number of students, the index is never copied.
+        """
+        if self._changes is self.snapshot.changes:
+            self._changes = dict(self._changes)
+        if students and self.ids is self.snapshot.ids:
+            self._labels = dict(self.labels)
+            self.ids = [str(email) for email in self.ids]
+
+    def _wanted_type(self, count: int) -> str:
+        """ The configured index type, IVF types stay flat until count vectors are enough to train them """
+        if self.index_type in ("ivf_flat", "ivf_pq") and count < ivf_min_train_size:
+            return "flat"
+        return self.index_type
+
+    def current_checkpoint(self) -> Path:
+        """
+        Directory of the checkpoint named in CURRENT, None before the first checkpoint. Raises FileNotFoundError
+        when CURRENT names a checkpoint whose files are missing instead of letting the gallery start empty.
+        """
+        current = self.directory / current_checkpoint_file_name
+        if not current.exists():
+            return None
+        checkpoint = self.directory / current.read_text().strip()
+        missing = [name for name in (default_faiss_idx.name, default_faiss_ids.name) if not (checkpoint / name).exists()]
+        if missing:
+            raise FileNotFoundError(f"{current} names {checkpoint}, which is missing {', '.join(missing)}")
+        return checkpoint
+
+    def _checkpoint_name(self, seq: int) -> str:
+        """
+        Name of a new checkpoint directory, its seq followed by a generation one past every existing checkpoint, so
+        a forced checkpoint at an unchanged seq never reuses the directory CURRENT names
+        """
+        generations = [int(path.name.split("-")[2]) for path in self.directory.glob("checkpoint-*")
+                       if path.suffix != ".tmp" and path.name.count("-") == 2]
+        return f"checkpoint-{seq:020d}-{max(generations, default=0) + 1:06d}"
+
+    def checkpoint(self, force: bool = False) -> bool:
+        """
+        Folds the current snapshot into a new base index, writes the index, IDs and embeddings together into a new
+        checkpoint directory, points CURRENT at it with an atomic rename and drops the journal records it contains.
+        Neither searches nor registrations wait for it.
+        Arguments:
+            force: write even when nothing changed since the last checkpoint
+        Returns:
+            written: False when there was nothing to write
+        """
+        with self._checkpoint_lock:
+            snapshot = self.snapshot
+            if snapshot.seq == self.checkpoint_seq and not force:
+                return False
+            snapshot = self._fold(snapshot)
+            seq = snapshot.seq
+            index_bytes = faiss.serialize_index(snapshot.index)
+            ids = np.array(snapshot.ids)
+
+            name = self._checkpoint_name(seq)
+            tmp = self.directory / f"{name}.tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            tmp.mkdir(parents=True)
+            index_bytes.tofile(str(tmp / default_faiss_idx.name))
+            np.save(str(tmp / default_faiss_ids.name), ids)
+            snapshot.embeddings.save(tmp)
+            if len(snapshot.removed_rows):
+                np.save(str(tmp / removed_rows_file_name), snapshot.removed_rows)
+            for path in tmp.iterdir():
+                with open(path, "rb") as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.directory / name)
+
+            current_tmp = self.directory / f"{current_checkpoint_file_name}.tmp"
+            with open(current_tmp, "w") as f:
+                f.write(name)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(current_tmp, self.directory / current_checkpoint_file_name)
+
+            with self._lock:
+                self.checkpoint_seq = seq
+                self.journal.compact(seq)
+            # Keep the previous checkpoint, a process may be between reading CURRENT and mapping its files
+            checkpoints = sorted(path for path in self.directory.glob("checkpoint-*") if path.suffix != ".tmp")
+            for old in checkpoints[:-2]:
+                if old.name != name:
+                    shutil.rmtree(old, ignore_errors=True)
+            return True
+
+    def start_checkpointing(self, interval: float = 300.0, max_records: int = 1000):
+        """
+        Checkpoints in a background thread every interval seconds, or sooner once max_records registrations are
+        journaled, and once more on stop_checkpointing
+        """
+        self.max_journal_records = max_records
+
+        def run():
+            while not self._stopping:
+                self._checkpoint_due.wait(interval)
+                self._checkpoint_due.clear()
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    print(f"FAISS checkpoint failed: {e}")
+
+        self._checkpointer = threading.Thread(target=run, name="faiss-checkpoint", daemon=True)
+        self._checkpointer.start()
+
+    def stop_checkpointing(self):
+        if self._checkpointer is not None:
+            self._stopping = True
+            self._checkpoint_due.set()
+            self._checkpointer.join()
+            self._checkpointer = None
+
+    def _journaled(self, op: int, person_id: str, encodings: np.ndarray = None):
+        self.seq += 1
+        self.journal.append(self.seq, op, person_id, encodings, sync=False)
+        if self._checkpointer is not None and self.seq - self.checkpoint_seq >= self.max_journal_records:
+            self._checkpoint_due.set()
+
+    def _replace(self, person_id: str, encodings: np.ndarray):
+        label = self.labels.get(person_id)
+        self._copy_on_write(students=label is None)
+        if label is None:
+            label = self.labels[person_id] = len(self.ids)
+            self.ids.append(person_id)
+        self._changes[label] = encodings
+
+    def _remove(self, person_id: str) -> bool:
+        if person_id not in self.labels:
+            return False
+        self._copy_on_write(students=True)
+        label = self.labels.pop(person_id)
+        self._changes[label] = None
+        self.ids[label] = ""  # Labels are never reused, the slot stays as a tombstone
+        return True
+
+    def _fold(self, snapshot: GallerySnapshot, rebuild: bool = False) -> GallerySnapshot:
+        """
+        Builds a base index holding everything in a snapshot and makes it the base of the gallery, changes made
+        after the snapshot stay in the delta. Only the swap at the end takes the writer lock, callers hold
+        _checkpoint_lock.
+        Arguments:
+            snapshot: state to fold
+            rebuild: build the base from the embedding store even when the changes could be added to the old one
+        Returns:
+            folded: snapshot of the new base with an empty delta, at the seq of snapshot
+        """
+        embeddings = snapshot.embeddings.replaced(snapshot.changes)
+        wanted, current = self._wanted_type(len(embeddings)), index_type_of(snapshot.index)
+        if not snapshot.changes and not rebuild and current == wanted:
+            return snapshot
+        if current != wanted:
+            print(f"Re-indexing {len(embeddings)} face vectors from {current} to {wanted}")
+        changed = np.fromiter(snapshot.changes, dtype=np.int64, count=len(snapshot.changes))
+        added = stacked(snapshot.changes)
+        removed_rows = np.empty(0, dtype=np.int64)
+        if wanted == "hnsw" and current == wanted and not rebuild:
+            # The old rows of changed labels stay in the graph and are left out of searches until there are too many
+            row_labels = faiss.vector_to_array(snapshot.index.id_map)
+            removed_rows = np.union1d(snapshot.removed_rows, np.flatnonzero(np.isin(row_labels, changed)))
+            if len(removed_rows) > hnsw_max_removed_fraction * (len(row_labels) + len(added[1])):
+                print(f"Rebuilding the HNSW graph, {len(removed_rows)} of its rows belong to removed registrations")
+                rebuild = True
+        # IVF indexes keep their training, flat costs the same to build as to copy
+        if rebuild or current != wanted or wanted == "flat":
+            index = create_index(wanted, *embeddings.all())
+            removed_rows = np.empty(0, dtype=np.int64)
+        else:
+            index = copy_index(snapshot.index)
+            if isinstance(index, faiss.IndexIVF):
+                index.remove_ids(changed)
+            index.add_with_ids(*added)
+        configure_search(index, self.nprobe, self.ef_search)
+        base_counts = np.bincount(embeddings.labels)
+        removed = faiss.IDSelectorBatch(removed_rows) if len(removed_rows) else None
+
+        with self._lock:
+            self.index, self.embeddings, self._base_counts = index, embeddings, base_counts
+            self._removed_rows, self._removed = removed_rows, removed
+            # Changes are replaced, never mutated, so an unchanged entry is the very same object as in the snapshot
+            self._changes = {label: rows for label, rows in self._changes.items()
+                             if label not in snapshot.changes or snapshot.changes[label] is not rows}
+            self._publish()
+        return GallerySnapshot(index, snapshot.ids, embeddings, snapshot.seq, removed_rows=removed_rows, removed=removed)
+
+    def rebuild(self, index_type: str = None) -> float:
+        """
+        Builds a new index from the embedding store in one bulk pass and checkpoints it, e.g. to switch index type or
+        to replace an index that was lost or damaged
+        Arguments:
+            index_type: one of index_types, defaults to the configured type, which it then becomes
+        Returns:
+            seconds: time spent building the index
+        """
+        if index_type is not None:
+            if index_type not in index_types:
+                raise ValueError(f"Unknown FAISS index type '{index_type}', expected one of {index_types}")
+            self.index_type = index_type
+        with self._checkpoint_lock:
+            start = time.perf_counter()
+            self._fold(self.snapshot, rebuild=True)
+            seconds = time.perf_counter() - start
+        print(f"Rebuilt {index_type_of(self.index)} index of {len(self.embeddings)} face vectors in {seconds:.2f}s")
+        self.checkpoint(force=True)
+        return seconds
+
+    def _apply(self, changes) -> list:
+        """
+        Queues changes and waits until they are part of the published snapshot. The caller that gets the lock
+        applies everything queued so far as one batch: one delta index, one journal fsync and one snapshot swap,
+        however many registrations arrived at once.
+        Arguments:
+            changes: list of (op, person_id, encodings)
+        Returns:
+            results: one result per change, the return value of _replace / _remove
+        """
+        pending = PendingChanges(changes)
+        with self._queue_lock:
+            self._queue.append(pending)
+        with self._lock:
+            if not pending.done:
+                with self._queue_lock:
+                    batch, self._queue = self._queue, []
+                self._apply_batch(batch)
+        if self.snapshot.delta.ntotal >= max_delta_vectors:
+            if self._checkpointer is not None:
+                self._checkpoint_due.set()
+            else:
+                with self._checkpoint_lock:
+                    if self.snapshot.delta.ntotal >= max_delta_vectors:
+                        self._fold(self.snapshot)
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    def _apply_batch(self, batch):
+        try:
+            for waiting in batch:
+                try:
+                    waiting.results = []
+                    for op, person_id, encodings in waiting.changes:
+                        if op == op_replace:
+                            self._replace(person_id, encodings)
+                            waiting.results.append(None)
+                            self._journaled(op, person_id, encodings)
+                        elif self._remove(person_id):
+                            waiting.results.append(True)
+                            self._journaled(op, person_id)
+                        else:
+                            waiting.results.append(False)
+                except Exception as e:
+                    waiting.error = e
+            self.journal.sync()
+            self._publish()
+            self.batches += 1
+            self.batched_changes += sum(len(waiting.changes) for waiting in batch)
+        finally:
+            for waiting in batch:
+                waiting.done = True
+
+    def replace(self, person_id: str, encodings: np.ndarray):
+        """
+        Stores the face vectors of a person, dropping whatever was registered for them before
+        Arguments:
+            person_id: email of the person
+            encodings: np.ndarray (N, 512) or (512,)
+        """
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, dimension)
+        self._apply([(op_replace, person_id, encodings)])
+
+    def remove(self, person_id: str) -> bool:
+        """
+        Removes every face vector of a person
+        Arguments:
+            person_id: email of the person
+        Returns:
+            removed: False when the person was not registered
+        """
+        return self._apply([(op_remove, person_id, None)])[0]
+
+    def update_index(self, encodings: List[np.ndarray], ids: List[str]):
+        """
+        Update the FAISS faiss_index with the provided encodings and IDs, replacing earlier registrations of the IDs.
         args:
             encodings: list of face encodings
             ids: list of corresponding IDs
         """
-        
-        # Convert to the correct format and add to the faiss_index
-        encodings = encodings[0]
-        encodings = np.array(encodings).astype('float32')
-        self.index.add(encodings)
+        self._apply([
+            (op_replace, person_id, np.ascontiguousarray(encoding, dtype=np.float32).reshape(-1, dimension))
+            for person_id, encoding in zip(ids, encodings)
+        ])
+
+    def search(self, embeddings: np.ndarray, number_of_results: int = 1, distance_threshold: float = 0.6) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Searches the gallery for every row of an embedding matrix with one search of the base index and one of the delta
+        Arguments:
+            embeddings: np.ndarray (N, 512) or (512,)
+            number_of_results: nearest faces returned per embedding
+            distance_threshold: faces having lesser or equal distance are accepted as a match
+        Returns:
+            labels: np.ndarray (N, k) int64 labels, self.ids[label] is the email, -1 where the index has fewer than k faces
+            distances: np.ndarray (N, k) float32
+            accepted: np.ndarray (N, k) bool, True where the match is within the threshold
+        """
+        return search_index(self.snapshot, embeddings, number_of_results, distance_threshold)
+
+    def vectors_for(self, labels, snapshot: GallerySnapshot = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the face vectors of some labels from the embedding store
+        Arguments:
+            labels: iterable of int labels
+            snapshot: snapshot to read from, defaults to the current one
+        Returns:
+            vectors: np.ndarray (M, 512) float32, every vector of every label
+            vector_labels: np.ndarray (M,) int64 label of each vector
+        """
+        return (snapshot or self.snapshot).vectors_for(labels)
 
-        # Append new IDs to existing IDs list
-        self.ids.extend(ids)
+    def restrict(self, person_ids) -> "RosterGallery":
+        """ Returns a gallery that only matches the given people, e.g. the students enrolled in a subject """
+        return RosterGallery(self, person_ids)
+
+    def ids_for(self, labels: np.ndarray) -> List[str]:
+        """ Maps a row of labels returned by search to emails, "" for -1 """
+        # Labels are never reused, so a newer snapshot than the one searched maps them the same way
+        ids = self.snapshot.ids
+        return [str(ids[label]) if label >= 0 else "" for label in np.asarray(labels).tolist()]
 
-        # Save the updated faiss_index and IDs
-        faiss.write_index(self.index, str(default_faiss_idx))
-        np.save(str(default_faiss_ids), np.array(self.ids))
-    
     def get_person_id(self, embedding: np.ndarray, number_of_results: int = 1, distance_threshold: float = 0.6) -> List[Person]:
         """
         Get the ID of the person with the given embedding in the FAISS index.
@@ -74,23 +823,69 @@ class FAISS:
         """
         if embedding is None:
             return []
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1, dimension)
+        snapshot = self.snapshot
+        labels, distances, accepted = search_index(snapshot, embedding, number_of_results, distance_threshold)
         person_recognized = []
-        print("Embedding shape", embedding[0].shape)
-        print(f"len embedding {len(embedding)} dimensions {embedding.ndim}")
-        if embedding.ndim == 1:
-            embedding = np.expand_dims(embedding, axis=0)
-            print(f"New :: len embedding {len(embedding)} dimensions {embedding.ndim}")
-        # face_encoding = np.expand_dims(embedding, axis=0)
-        distances, indices = self.index.search(embedding, number_of_results)
-        for distance, index in zip(distances, indices):
-            print(f"Distance: {distance[0]}")
-            if distance[0] > distance_threshold:
-                continue
-            person_id = self.ids[index[0]]
-            person_recognized.append(Person(person_id, embedding, distance[0]))
-            print(f"Person Recognized: {len(person_recognized)} {person_id}")
+        for row in np.flatnonzero(accepted[:, 0]):
+            person_recognized.append(Person(str(snapshot.ids[labels[row, 0]]), embedding[row], distances[row, 0]))
         return person_recognized
 
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        return {
+            "index_type": index_type_of(snapshot.index),
+            "vectors": snapshot.ntotal,
+            "delta_vectors": snapshot.delta.ntotal,
+            "seq": snapshot.seq,
+            "checkpoint_seq": self.checkpoint_seq,
+            "batches": self.batches,
+            "avg_batch_size": self.batched_changes / self.batches if self.batches else 0.0,
+        }
+
+
+class RosterGallery:
+    """
+    Exact flat sub-index over the faces of a fixed set of people, shares the label table of the full gallery.
+    A class roster is a few dozen students, so searching it is cheaper than any campus-wide index and cannot match
+    a student of another course. It is rebuilt on the next search after the full gallery publishes a new snapshot,
+    so faces registered or removed, or a reload from disk, during a session are picked up.
+    """
+
+    def __init__(self, gallery: FAISS, person_ids):
+        """
+        Arguments:
+            gallery: the full FAISS gallery
+            person_ids: emails of the people to match
+        """
+        self.gallery = gallery
+        self.person_ids = set(person_ids)
+        self._build_lock = threading.Lock()
+        self.build()
+
+    def build(self):
+        # Everything comes from one published snapshot, so a batch of registrations being applied never blocks this
+        snapshot = self.gallery.snapshot
+        labels = [snapshot.labels[p] for p in self.person_ids if p in snapshot.labels]
+        vectors, vector_labels = self.gallery.vectors_for(labels, snapshot)
+        self.index = create_index("flat", vectors, vector_labels)
+        self.registered = len(labels)
+        # The seq of the main gallery this roster reflects, and the snapshot itself: a reload can publish a
+        # different gallery at the same seq, e.g. after a rebuild or a repaired journal
+        self.seq = snapshot.seq
+        self.snapshot = snapshot
+
+    def search(self, embeddings: np.ndarray, number_of_results: int = 1, distance_threshold: float = 0.6) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Same as FAISS.search, restricted to the roster """
+        snapshot = self.gallery.snapshot
+        if snapshot is not self.snapshot or snapshot.seq != self.seq:
+            with self._build_lock:
+                if self.gallery.snapshot is not self.snapshot:
+                    self.build()
+        return search_index(self.index, embeddings, number_of_results, distance_threshold)
+
+    def ids_for(self, labels: np.ndarray) -> List[str]:
+        return self.gallery.ids_for(labels)
 
 
 # Example usage:
@@ -1,18 +1,327 @@
 # firebase_utils_2.py
 import firebase_admin
 from firebase_admin import credentials, db, storage
-from typing import List, Union, Optional, Dict
+from typing import Callable, List, Union, Optional, Dict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import atexit
+import copy
 import hashlib
+import threading
+import time
 from modules.collections_format import User, Subject, AttendanceSession, AttendanceRecord
 import logging
+
+
+class ReadThroughCache:
+    """
+    Bounded LRU cache of Firebase query results. Entries expire after ttl seconds so changes made outside this
+    process show up eventually, changes made through FirebaseDatabase invalidate their entries right away.
+    Callers get their own copy of a cached value and may modify it.
+    """
+
+    def __init__(self, max_entries: int = 5000, ttl: float = 300.0):
+        """
+        Arguments:
+            max_entries: least recently used entries are dropped beyond this
+            ttl: seconds an entry is served before it is read again
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._generation = 0  # Bumped by every invalidation, a read that raced one is not cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, load: Callable):
+        """
+        Returns the cached value of a key, calling load() to read it on a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            self.misses += 1
+            generation = self._generation
+        value = load()
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value, now)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value, time.monotonic())
+
+    def _store(self, key, value, now):
+        self._entries[key] = (now + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "firebase_reads_saved": self.hits,
+            }
+
+
+class WriteBehindBuffer:
+    """
+    Collects writes and sends them as one multi-location update every max_records writes or max_delay_ms after
+    the oldest pending write, from a background thread. Writes to the same path coalesce, the last one wins.
+    Writes added with keep_existing only create their path, each goes out in a transaction that leaves a value
+    already stored there alone. A failed update keeps its writes for the next flush.
+    """
+
+    def __init__(self, max_records: int = 50, max_delay_ms: float = 500.0):
+        """
+        Arguments:
+            max_records: pending writes that trigger a flush right away
+            max_delay_ms: longest a write waits to be flushed
+        """
+        self.max_records = max_records
+        self.max_delay = max_delay_ms / 1000
+        self._pending = OrderedDict()  # path -> value
+        self._first_writes = OrderedDict()  # path -> value, written only where nothing is stored yet
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()  # One update in flight at a time, keeps the writes in order
+        self._stopping = False
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.records_flushed = 0
+        self.total_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="firebase-write-behind", daemon=True)
+        self._thread.start()
+
+    def add(self, path: str, value, keep_existing: bool = False):
+        """
+        Arguments:
+            path: database path to write
+            value: value to write
+            keep_existing: only write when nothing is stored at path yet, the first value added wins
+        """
+        with self._condition:
+            first = not self._queued()
+            if first:
+                self._oldest = time.monotonic()
+            if keep_existing:
+                self._first_writes.setdefault(path, value)
+            else:
+                self._pending[path] = value
+                self._pending.move_to_end(path)
+            if first or self._queued() >= self.max_records:
+                # The first write starts the flush timer, a full buffer ends it
+                self._condition.notify()
+
+    def _queued(self) -> int:
+        return len(self._pending) + len(self._first_writes)
+
+    def _requeue(self, batch: OrderedDict, first_writes: OrderedDict):
+        """ Puts the writes of a failed flush back in front of the ones added since """
+        with self._condition:
+            # Writes made while this one was in flight are newer, they win, except over a first write
+            batch.update(self._pending)
+            self._pending = batch
+            first_writes.update((path, value) for path, value in self._first_writes.items() if path not in first_writes)
+            self._first_writes = first_writes
+            self._oldest = time.monotonic()
+            self.failed_flushes += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and (not self._queued() or (
+                        self._queued() < self.max_records and time.monotonic() - self._oldest < self.max_delay)):
+                    timeout = self.max_delay - (time.monotonic() - self._oldest) if self._queued() else None
+                    self._condition.wait(timeout)
+                if self._stopping:
+                    return
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Sends every pending write now
+        Returns:
+            records: number of writes sent
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, OrderedDict()
+                first_writes, self._first_writes = self._first_writes, OrderedDict()
+            if not batch and not first_writes:
+                return 0
+            start = time.perf_counter()
+            try:
+                if batch:
+                    db.reference().update(dict(batch))
+            except Exception as e:
+                print(f"Flushing {len(batch)} writes to Firebase failed, retrying with the next flush: {e}")
+                self._requeue(batch, first_writes)
+                return 0
+            failed = OrderedDict()
+            for path, value in first_writes.items():
+                try:
+                    db.reference(path).transaction(lambda current, value=value: value if current is None else current)
+                except Exception as e:
+                    print(f"Writing {path} to Firebase failed, retrying with the next flush: {e}")
+                    failed[path] = value
+            if failed:
+                self._requeue(OrderedDict(), failed)
+            seconds = time.perf_counter() - start
+            with self._condition:
+                self.flushes += 1
+                self.records_flushed += len(batch) + len(first_writes) - len(failed)
+                self.total_flush_seconds += seconds
+                self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+                self.last_flush_seconds = seconds
+            return len(batch)
+
+    def stop(self):
+        """ Flushes what is pending and stops the background thread """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "queue_depth": self._queued(),
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "records_flushed": self.records_flushed,
+                "avg_records_per_flush": self.records_flushed / self.flushes if self.flushes else 0.0,
+                "avg_flush_ms": 1000 * self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+                "max_flush_ms": 1000 * self.max_flush_seconds,
+                "last_flush_ms": 1000 * self.last_flush_seconds,
+            }
+
+
+class SessionRoster:
+    """
+    The students of a running attendance session, loaded in bulk when it starts so that marking a recognized
+    student needs no reads
+    """
+
+    def __init__(self, session_id: str, subject_name: str, teacher_id: str, students: Dict[str, tuple]):
+        """
+        Arguments:
+            session_id: key of the attendance session
+            subject_name: subject the session is held for
+            teacher_id: teacher running the session
+            students: email -> (user_id, name) of every enrolled student
+        """
+        self.session_id = session_id
+        self.subject_name = subject_name
+        self.teacher_id = teacher_id
+        self.students = students
+
+    def emails(self) -> List[str]:
+        return list(self.students)
+
+
 class FirebaseDatabase:
-    def __init__(self):
+    def __init__(self, cache_ttl: float = 300.0, cache_size: int = 5000, flush_records: int = 50,
+                 flush_ms: float = 500.0):
+        """
+        Arguments:
+            cache_ttl: seconds user and subject lookups are cached, 0 turns the caches off
+            cache_size: entries kept per cache
+            flush_records: attendance records that are written together, see WriteBehindBuffer
+            flush_ms: longest an attendance record waits before it is written
+        """
         self.cred = credentials.Certificate("Data/service_account.json")
         firebase_admin.initialize_app(self.cred, {
             'databaseURL': "https://face-attendance-system-b763a-default-rtdb.firebaseio.com",
             'storageBucket': "gs://face-attendance-system-c3383.appspot.com"
         })
+        # Users by email ({user_id: user} query results), users by ID and subjects by name ({subject_id: subject})
+        self.users_by_email = ReadThroughCache(cache_size, cache_ttl)
+        self.users_by_id = ReadThroughCache(cache_size, cache_ttl)
+        self.subjects_by_name = ReadThroughCache(cache_size, cache_ttl)
+        # Session IDs by subject name, a subject only gains sessions through start_attendance_session
+        self.sessions_by_subject = ReadThroughCache(cache_size, cache_ttl)
+        # Independent reads of one request are issued together
+        self._read_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="firebase-read")
+        # teacher_id -> SessionRoster of the teacher's running attendance session
+        self.session_rosters = {}
+        self.attendance_writes = WriteBehindBuffer(flush_records, flush_ms)
+        # session_id -> IDs of the students recorded in it by this process
+        self.recorded_students = {}
+        self._recorded_lock = threading.Lock()
+        atexit.register(self.attendance_writes.stop)
+
+    def find_users_by_email(self, email: str) -> dict:
+        """
+        Returns:
+            users: {user_id: user} of the users with this email, empty when there is none
+        """
+        def load():
+            users = db.reference("users").order_by_child("email").equal_to(email).get() or {}
+            for user_id, user in users.items():
+                self.users_by_id.put(user_id, user)
+            return users
+        return self.users_by_email.get(email, load)
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        """ Returns the user stored under an ID, None when there is none """
+        return self.users_by_id.get(user_id, lambda: db.reference(f"users/{user_id}").get())
+
+    def find_subjects_by_name(self, subject_name: str) -> dict:
+        """
+        Returns:
+            subjects: {subject_id: subject} of the subjects with this name, empty when there is none
+        """
+        return self.subjects_by_name.get(
+            subject_name, lambda: db.reference("subjects").order_by_child("name").equal_to(subject_name).get() or {})
+
+    def find_session_ids_for_subject(self, subject_name: str) -> List[str]:
+        """ Returns the keys of every attendance session held for a subject """
+        return self.sessions_by_subject.get(subject_name, lambda: list(
+            (db.reference("attendance_sessions").order_by_child('subjectId').equal_to(subject_name).get() or {}).keys()))
+
+    def invalidate_user(self, email: str, user_ids=()):
+        self.users_by_email.invalidate(email)
+        self.users_by_id.invalidate(*user_ids)
+
+    def cache_stats(self) -> dict:
+        caches = {"users_by_email": self.users_by_email, "users_by_id": self.users_by_id,
+                  "subjects_by_name": self.subjects_by_name, "sessions_by_subject": self.sessions_by_subject}
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        hits = sum(cache["hits"] for cache in stats.values())
+        lookups = hits + sum(cache["misses"] for cache in stats.values())
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        stats["firebase_reads_saved"] = hits
+        return stats
 
     def hash_password(self, password: str) -> str:
         return hashlib.sha256(password.encode()).hexdigest()
@@ -26,9 +335,10 @@ class FirebaseDatabase:
         )
         user_ref = db.reference("users").push()
         user_ref.set(user.to_dict())
+        self.invalidate_user(email, [user_ref.key])
 
     def login(self, email: str, password: str) -> Optional[dict]:
-        users_ref = db.reference("users").order_by_child("email").equal_to(email).get()
+        users_ref = self.find_users_by_email(email)
         for user_id, user in users_ref.items():
             if user['password'] == self.hash_password(password):
                 user['id'] = user_id
@@ -40,9 +350,10 @@ class FirebaseDatabase:
         subject = Subject(name=name, teacherId=teacher_id, teacherMail=email)
         subject_ref = db.reference("subjects").push()
         subject_ref.set(subject.to_dict())
+        self.subjects_by_name.invalidate(name)
 
         # Update the teacher's subjects in the users database
-        teacher_ref = db.reference(f"users").order_by_child("email").equal_to(email).get()
+        teacher_ref = self.find_users_by_email(email)
         print(f"Retrieved teacher ref: {teacher_ref}")
         if teacher_ref:
             for user_id, user in teacher_ref.items():   
@@ -51,6 +362,7 @@ class FirebaseDatabase:
                 if name not in current_subjects:
                     current_subjects.append(name)
                     db.reference(f"users/{user_id}").update({'subjects': current_subjects})
+                    self.invalidate_user(email, [user_id])
                     print(f"Updated subjects for {user_id}: {current_subjects}")
                     break  # No need to keep looping since we found the teacher
         else:
@@ -74,10 +386,14 @@ class FirebaseDatabase:
                         print(f"Removed {subject_name} from {teacher_mail}'s subjects.")
             else:
                 print(f"No teacher found with email {teacher_mail}")
+        # Any user may have lost the subject
+        self.subjects_by_name.invalidate(subject_name)
+        self.users_by_email.clear()
+        self.users_by_id.clear()
 
 
     def remove_subject_from_student(self, student_email: str, subject_name: str):
-        users_ref = db.reference("users").order_by_child("email").equal_to(student_email).get()
+        users_ref = self.find_users_by_email(student_email)
 
         if not users_ref:
             raise ValueError("Student not found")
@@ -86,11 +402,12 @@ class FirebaseDatabase:
             if 'subjects' in user_data and subject_name in user_data['subjects']:
                 updated_subjects = [subject for subject in user_data['subjects'] if subject != subject_name]
                 db.reference(f"users/{user_id}").update({'subjects': updated_subjects})
+                self.invalidate_user(student_email, [user_id])
                 print(f"Subject '{subject_name}' removed from student '{student_email}'")
             else:
                 print(f"Subject '{subject_name}' not found for student '{student_email}'")
 
-        subjects_ref = db.reference("subjects").order_by_child("name").equal_to(subject_name).get()
+        subjects_ref = self.find_subjects_by_name(subject_name)
 
         if not subjects_ref:
             raise ValueError("Subject not found")
@@ -99,6 +416,7 @@ class FirebaseDatabase:
             if 'students' in subject_data and student_email in subject_data['students']:
                 updated_students = [student for student in subject_data['students'] if student != student_email]
                 db.reference(f"subjects/{subject_id}").update({'students': updated_students})
+                self.subjects_by_name.invalidate(subject_name)
                 print(f"Student '{student_email}' removed from subject '{subject_name}'")
             else:
                 print(f"Student '{student_email}' not found in subject '{subject_name}'")
@@ -124,7 +442,7 @@ class FirebaseDatabase:
         return subjects_list
 
     def get_subjects_for_student(self, student_id:str):
-        student_ref = db.reference("users").order_by_child("email").equal_to(student_id).get()
+        student_ref = self.find_users_by_email(student_id)
         subjects_enrolled = []
         for _, student_data in student_ref.items():
             subjects_enrolled = student_data.get('subjects', [])
@@ -132,6 +450,16 @@ class FirebaseDatabase:
         "subjectsEnrolled": subjects_enrolled
     }
 
+    def get_subject_students(self, subject_name: str) -> List[str]:
+        """
+        Returns the emails of the students enrolled in a subject
+        """
+        subjects_ref = self.find_subjects_by_name(subject_name)
+        students = []
+        for _, subject_data in subjects_ref.items():
+            students.extend(email for email in subject_data.get('students', []) if email not in students)
+        return students
+
     def get_teachers(self) -> List[dict]:
         users_ref = db.reference("users").order_by_child("role").equal_to("teacher").get()
         return self.parse_realtime_db_docs(users_ref)
@@ -163,13 +491,16 @@ class FirebaseDatabase:
         for user_id in users_ref.keys():
             db.reference(f"users/{user_id}").delete()  # Remove the teacher from the database
             print(f"Teacher with email '{teacher_email}' and their subjects have been removed from the database.")
+        self.users_by_email.clear()
+        self.users_by_id.clear()
+        self.subjects_by_name.clear()
 
     def get_students(self) -> List[dict]:
         users_ref = db.reference("users").order_by_child("role").equal_to("student").get()
         return self.parse_realtime_db_docs(users_ref)
 
     def remove_student(self, student_email: str):
-        users_ref = db.reference("users").order_by_child("email").equal_to(student_email).get()
+        users_ref = self.find_users_by_email(student_email)
 
         if not users_ref:
             raise ValueError("Student not found")
@@ -177,6 +508,7 @@ class FirebaseDatabase:
         for user_id in users_ref.keys():
             db.reference(f"users/{user_id}").delete()  # Remove the student from the database
             print(f"Student with email '{student_email}' has been removed from the database.")
+        self.invalidate_user(student_email, list(users_ref))
 
         subjects_ref = db.reference("subjects").get()
 
@@ -184,10 +516,11 @@ class FirebaseDatabase:
             if 'students' in subject_data and student_email in subject_data['students']:
                 updated_students = [student for student in subject_data['students'] if student != student_email]
                 db.reference(f"subjects/{subject_id}").update({'students': updated_students})
+                self.subjects_by_name.invalidate(subject_data['name'])
                 print(f"Student '{student_email}' removed from subject '{subject_data['name']}'")
 
     def enroll_student_in_subject(self, student_email: str, subject_name: str):
-        student_ref = db.reference(f"users").order_by_child("email").equal_to(student_email).get()
+        student_ref = self.find_users_by_email(student_email)
         print(f"Retrieved student ref: {student_ref}")
         if student_ref:
             for user_id, user in student_ref.items():   
@@ -196,13 +529,14 @@ class FirebaseDatabase:
                 if subject_name not in current_subjects:
                     current_subjects.append(subject_name)
                     db.reference(f"users/{user_id}").update({'subjects': current_subjects})
+                    self.invalidate_user(student_email, [user_id])
                     print(f"Updated subjects for {user_id}: {current_subjects}")
                     break  # No need to keep looping since we found the teacher
         else:
             print(f"No teacher found with email {student_email}")
 
         # Fetch subject reference
-        subjects_ref = db.reference("subjects").order_by_child("name").equal_to(subject_name).get()
+        subjects_ref = self.find_subjects_by_name(subject_name)
         if not subjects_ref:
             print(f"Subject {subject_name} does not exist.")
             return False  # Subject not found
@@ -214,6 +548,7 @@ class FirebaseDatabase:
             if student_email not in existing_students:
                 existing_students.append(student_email)
                 db.reference(f"subjects/{key}").update({'students': existing_students})
+                self.subjects_by_name.invalidate(subject_name)
 
         return True  # Enrollment successful
 
@@ -223,15 +558,71 @@ class FirebaseDatabase:
         session = AttendanceSession(subjectId=subject_id, teacherId=teacher_id, teacherMail=email)
         session_ref = db.reference("attendance_sessions").push()
         session_ref.set(session.to_dict())
+        self.sessions_by_subject.invalidate(subject_id)
+        self.preload_roster(session_ref.key, subject_id, teacher_id)
         return session_ref.key
 
-    def mark_attendance(self, session_id: str, student_id: str):
-        session_ref = db.reference(f"attendance_sessions/{session_id}")
-        session = session_ref.get()
-        if session and session.get('active'):
-            record = AttendanceRecord(sessionId=session_id, studentId=student_id)
-            record_ref = db.reference("attendance_records").push()
-            record_ref.set(record.to_dict())
+    def preload_roster(self, session_id: str, subject_name: str, teacher_id: str) -> SessionRoster:
+        """
+        Loads the enrolled students of a session, the subject is read from Firebase and one email lookup per student
+        runs concurrently on the read pool (cached users are not read again), and makes it the teacher's active session for
+        mark_attendance_by_email
+        Arguments:
+            session_id: key of the attendance session
+            subject_name: name of the subject
+            teacher_id: teacher running the session
+        Returns:
+            roster: the SessionRoster of the session
+        """
+        # Read the enrollment fresh, a student enrolled by another process within the cache TTL would be missing
+        # from the roster for the whole session
+        self.subjects_by_name.invalidate(subject_name)
+        emails = sorted(set(self.get_subject_students(subject_name)))
+        students = {}
+        for email, users in zip(emails, self._read_pool.map(self.find_users_by_email, emails)):
+            for user_id, user in users.items():
+                if user.get('role') == 'student':
+                    students[email] = (user_id, user.get('name', ''))
+                    break
+        roster = SessionRoster(session_id, subject_name, teacher_id, students)
+        self.session_rosters[teacher_id] = roster
+        print(f"Preloaded {len(students)} of {len(emails)} students enrolled in {subject_name} for session {session_id}")
+        return roster
+
+    def get_session_roster(self, teacher_id: str) -> Optional[SessionRoster]:
+        return self.session_rosters.get(teacher_id)
+
+    def mark_attendance(self, session_id: str, student_id: str) -> bool:
+        """
+        Marks a student present in a session, the session is only read when it was not started by this process
+        Returns:
+            marked: True when the student was marked now, False when already marked or the session is not active
+        """
+        if not any(roster.session_id == session_id for roster in list(self.session_rosters.values())):
+            session = db.reference(f"attendance_sessions/{session_id}").get()
+            if not session or not session.get('active'):
+                return False
+        return self.record_attendance(session_id, student_id)
+
+    def record_attendance(self, session_id: str, student_id: str) -> bool:
+        """
+        Records a student as present in a session known to be active, without reading anything first. A student has
+        one record per session at attendance_records/{session_id}/{student_id}, mirrored at
+        student_attendance/{student_id}/{session_id} for the per-student summary. The record is only created when
+        none is stored yet, so a restarted or second server marking the student again keeps the first markedAt.
+        Both paths go out with the next flush of self.attendance_writes.
+        Returns:
+            recorded: False when the student was already recorded in the session by this process
+        """
+        with self._recorded_lock:
+            recorded = self.recorded_students.setdefault(session_id, set())
+            if student_id in recorded:
+                return False
+            recorded.add(student_id)
+        record = AttendanceRecord(sessionId=session_id, studentId=student_id)
+        self.attendance_writes.add(f"attendance_records/{session_id}/{student_id}", record.to_dict(), keep_existing=True)
+        self.attendance_writes.add(f"student_attendance/{student_id}/{session_id}", True)
+        return True
 
     def get_active_session_id(self,teacher_id):
         try:
@@ -246,29 +637,39 @@ class FirebaseDatabase:
             return None
 
     def end_attendance_session(self, session_id: str):
+        # Records of the session are written before it is closed
+        self.attendance_writes.flush()
         session_ref = db.reference(f"attendance_sessions/{session_id}")
         session_ref.update({'active': False})
+        for teacher_id, roster in list(self.session_rosters.items()):
+            if roster.session_id == session_id:
+                self.session_rosters.pop(teacher_id, None)
+        with self._recorded_lock:
+            self.recorded_students.pop(session_id, None)
 
     def get_attendance_summary(self, student_id: str, student_email: str):
         # Fetch the subjects the student is enrolled in
-        student_ref = db.reference("users").order_by_child("email").equal_to(student_email).get()
+        student_ref = self.find_users_by_email(student_email)
         subjects_enrolled = []
         
         for _, student_data in student_ref.items():
             subjects_enrolled = student_data.get('subjects', [])
 
+        # The sessions the student attended are read once, the sessions of every subject are read concurrently
+        # (the database cannot query several subjects at once) and cached per subject
+        attended_future = self._read_pool.submit(lambda: db.reference(f"student_attendance/{student_id}").get() or {})
+        subject_sessions = list(self._read_pool.map(self.find_session_ids_for_subject, subjects_enrolled))
+        attended_sessions = set(attended_future.result())
+
         # Initialize a dictionary to store attendance summary
         attendance_summary = {}
 
-        for subject in subjects_enrolled:
+        for subject, session_ids in zip(subjects_enrolled, subject_sessions):
             # Get the total number of classes for the subject
-            sessions_ref = db.reference("attendance_sessions").order_by_child('subjectId').equal_to(subject).get()
-            session_ids = [session_key for session_key in sessions_ref.keys()]
             total_classes = len(session_ids)
 
             # Get the number of classes the student has attended for the subject
-            attendance_records = db.reference("attendance_records").order_by_child('studentId').equal_to(student_id).get()
-            attended_classes = sum(1 for record in attendance_records.values() if record['sessionId'] in session_ids)
+            attended_classes = len(attended_sessions.intersection(session_ids))
 
             # Calculate the attendance percentage
             attendance_percentage = (attended_classes / total_classes) * 100 if total_classes > 0 else 0
@@ -294,7 +695,15 @@ class FirebaseDatabase:
         if not student_email:
             print("No student email provided")
             return {"status":False, "message":"Email Not Found", "name":"Unknown"}
-        students_ref = db.reference("users").order_by_child("email").equal_to(student_email).get()
+        roster = self.session_rosters.get(teacher_id)
+        if roster is not None and student_email in roster.students:
+            # Enrolled student of the running session, everything needed was loaded when it started
+            student_id, student_name = roster.students[student_email]
+            if not self.record_attendance(roster.session_id, student_id):
+                return {"status":True, "message":"Already Marked", "name":student_name}
+            print(f"Attendance marked for student '{student_email}' in subject '{roster.subject_name}' with session '{roster.session_id}'")
+            return {"status":True, "message":"Marked", "name":student_name}
+        students_ref = self.find_users_by_email(student_email)
         student_id = None
         student_name = "Unknown"
         if students_ref:
@@ -320,7 +729,7 @@ class FirebaseDatabase:
             
             if active_session_id:
                 # Mark the attendance for the found student in the active session
-                if self.mark_attendance(active_session_id, student_id):
+                if self.record_attendance(active_session_id, student_id):
                     print(f"Attendance marked for student '{student_email}' in subject '{subject_name}' with session '{active_session_id}'")
                     return {"status":True, "message":"Marked", "name":student_name}  # Attendance marked successfully
                 else :
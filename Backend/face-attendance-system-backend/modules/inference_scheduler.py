@@ -0,0 +1,185 @@
+from collections import Counter, OrderedDict
+from typing import Callable
+
+import threading
+import time
+
+import numpy as np
+
+
+class FrameRequest:
+    def __init__(self, client_id, data, teacher_id, on_result, on_error=None):
+        self.client_id = client_id
+        self.data = data
+        self.teacher_id = teacher_id
+        self.on_result = on_result
+        self.on_error = on_error
+        self.enqueued_at = time.monotonic()
+
+
+class InferenceScheduler:
+    """
+    Queues frames from every connected client and runs MTCNN and FaceNet over micro-batches of them.
+    A batch is flushed once it holds max_batch_size frames or the oldest frame has waited max_wait_ms.
+    Each client keeps at most one pending frame, a newer frame replaces the one still waiting.
+    """
+
+    def __init__(self, face_recognizer, finish_frame: Callable, select_faces: Callable = None,
+                 reuse_faces: Callable = None, max_batch_size: int = 8, max_wait_ms: float = 20):
+        """
+        Arguments:
+            face_recognizer: FaceRecognition
+            finish_frame: callable(client_id, img, boxes, embeddings, teacher_id) -> result, run per frame after inference
+            select_faces: callable(boxes, client_id) -> indices of the boxes to embed, every box when None
+            reuse_faces: callable(img, client_id) -> boxes to use instead of running detection, or None
+            max_batch_size: maximum number of frames per batch
+            max_wait_ms: maximum time the oldest frame waits for the batch to fill up
+        """
+        self.face_recognizer = face_recognizer
+        self.finish_frame = finish_frame
+        self.select_faces = select_faces or (lambda boxes, client_id: np.arange(0 if boxes is None else len(boxes)))
+        self.reuse_faces = reuse_faces or (lambda img, client_id: None)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._pending = OrderedDict()  # client_id -> FrameRequest
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        self._batch_sizes = Counter()
+        self._frames_processed = 0
+        self._frames_replaced = 0
+        self._frames_failed = 0
+        self._max_queue_depth = 0
+        self._last_batch_ms = 0.0
+        self._total_wait = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, client_id, data: bytes, teacher_id: str, on_result: Callable, on_error: Callable = None):
+        """
+        Queues a binary frame for inference
+        Arguments:
+            client_id: socket id the result belongs to
+            data: encoded frame as received from the socket
+            teacher_id: user id of the teacher running the session
+            on_result: callable(client_id, result), called from the scheduler thread
+            on_error: callable(client_id, message), called from the scheduler thread when the frame does not decode
+        """
+        with self._condition:
+            if client_id in self._pending:
+                self._frames_replaced += 1
+            self._pending[client_id] = FrameRequest(client_id, data, teacher_id, on_result, on_error)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._pending))
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            batches = sum(self._batch_sizes.values())
+            return {
+                "queue_depth": len(self._pending),
+                "max_queue_depth": self._max_queue_depth,
+                "frames_processed": self._frames_processed,
+                "frames_replaced": self._frames_replaced,
+                "frames_failed": self._frames_failed,
+                "batches": batches,
+                "avg_batch_size": self._frames_processed / batches if batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "avg_queue_wait_ms": 1000.0 * self._total_wait / self._frames_processed if self._frames_processed else 0.0,
+                "last_batch_ms": self._last_batch_ms,
+            }
+
+    def _next_batch(self):
+        with self._condition:
+            while self._running and not self._pending:
+                self._condition.wait()
+            if not self._running:
+                return []
+            deadline = next(iter(self._pending.values())).enqueued_at + self.max_wait
+            while self._running and len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._pending.popitem(last=False)[1] for _ in range(min(self.max_batch_size, len(self._pending)))]
+
+    def _run(self):
+        while self._running:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._process_batch(batch)
+                except Exception as e:
+                    print(f"Error processing batch of {len(batch)} frames: {e}")
+
+    def _decode(self, batch):
+        """
+        Decodes the frames of a batch, a frame that does not decode is reported to its own client and left out
+        Returns:
+            requests: the requests whose frame decoded
+            images: their decoded frames
+        """
+        requests, images = [], []
+        for request in batch:
+            try:
+                images.append(self.face_recognizer.decode_frame(request.data))
+                requests.append(request)
+            except Exception as e:
+                print(f"Error decoding frame for client {request.client_id}: {e}")
+                with self._condition:
+                    self._frames_failed += 1
+                if request.on_error is not None:
+                    try:
+                        request.on_error(request.client_id, str(e))
+                    except Exception as error:
+                        print(f"Error reporting a bad frame to client {request.client_id}: {error}")
+        return requests, images
+
+    def _process_batch(self, batch):
+        started = time.monotonic()
+        batch, images = self._decode(batch)
+        if not batch:
+            return
+
+        # Unchanged frames reuse their boxes, the rest get one MTCNN pass per frame size
+        all_boxes = [self.reuse_faces(img, request.client_id) for request, img in zip(batch, images)]
+        to_detect = [i for i, boxes in enumerate(all_boxes) if boxes is None]
+        if to_detect:
+            detected = self.face_recognizer.detect_face_locations_mtcnn_batch([images[i] for i in to_detect])
+            for i, boxes in zip(to_detect, detected):
+                all_boxes[i] = boxes
+
+        # One FaceNet pass over the faces of every frame
+        crops = []
+        for request, img, boxes in zip(batch, images, all_boxes):
+            selected = self.select_faces(boxes, request.client_id)
+            crops.append(self.face_recognizer.crop_faces(img, boxes[selected] if len(selected) else None))
+        embeddings = self.face_recognizer.embed_faces(np.concatenate(crops, axis=0))
+        splits = np.cumsum([len(faces) for faces in crops])[:-1]
+
+        for request, img, boxes, frame_embeddings in zip(batch, images, all_boxes, np.split(embeddings, splits)):
+            try:
+                result = self.finish_frame(request.client_id, img, boxes, frame_embeddings, request.teacher_id)
+                request.on_result(request.client_id, result)
+            except Exception as e:
+                print(f"Error finishing frame for client {request.client_id}: {e}")
+
+        with self._condition:
+            self._batch_sizes[len(batch)] += 1
+            self._frames_processed += len(batch)
+            self._total_wait += sum(started - request.enqueued_at for request in batch)
+            self._last_batch_ms = 1000.0 * (time.monotonic() - started)
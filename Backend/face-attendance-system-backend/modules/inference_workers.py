@@ -0,0 +1,215 @@
+from multiprocessing import shared_memory
+from typing import Callable
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# Largest frame a shared memory slot can hold
+default_max_frame_shape = (1080, 1920, 3)
+
+
+def _worker_main(worker_index, slot_names, tasks, results, threads_per_worker):
+    """
+    Entry point of a worker process. Frames arrive as (task_id, slot, shape, client_id, roster_id) and are read in place from
+    the shared memory slot, only the boxes and identities travel back through the result queue.
+    """
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads_per_worker)
+
+    import cv2
+    import torch
+    from modules.utils import end_roster, get_faiss, recognize_frame, remove_face_tracker, start_roster, warm_up
+
+    torch.set_num_threads(threads_per_worker)
+    cv2.setNumThreads(threads_per_worker)
+    # The pool is forked before the parent loads anything, the server process stays the only gallery writer
+    warm_up(writer=False)
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            if task[0] == "drop":
+                remove_face_tracker(task[1])
+                continue
+            if task[0] == "reload":
+                get_faiss().reload()
+                continue
+            if task[0] == "roster":
+                start_roster(task[1], task[2])
+                continue
+            if task[0] == "end_roster":
+                end_roster(task[1])
+                continue
+            task_id, slot, shape, client_id, roster_id = task
+            try:
+                img = np.ndarray(shape, dtype=np.uint8, buffer=slots[slot].buf)
+                boxes, person_ids = recognize_frame(img, client_id, roster_id)
+                results.put((task_id, worker_index, slot, boxes, person_ids, None))
+            except Exception as e:
+                results.put((task_id, worker_index, slot, None, [], str(e)))
+    finally:
+        for shm in slots:
+            shm.close()
+
+
+class InferenceWorkerPool:
+    """
+    Runs recognize_frame in worker processes, each with its own FaceRecognition, FAISS index and torch thread pool.
+    Every client is pinned to one worker so its face tracker and change gate live in a single process.
+    Decoded frames are handed over through preallocated shared memory slots instead of being pickled.
+    """
+
+    def __init__(self, num_workers: int, threads_per_worker: int = 1, slots_per_worker: int = 2,
+                 max_frame_shape=default_max_frame_shape):
+        """
+        Arguments:
+            num_workers: number of worker processes
+            threads_per_worker: torch/OpenCV threads per worker, keep num_workers * threads_per_worker <= cores
+            slots_per_worker: frames that can be in flight per worker
+            max_frame_shape: largest (H, W, 3) frame a slot can hold
+        """
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.slots_per_worker = slots_per_worker
+        self.slot_bytes = int(np.prod(max_frame_shape))
+
+        self._processes = []
+        self._tasks = []
+        self._free_slots = []
+        self._slots = []
+        self._results = None
+        self._callbacks = {}
+        self._task_ids = iter(range(1 << 62))
+        self._lock = threading.Lock()
+        self._collector = None
+
+        self._submitted = [0] * num_workers
+        self._completed = [0] * num_workers
+        self._errors = 0
+        self._total_latency = 0.0
+
+    def start(self):
+        # fork avoids re-importing server.py in every worker. It must happen before this process starts any thread
+        # (the FAISS checkpointer, the Firebase write-behind flusher) whose held locks a worker would inherit, and
+        # before CUDA is up
+        context = multiprocessing.get_context("fork")
+        self._results = context.Queue()
+        for worker_index in range(self.num_workers):
+            slots = [shared_memory.SharedMemory(create=True, size=self.slot_bytes) for _ in range(self.slots_per_worker)]
+            free_slots = queue.Queue()
+            for slot in range(self.slots_per_worker):
+                free_slots.put(slot)
+            tasks = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(worker_index, [shm.name for shm in slots], tasks, self._results, self.threads_per_worker),
+                name=f"inference-worker-{worker_index}",
+                daemon=True,
+            )
+            process.start()
+            self._slots.append(slots)
+            self._free_slots.append(free_slots)
+            self._tasks.append(tasks)
+            self._processes.append(process)
+
+        self._collector = threading.Thread(target=self._collect, name="inference-results", daemon=True)
+        self._collector.start()
+        return self
+
+    def stop(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+        self._results.put(None)
+        self._collector.join()
+        for slots in self._slots:
+            for shm in slots:
+                shm.close()
+                shm.unlink()
+
+    def worker_for(self, client_id) -> int:
+        return zlib.crc32(str(client_id).encode()) % self.num_workers
+
+    def submit(self, client_id, img: np.ndarray, on_result: Callable, roster_id=None):
+        """
+        Copies a decoded frame into a free slot of the client's worker and queues it
+        Arguments:
+            client_id: stream the frame belongs to
+            img: np.ndarray (H, W, 3) uint8
+            on_result: callable(client_id, img, boxes, person_ids), called from the collector thread with a view of
+                the frame in shared memory, the view is only valid until the callback returns
+            roster_id: teacher id of the attendance session, see set_roster
+        """
+        if img.nbytes > self.slot_bytes:
+            raise ValueError(f"Frame of shape {img.shape} does not fit in a {self.slot_bytes} byte slot")
+        worker_index = self.worker_for(client_id)
+        slot = self._free_slots[worker_index].get()  # Blocks while the worker has every slot in flight
+        np.copyto(np.ndarray(img.shape, dtype=np.uint8, buffer=self._slots[worker_index][slot].buf), img)
+        with self._lock:
+            task_id = next(self._task_ids)
+            self._callbacks[task_id] = (client_id, img.shape, on_result, time.monotonic())
+            self._submitted[worker_index] += 1
+        self._tasks[worker_index].put((task_id, slot, img.shape, client_id, roster_id))
+
+    def drop_client(self, client_id):
+        """ Forgets the face tracks of a client in its worker """
+        self._tasks[self.worker_for(client_id)].put(("drop", client_id))
+
+    def reload_index(self):
+        """ Makes every worker re-read the FAISS index from disk after a registration """
+        for tasks in self._tasks:
+            tasks.put(("reload",))
+
+    def set_roster(self, roster_id, person_ids):
+        """ Restricts the matches of a session's frames to its enrolled students in every worker """
+        for tasks in self._tasks:
+            tasks.put(("roster", roster_id, list(person_ids)))
+
+    def end_roster(self, roster_id):
+        for tasks in self._tasks:
+            tasks.put(("end_roster", roster_id))
+
+    def _collect(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            task_id, worker_index, slot, boxes, person_ids, error = result
+            with self._lock:
+                client_id, shape, on_result, submitted_at = self._callbacks.pop(task_id)
+                self._completed[worker_index] += 1
+                self._total_latency += time.monotonic() - submitted_at
+                self._errors += error is not None
+            try:
+                if error is not None:
+                    print(f"Worker {worker_index} failed on a frame of client {client_id}: {error}")
+                else:
+                    img = np.ndarray(shape, dtype=np.uint8, buffer=self._slots[worker_index][slot].buf)
+                    on_result(client_id, img, boxes, person_ids)
+            except Exception as e:
+                print(f"Error handling result for client {client_id}: {e}")
+            finally:
+                self._free_slots[worker_index].put(slot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            completed = sum(self._completed)
+            return {
+                "workers": self.num_workers,
+                "threads_per_worker": self.threads_per_worker,
+                "in_flight": sum(self._submitted) - completed,
+                "submitted_per_worker": list(self._submitted),
+                "completed_per_worker": list(self._completed),
+                "errors": self._errors,
+                "avg_latency_ms": 1000.0 * self._total_latency / completed if completed else 0.0,
+            }
@@ -0,0 +1,109 @@
+"""
+Moves attendance records written under push keys
+(attendance_records/{pushKey} = {sessionId, studentId, markedAt}) to one record
+per student and session at attendance_records/{sessionId}/{studentId}, mirrored
+at student_attendance/{studentId}/{sessionId}. Duplicate records of a student
+in a session are merged into the earliest one, including a record an earlier
+run or the server already wrote at the new key.
+
+Records are read a page at a time in key order and every page is rewritten and
+its old keys deleted in one multi-location update, so the migration can be
+stopped and run again. The server already writes the new layout and can keep
+running, but attendance summaries only count migrated records.
+
+Run from the backend directory:
+    python -m modules.migrate_attendance_records --dry-run
+    python -m modules.migrate_attendance_records --page-size 1000
+"""
+from collections import Counter
+
+import argparse
+
+from firebase_admin import db
+
+
+def is_push_key_record(value) -> bool:
+    """ True for a record of the old layout, attendance_records/{sessionId} nodes of the new one hold records """
+    return isinstance(value, dict) and "sessionId" in value and "studentId" in value
+
+
+def existing_marks(session_id: str) -> dict:
+    """
+    Returns:
+        marks: {student_id: markedAt} of the records of a session already at attendance_records/{sessionId}/{studentId}
+    """
+    node = db.reference(f"attendance_records/{session_id}").get() or {}
+    if not isinstance(node, dict) or is_push_key_record(node):
+        return {}
+    return {student_id: record.get("markedAt", "") for student_id, record in node.items() if isinstance(record, dict)}
+
+
+def migrate(page_size: int = 1000, dry_run: bool = False) -> Counter:
+    """
+    Arguments:
+        page_size: records read and rewritten per update
+        dry_run: count what would change without writing
+    Returns:
+        counts: records found, duplicates merged, records written and session nodes already in the new layout
+    """
+    counts = Counter()
+    earliest = {}  # (session_id, student_id) -> markedAt of the record written for it
+    migrated = {}  # session_id -> {student_id: markedAt} of the records already in the new layout, read once
+    last_key = None
+    while True:
+        query = db.reference("attendance_records").order_by_key()
+        if last_key is not None:
+            query = query.start_at(last_key)
+        page = query.limit_to_first(page_size + (last_key is not None)).get() or {}
+        keys = [key for key in page if key != last_key]
+        if not keys:
+            break
+        update = {}
+        for key in keys:
+            record = page[key]
+            if not is_push_key_record(record):
+                counts["sessions_already_migrated"] += 1
+                continue
+            counts["records_found"] += 1
+            session_id, student_id = record["sessionId"], record["studentId"]
+            marked_at = record.get("markedAt", "")
+            pair = (session_id, student_id)
+            if pair not in earliest:
+                if session_id not in migrated:
+                    migrated[session_id] = existing_marks(session_id)
+                if student_id in migrated[session_id]:
+                    earliest[pair] = migrated[session_id][student_id]
+            if pair in earliest:
+                counts["duplicates_merged"] += 1
+                if earliest[pair] <= marked_at:
+                    update[f"attendance_records/{key}"] = None
+                    continue
+            else:
+                counts["records_written"] += 1
+            earliest[pair] = marked_at
+            update[f"attendance_records/{session_id}/{student_id}"] = record
+            update[f"student_attendance/{student_id}/{session_id}"] = True
+            update[f"attendance_records/{key}"] = None
+        if update and not dry_run:
+            db.reference().update(update)
+        last_key = keys[-1]
+        print(f"{counts['records_found']} records migrated, {counts['duplicates_merged']} duplicates merged")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move attendance records to one record per student and session")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    from modules.firebase_utils import FirebaseDatabase
+    FirebaseDatabase()  # Initializes the Firebase app
+    counts = migrate(args.page_size, args.dry_run)
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {counts['records_found']} records into "
+          f"{counts['records_written']} ({counts['duplicates_merged']} duplicates merged), "
+          f"{counts['sessions_already_migrated']} sessions were already in the new layout")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,105 @@
 from PIL import Image
 from facenet_pytorch import InceptionResnetV1, MTCNN
 from io import BytesIO
+from modules.embedding_engines import load_embedding_engine
 
 import cv2
 import numpy as np
+import threading
 import torch
 
 
 
+# FaceNet input resolution and embedding size
+face_size = 160
+embedding_dimension = 512
+# MTCNN's default smallest face and the smallest face its P-Net can see
+mtcnn_min_face_size = 20
+pnet_face_size = 12
+# JPEG decode reductions OpenCV can apply while decoding
+imread_reduced_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
 class FaceRecognition:
-    def __init__(self):
+    def __init__(self, embedding_batch_size: int = 32, engine: str = "eager", detection_scale: float = 1.0,
+                 min_face_size: int = 20, decode_reduction: int = 1, device: torch.device = None):
+        """
+        Arguments:
+            embedding_batch_size: upper bound on faces sent through FaceNet in one forward pass
+            engine: runtime for the embedding model, "eager", "torchscript", "onnx" or "int8_static"
+            detection_scale: factor frames are downscaled by before MTCNN, 0 derives it from min_face_size
+            min_face_size: smallest face to detect, in pixels of the full resolution frame
+            decode_reduction: 1, 2, 4 or 8, decode frames at that fraction of their size, 0 picks the largest
+                reduction the detection scale allows
+            device: device to run the models on, None uses CUDA when it is available
+        """
         self.device = None
-        self.check_gpu()
-        self.mtcnn = MTCNN(keep_all=True, device=self.device)
-        self.face_recognition_model = InceptionResnetV1(pretrained='vggface2').eval().to(self.device)
+        self.embedding_batch_size = embedding_batch_size
+        self.requested_decode_reduction = decode_reduction
+        self._buffers = threading.local()  # Per thread scratch buffers reused across frames
+        self.engine = engine
+        self._embedding_model = None
+        self._embedding_engine = None
+        self._model_lock = threading.Lock()
+        if device is None:
+            self.check_gpu()
+        else:
+            self.device = torch.device(device)
+        self.configure_detection(detection_scale, min_face_size)
+
+    def load_embedding_model(self):
+        """ Builds FaceNet and its engine, on first use so a process that only decodes and draws frames never does """
+        with self._model_lock:
+            if self._embedding_engine is None:
+                model = InceptionResnetV1(pretrained='vggface2').eval().to(self.device)
+                self._embedding_engine = load_embedding_engine(model, self.device, self.engine)
+                self._embedding_model = model
+                if self.engine.startswith("int8"):
+                    # Quantized kernels only run on the CPU
+                    self.device = torch.device('cpu')
+
+    @property
+    def face_recognition_model(self):
+        if self._embedding_engine is None:
+            self.load_embedding_model()
+        return self._embedding_model
+
+    @property
+    def embedding_engine(self):
+        if self._embedding_engine is None:
+            self.load_embedding_model()
+        return self._embedding_engine
+
+    def configure_detection(self, detection_scale: float = 1.0, min_face_size: int = 20):
+        """ Builds MTCNN for frames downscaled by detection_scale, keeping faces of min_face_size detectable
+        Arguments:
+            detection_scale: factor in (0, 1], 0 picks the smallest scale at which min_face_size faces
+                are still mtcnn_min_face_size pixels wide
+            min_face_size: smallest face to detect, in pixels of the full resolution frame
+        """
+        if detection_scale <= 0:
+            detection_scale = min(1.0, mtcnn_min_face_size / min_face_size)
+        detection_scale = min(detection_scale, 1.0)
+        self.min_face_size = min_face_size
+        self.mtcnn = MTCNN(
+            keep_all=True,
+            device=self.device,
+            min_face_size=max(pnet_face_size, int(round(min_face_size * detection_scale))),
+        )
+
+        # Decoding at a reduced size already does part of the downscaling, detection does the rest.
+        # The reduction never goes below the detection scale, so detection_scale is relative to decode_frame output.
+        largest_reduction = max(r for r in imread_reduced_flags if r * detection_scale <= 1.0)
+        if self.requested_decode_reduction <= 0:
+            self.decode_reduction = largest_reduction
+        else:
+            self.decode_reduction = min(self.requested_decode_reduction, largest_reduction)
+        self.detection_scale = min(1.0, detection_scale * self.decode_reduction)
 
     def check_gpu(self):
         if torch.cuda.is_available():
@@ -31,11 +117,85 @@ class FaceRecognition:
         Returns:
             boxes: list of bounding boxes of detected faces
         """
-        img = np.array(image)
-        boxes, _ = self.mtcnn.detect(img)
+        img = np.asarray(image)
+        boxes, _ = self.mtcnn.detect(self.downscale_for_detection(img, self._scratch("detection", img)))
+        return self.rescale_boxes(boxes, img.shape)
+
+    def detect_face_locations_mtcnn_batch(self, images):
+        """ Detects faces in several images, frames of the same size share one MTCNN pass
+        Arguments:
+            images: list of np.ndarray (H, W, 3)
+        Returns:
+            boxes: list with the bounding boxes (or None) of each image, in input order
+        """
+        boxes = [None] * len(images)
+        same_shape = {}
+        for i, image in enumerate(images):
+            same_shape.setdefault(np.shape(image), []).append(i)
+        for shape, indices in same_shape.items():
+            # Frames are resized straight into the batch instead of being stacked afterwards
+            batch = np.empty((len(indices),) + self.detection_shape(shape), dtype=np.uint8)
+            for j, i in enumerate(indices):
+                self.downscale_for_detection(np.asarray(images[i]), batch[j])
+            batch_boxes, _ = self.mtcnn.detect(batch)
+            for i, image_boxes in zip(indices, batch_boxes):
+                boxes[i] = self.rescale_boxes(image_boxes, shape)
         return boxes
 
+    def detection_shape(self, shape):
+        """ Shape of a frame of the given shape after downscaling for detection """
+        height, width = shape[:2]
+        if self.detection_scale >= 1.0:
+            return (height, width) + tuple(shape[2:])
+        return (max(1, int(round(height * self.detection_scale))), max(1, int(round(width * self.detection_scale)))) + tuple(shape[2:])
+
+    def downscale_for_detection(self, img, out=None):
+        """ Resizes a frame to the detection scale, frames are returned as is at scale 1
+        Arguments:
+            img: np.ndarray (H, W, 3)
+            out: optional preallocated np.ndarray of detection_shape(img.shape) to resize into
+        """
+        if self.detection_scale >= 1.0:
+            if out is not None:
+                out[...] = img
+                return out
+            return img
+        height, width = self.detection_shape(img.shape)[:2]
+        return cv2.resize(img, (width, height), dst=out, interpolation=cv2.INTER_AREA)
+
+    def rescale_boxes(self, boxes, shape):
+        """ Maps boxes found on the downscaled frame back to the full resolution frame of the given shape """
+        if boxes is None or self.detection_scale >= 1.0:
+            return boxes
+        height, width = shape[:2]
+        small_height, small_width = self.detection_shape(shape)[:2]
+        return boxes * np.array([width / small_width, height / small_height] * 2, dtype=boxes.dtype)
+
+    def _scratch(self, name, img):
+        """ Thread local buffer for downscaling img, reused while the frame size stays the same """
+        if self.detection_scale >= 1.0:
+            return None
+        shape = self.detection_shape(img.shape)
+        buffer = getattr(self._buffers, name, None)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            setattr(self._buffers, name, buffer)
+        return buffer
+
+    def decode_frame(self, data):
+        """ Decodes an encoded frame straight from the socket bytes, at 1/decode_reduction of its size
+        Arguments:
+            data: bytes (JPEG or PNG)
+        Returns:
+            img: np.ndarray (H, W, 3), same channel order as convert_binary_to_rgb
+        """
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), imread_reduced_flags[self.decode_reduction])
+        if img is None:
+            raise ValueError("Could not decode frame")
+        return img
+
     def convert_binary_to_rgb(self, data):
+        # Superseded by decode_frame, which skips the PIL copy and the color conversion
         img = Image.open(BytesIO(data))
         img = np.array(img)
         # Convert the image from BGR to RGB
@@ -71,14 +231,83 @@ class FaceRecognition:
 
         return embeddings
 
+    def crop_faces(self, img, boxes):
+        """ Crops every box out of the image and resizes it to the FaceNet input size
+        Arguments:
+            img: np.ndarray (H, W, 3)
+            boxes: bounding boxes (x1, y1, x2, y2)
+        Returns:
+            faces: np.ndarray (N, 160, 160, 3) uint8
+        """
+        if boxes is None or len(boxes) == 0:
+            return np.empty((0, face_size, face_size, 3), dtype=np.uint8)
+        height, width = img.shape[:2]
+        faces = np.empty((len(boxes), face_size, face_size, 3), dtype=np.uint8)
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            # MTCNN boxes can run past the frame edges, clamp them so the slice is never empty
+            x1, x2 = min(max(int(x1), 0), width - 1), min(max(int(x2), 1), width)
+            y1, y2 = min(max(int(y1), 0), height - 1), min(max(int(y2), 1), height)
+            cv2.resize(img[y1:max(y2, y1 + 1), x1:max(x2, x1 + 1)], (face_size, face_size), dst=faces[i])
+        return faces
+
+    def embed_faces(self, faces, max_batch_size: int = None):
+        """ Runs FaceNet on already cropped faces, max_batch_size faces per forward pass
+        Arguments:
+            faces: np.ndarray (N, 160, 160, 3) uint8
+            max_batch_size: int, defaults to self.embedding_batch_size
+        Returns:
+            embeddings: np.ndarray (N, 512) float32
+        """
+        max_batch_size = max_batch_size or self.embedding_batch_size
+        embeddings = np.empty((len(faces), embedding_dimension), dtype=np.float32)
+        for start in range(0, len(faces), max_batch_size):
+            batch = (
+                torch.from_numpy(faces[start:start + max_batch_size])
+                .to(self.device)
+                .permute(0, 3, 1, 2)
+                .float()
+                .div(255.0)
+            )
+            embeddings[start:start + len(batch)] = self.embedding_engine(batch)
+        return embeddings
+
+    def get_embeddings_batch(self, img, boxes, max_batch_size: int = None):
+        """ Batched version of get_embeddings, all faces of a frame go through FaceNet together
+        Arguments:
+            img: np.ndarray (H, W, 3)
+            boxes: bounding boxes of detected faces
+            max_batch_size: int, defaults to self.embedding_batch_size
+        Returns:
+            embeddings: np.ndarray (N, 512) float32
+        """
+        return self.embed_faces(self.crop_faces(img, boxes), max_batch_size)
 
     def get_face_location_and_embeddings(self, img):
         boxes = self.detect_face_locations_mtcnn(img)
-        embeddings = self.get_embeddings(img, boxes)
+        embeddings = self.get_embeddings_batch(img, boxes)
         return boxes, embeddings
     
+    def get_largest_face_embeddings(self, images):
+        """ Embeds the largest face of every image, detection and FaceNet each run once for all images
+        Arguments:
+            images: list of np.ndarray (H, W, 3), e.g. the capture steps of one registration
+        Returns:
+            embeddings: np.ndarray (M, 512) float32, one row per image with a face
+            found: list with the index of the image each row belongs to
+        """
+        faces, found = [], []
+        for i, (image, boxes) in enumerate(zip(images, self.detect_face_locations_mtcnn_batch(images))):
+            if boxes is None or len(boxes) == 0:
+                continue
+            largest = boxes[np.argmax((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))]
+            faces.append(self.crop_faces(np.asarray(image), largest[None]))
+            found.append(i)
+        if not faces:
+            return np.empty((0, embedding_dimension), dtype=np.float32), found
+        return self.embed_faces(np.concatenate(faces)), found
+
     def get_largest_face_location_and_embedding(self, boxes, embeddings):
-        if boxes is not None and len(boxes) > 0 and embeddings is not None:
+        if boxes is not None and len(boxes) > 0 and embeddings is not None and len(embeddings) > 0:
             # Find the index of the largest box
             largest_box_index = np.argmax((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
 
@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+
+
+class FrameChangeGate:
+    """
+    Cheap change detector for one camera stream.
+    Frames are compared as small grayscale thumbnails against the last frame that went through detection,
+    when the mean absolute difference stays under the threshold the previous boxes can be reused.
+    """
+
+    def __init__(self, threshold: float = 3.0, force_detection_every: int = 15, thumbnail_size=(64, 36)):
+        """
+        Arguments:
+            threshold: mean absolute gray level difference (0-255) under which a frame counts as unchanged,
+                0 disables the gate
+            force_detection_every: run detection at least every this many frames
+            thumbnail_size: (width, height) of the compared thumbnails
+        """
+        self.threshold = threshold
+        self.force_detection_every = force_detection_every
+        self.thumbnail_size = thumbnail_size
+        self.reference = None
+        self.frames_since_detection = 0
+        self.frames = 0
+        self.skipped = 0
+
+    def thumbnail(self, img) -> np.ndarray:
+        small = cv2.resize(np.asarray(img), self.thumbnail_size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_RGB2GRAY).astype(np.int16)
+
+    def is_unchanged(self, img) -> bool:
+        """
+        Checks whether the frame can reuse the detections of the previous one
+        Arguments:
+            img: np.ndarray (H, W, 3)
+        Returns:
+            unchanged: True when detection can be skipped for this frame
+        """
+        self.frames += 1
+        if self.threshold <= 0:
+            return False
+        thumbnail = self.thumbnail(img)
+        if (self.reference is not None
+                and self.frames_since_detection + 1 < self.force_detection_every
+                and np.abs(thumbnail - self.reference).mean() < self.threshold):
+            self.frames_since_detection += 1
+            self.skipped += 1
+            return True
+        self.reference = thumbnail
+        self.frames_since_detection = 0
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skipped_percent": 100.0 * self.skipped / self.frames if self.frames else 0.0,
+        }
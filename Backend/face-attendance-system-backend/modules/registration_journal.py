@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import List, Tuple
+
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+# Record layout: crc32 of the rest | seq | timestamp | op | id length | vector count | id (utf-8) | float32 vectors
+record_header = struct.Struct("<QdBHI")
+crc_field = struct.Struct("<I")
+op_replace = 1
+op_remove = 2
+
+
+class RegistrationJournal:
+    """
+    Append-only log of gallery changes. Each registration or removal costs one small append instead of rewriting
+    the whole index, the FAISS checkpoints fold the log back into the index files and compact it.
+    """
+
+    def __init__(self, path: Path, dimension: int, fsync: bool = True):
+        """
+        Arguments:
+            path: journal file
+            dimension: length of the stored face vectors
+            fsync: fsync after every append so an acknowledged registration survives a crash
+        """
+        self.path = Path(path)
+        self.dimension = dimension
+        self.fsync = fsync
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "ab")
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, seq: int, op: int, person_id: str, encodings: np.ndarray = None, sync: bool = True,
+               timestamp: float = None):
+        """
+        Appends one record
+        Arguments:
+            seq: sequence number, increasing across records
+            op: op_replace or op_remove
+            person_id: email of the person
+            encodings: np.ndarray (N, dimension), None for removals
+            sync: flush (and fsync) now, pass False when appending a batch and call sync once at the end
+            timestamp: time of the change, defaults to now
+        """
+        if encodings is None:
+            encodings = np.empty((0, self.dimension), dtype=np.float32)
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, self.dimension)
+        email = person_id.encode("utf-8")
+        timestamp = time.time() if timestamp is None else timestamp
+        body = record_header.pack(seq, timestamp, op, len(email), len(encodings)) + email + encodings.tobytes()
+        self._open().write(crc_field.pack(zlib.crc32(body)) + body)
+        if sync:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def read(self, repair: bool = True) -> List[Tuple[int, float, int, str, np.ndarray]]:
+        """
+        Reads every intact record
+        Arguments:
+            repair: cut off a torn or corrupt tail (crash in the middle of an append), only the writing process
+                may do this, a reader could otherwise cut an append that is still in progress
+        Returns:
+            records: list of (seq, timestamp, op, person_id, encodings)
+        """
+        if self._file is not None:
+            self._file.flush()
+        if not self.path.exists():
+            return []
+        data = self.path.read_bytes()
+        records, offset = [], 0
+        while offset < len(data):
+            start = offset + crc_field.size
+            if start + record_header.size > len(data):
+                break
+            seq, timestamp, op, email_length, count = record_header.unpack_from(data, start)
+            end = start + record_header.size + email_length + 4 * count * self.dimension
+            if end > len(data) or crc_field.unpack_from(data, offset)[0] != zlib.crc32(data[start:end]):
+                break
+            email_start = start + record_header.size
+            person_id = data[email_start:email_start + email_length].decode("utf-8")
+            encodings = np.frombuffer(data, dtype=np.float32, count=count * self.dimension,
+                                      offset=email_start + email_length).reshape(count, self.dimension)
+            records.append((seq, timestamp, op, person_id, encodings))
+            offset = end
+        if offset < len(data) and repair:
+            print(f"Discarding {len(data) - offset} corrupt bytes at the end of {self.path}")
+            self.close()
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        return records
+
+    def compact(self, upto_seq: int):
+        """ Drops the records already contained in a checkpoint, atomically replacing the file """
+        kept = [record for record in self.read() if record[0] > upto_seq]
+        self.close()
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            self._file = f
+            for seq, timestamp, op, person_id, encodings in kept:
+                self.append(seq, op, person_id, encodings, sync=False, timestamp=timestamp)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file = None
+        os.replace(tmp, self.path)
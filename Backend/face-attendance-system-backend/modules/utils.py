@@ -1,63 +1,305 @@
-from PIL import Image
-from modules.faiss_utils import FAISS
 from modules.firebase_utils import FirebaseDatabase
-from modules.ml_utils import FaceRecognition
-from typing import Tuple
+from modules.face_tracker import FaceTracker
+from typing import List, Tuple
 
+import atexit
 import logging
+import os
+import threading
 import time
 from collections import OrderedDict
 
+import numpy as np
+
 # Initialize the cache and flush time
 local_cache = OrderedDict()
+# Every face of a frame is marked, keep a full classroom in the cache
+local_cache_size = 100
 last_flushed = time.time()
 
-faiss = FAISS()
-face_recognizer = FaceRecognition()
+# The FAISS index and the models are built on first use (or by warm_up), importing this module stays cheap
+faiss = None
+face_recognizer = None
+ml_lock = threading.Lock()
+
+def get_faiss(writer: bool = True):
+    """
+    Returns the FAISS index, loading it on first use
+    Arguments:
+        writer: False loads a gallery that is only searched, it neither repairs the journal nor checkpoints
+    """
+    global faiss
+    if faiss is None:
+        with ml_lock:
+            if faiss is None:
+                from modules.faiss_utils import FAISS
+                loaded = FAISS(
+                    index_type=os.getenv("FAISS_INDEX_TYPE", "flat"),
+                    nprobe=int(os.getenv("FAISS_NPROBE", 16)),
+                    ef_search=int(os.getenv("FAISS_EF_SEARCH", 64)),
+                    mmap=os.getenv("FAISS_MMAP", "0") == "1",
+                    model_version=os.getenv("EMBEDDING_MODEL_VERSION", "facenet-vggface2"),
+                    embedding_dtype=os.getenv("EMBEDDING_STORE_DTYPE", "float32"),
+                    writer=writer,
+                )
+                if writer:
+                    loaded.start_checkpointing(
+                        interval=float(os.getenv("FAISS_CHECKPOINT_INTERVAL", 300)),
+                        max_records=int(os.getenv("FAISS_CHECKPOINT_RECORDS", 1000)),
+                    )
+                    # Fold the journal into a checkpoint on a clean shutdown
+                    atexit.register(loaded.stop_checkpointing)
+                faiss = loaded
+    return faiss
+
+def get_face_recognizer():
+    """
+    Returns the face detection and embedding models, building them on first use
+    """
+    global face_recognizer
+    if face_recognizer is None:
+        with ml_lock:
+            if face_recognizer is None:
+                from modules.ml_utils import FaceRecognition
+                face_recognizer = FaceRecognition(
+                    embedding_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 32)),
+                    engine=os.getenv("EMBEDDING_ENGINE", "eager"),
+                    detection_scale=float(os.getenv("DETECTION_SCALE", 1.0)),
+                    min_face_size=int(os.getenv("MIN_FACE_SIZE", 20)),
+                    decode_reduction=int(os.getenv("DECODE_REDUCTION", 1)),
+                )
+    return face_recognizer
+
+def warm_up(writer: bool = True):
+    """
+    Loads the FAISS index and the models up front so the first frame does not pay for them
+    Arguments:
+        writer: False in the inference workers, see get_faiss
+    Returns:
+        seconds: time spent loading
+    """
+    start = time.perf_counter()
+    get_faiss(writer)
+    get_face_recognizer().load_embedding_model()
+    seconds = time.perf_counter() - start
+    print(f"Face recognition warmed up in {seconds:.1f}s")
+    return seconds
+
+# "prototype" and "medoid" store one vector per student, "all" stores every capture step and votes over the top k
+enrollment_templates = os.getenv("ENROLLMENT_TEMPLATES", "prototype")
+template_votes = int(os.getenv("TEMPLATE_VOTES", 5))
+# Capture steps of a face registration, the student is registered once the last one is embedded
+registration_steps = int(os.getenv("REGISTRATION_STEPS", 6))
+# Embeddings of the registrations in progress, (email, subject) -> {step: np.ndarray (512,)}
+pending_registrations = {}
+registrations_lock = threading.Lock()
+
+# Gallery restricted to the enrolled students of each running attendance session, keyed by teacher id
+session_rosters = {}
+roster_search = os.getenv("ROSTER_SEARCH", "1") != "0"
 
-def process_image_and_mark_attendance(img:Image , firebase_db:FirebaseDatabase, session)->Tuple[bytes, dict]:
+# One face tracker and change gate per camera stream, keyed by socket id
+face_trackers = {}
+change_gates = {}
+motion_gate_threshold = float(os.getenv("MOTION_GATE_THRESHOLD", 3.0))
+motion_gate_force_every = int(os.getenv("MOTION_GATE_FORCE_EVERY", 15))
+
+def process_image_and_mark_attendance(img:np.ndarray , firebase_db:FirebaseDatabase, session, client_id=None)->Tuple[bytes, dict]:
     """
     Processes the image and marks the attendance
     Arguments:
-        img: PIL.Image
+        img: np.ndarray (H, W, 3) as returned by decode_frame
         firebase_db: FirebaseDB
         session: dict
+        client_id: stream the frame belongs to, enables face tracking across frames
     Returns:
         processed_frame_data: bytes
         attendance_status: dict
     """
     
-    boxes, embeddings = face_recognizer.get_face_location_and_embeddings(img)
+    boxes, person_ids = recognize_frame(img, client_id, session['user_id'])
+    return mark_attendance_for_faces(img, boxes, person_ids, firebase_db, session['user_id'])
 
-    # Get largest face location and embedding
-    largest_box, largest_embedding = face_recognizer.get_largest_face_location_and_embedding(boxes, embeddings)
-    
-    # Get perosn id (email) from faiss index
-    person_recognized = faiss.get_person_id(largest_embedding, 1, 0.8)
-    
-    # Select highest confidence person
-    person = person_recognized[0] if person_recognized else None
-    person_email = person.id if person else ""
 
-    response = check_in_local_cache(person_email)
-    
-    # Mark Attendance
-    if not response:
-        response = firebase_db.mark_attendance_by_email(student_email=person_email, teacher_id=session['user_id'])
-    if response['status'] == True:
-        # Green box
-        img = face_recognizer.draw_bounding_boxes(img, [largest_box],(0, 255, 0), 4)
-        attendance_status = {response['name']: response['message']}
-        update_local_cache(person_email, response['name'])
-    elif response['status'] == False and largest_box is not None:
-        # Red box
-        img = face_recognizer.draw_bounding_boxes(img, [largest_box],(0, 0, 255), 4)
-        attendance_status = {"Person": "Unknown"}
+def recognize_frame(img, client_id=None, roster_id=None):
+    """
+    Detects and identifies the faces of a frame, without touching Firebase
+    Arguments:
+        img: np.ndarray
+        client_id: stream the frame belongs to, enables change gating and face tracking across frames
+        roster_id: teacher id of the attendance session, restricts matches to its roster when one was started
+    Returns:
+        boxes: bounding boxes of the detected faces
+        person_ids: list with the email of every box, "" for unknown faces
+    """
+    boxes = previous_faces(img, client_id)
+    if boxes is None:
+        boxes = get_face_recognizer().detect_face_locations_mtcnn(img)
+    to_embed = faces_to_embed(boxes, client_id)
+    embeddings = get_face_recognizer().get_embeddings_batch(img, boxes[to_embed] if len(to_embed) else None)
+    return boxes, identify_tracked_faces(embeddings, client_id, roster_id)
+
+
+def get_face_tracker(client_id) -> FaceTracker:
+    if client_id not in face_trackers:
+        face_trackers[client_id] = FaceTracker()
+    return face_trackers[client_id]
+
+def remove_face_tracker(client_id):
+    face_trackers.pop(client_id, None)
+    change_gates.pop(client_id, None)
+
+def previous_faces(img, client_id=None):
+    """
+    Returns the boxes of the stream's previous frame when this frame has not changed
+    Arguments:
+        img: np.ndarray
+        client_id: stream the frame belongs to, untracked frames are always detected
+    Returns:
+        boxes: np.ndarray (N, 4) to reuse, None when detection has to run
+    """
+    if client_id is None:
+        return None
+    if client_id not in change_gates:
+        # Imported here, the gate pulls in cv2 which the API-only server never loads
+        from modules.motion_gate import FrameChangeGate
+        change_gates[client_id] = FrameChangeGate(motion_gate_threshold, motion_gate_force_every)
+    if not change_gates[client_id].is_unchanged(img):
+        return None
+    tracks = get_face_tracker(client_id).current
+    return np.array([track.box for track in tracks], dtype=np.float32).reshape(-1, 4)
+
+def get_motion_gate_stats() -> dict:
+    """
+    Aggregated skip statistics of the live change gates
+    """
+    frames = sum(gate.frames for gate in change_gates.values())
+    skipped = sum(gate.skipped for gate in change_gates.values())
+    return {
+        "streams": len(change_gates),
+        "frames": frames,
+        "skipped": skipped,
+        "skipped_percent": 100.0 * skipped / frames if frames else 0.0,
+    }
+
+def get_tracking_stats() -> dict:
+    """
+    Aggregated embedding cache statistics of the live face trackers
+    """
+    lookups = sum(tracker.lookups for tracker in face_trackers.values())
+    hits = sum(tracker.hits for tracker in face_trackers.values())
+    return {
+        "streams": len(face_trackers),
+        "lookups": lookups,
+        "hits": hits,
+        "hit_rate": hits / lookups if lookups else 0.0,
+    }
+
+def faces_to_embed(boxes, client_id=None) -> np.ndarray:
+    """
+    Selects the faces of a frame that need a new embedding
+    Arguments:
+        boxes: bounding boxes of the detected faces
+        client_id: stream the frame belongs to, None embeds every face
+    Returns:
+        indices: np.ndarray of box indices
+    """
+    if client_id is None:
+        return np.arange(0 if boxes is None else len(boxes))
+    return get_face_tracker(client_id).assign(boxes)
+
+def start_roster(roster_id, person_ids) -> int:
+    """
+    Restricts the matches of an attendance session to the enrolled students
+    Arguments:
+        roster_id: teacher id of the session
+        person_ids: emails of the students enrolled in the subject
+    Returns:
+        registered: number of enrolled students with a registered face
+    """
+    if not roster_search:
+        return 0
+    roster = get_faiss().restrict(person_ids)
+    session_rosters[roster_id] = roster
+    return roster.registered
+
+def end_roster(roster_id):
+    session_rosters.pop(roster_id, None)
+
+def identify_faces(embeddings, roster_id=None) -> Tuple[List[str], List[float]]:
+    """
+    Searches the FAISS index for all embeddings in one call
+    Arguments:
+        embeddings: np.ndarray (N, 512)
+        roster_id: teacher id of the attendance session, searches its roster instead of the whole gallery
+    Returns:
+        person_ids: list of emails, "" when no face in the index is close enough
+        distances: list of distances, None when no face in the index is close enough
+    """
+    if embeddings is None or len(embeddings) == 0:
+        return [], []
+    gallery = session_rosters.get(roster_id) or get_faiss()
+    if enrollment_templates == "all":
+        from modules.faiss_utils import vote
+        labels, distances, accepted = vote(*gallery.search(embeddings, template_votes, 0.8))
     else:
+        labels, distances, accepted = gallery.search(embeddings, 1, 0.8)
+    person_ids = gallery.ids_for(np.where(accepted[:, 0], labels[:, 0], -1))
+    distances = [float(distance) if ok else None for distance, ok in zip(distances[:, 0], accepted[:, 0])]
+    return person_ids, distances
+
+
+def identify_tracked_faces(embeddings, client_id=None, roster_id=None) -> List[str]:
+    """
+    Identifies the embedded faces and fills in the rest from the stream's face tracks
+    Arguments:
+        embeddings: np.ndarray (N, 512), one row per index returned by faces_to_embed(boxes, client_id)
+        client_id: stream the frame belongs to, None when every face was embedded
+        roster_id: teacher id of the attendance session
+    Returns:
+        person_ids: list with the email of every box of the frame, "" for unknown faces
+    """
+    person_ids, distances = identify_faces(embeddings, roster_id)
+    if client_id is None:
+        return person_ids
+    tracker = get_face_tracker(client_id)
+    tracker.update_identities(embeddings, person_ids, distances)
+    return [track.person_id for track in tracker.current]
+
+
+def mark_attendance_for_faces(img, boxes, person_ids, firebase_db:FirebaseDatabase, teacher_id:str)->Tuple[bytes, dict]:
+    """
+    Marks the attendance for faces that were already identified
+    Arguments:
+        img: np.ndarray
+        boxes: bounding boxes of the detected faces
+        person_ids: list with the email of every box, "" for unknown faces
+        firebase_db: FirebaseDB
+        teacher_id: str
+    Returns:
+        processed_frame_data: bytes
+        attendance_status: dict
+    """
+    attendance_status = {}
+    for box, person_email in zip(boxes if boxes is not None else [], person_ids):
+        response = check_in_local_cache(person_email) if person_email else None
+
+        # Mark Attendance
+        if not response and person_email:
+            response = firebase_db.mark_attendance_by_email(student_email=person_email, teacher_id=teacher_id)
+        if response and response['status'] == True:
+            # Green box
+            img = get_face_recognizer().draw_bounding_boxes(img, [box],(0, 255, 0), 4)
+            attendance_status[response['name']] = response['message']
+            update_local_cache(person_email, response['name'])
+        else:
+            # Red box
+            img = get_face_recognizer().draw_bounding_boxes(img, [box],(0, 0, 255), 4)
+    if not attendance_status:
         attendance_status = {"Person": "Unknown"}
     
     # Convert the processed image to bytes
-    processed_frame_data = face_recognizer.convert_rgb_to_binary(img)
+    processed_frame_data = get_face_recognizer().convert_rgb_to_binary(img)
 
     return processed_frame_data, attendance_status
 
@@ -101,8 +343,8 @@ def update_local_cache(person_email: str, student_name: str) -> None:
     local_cache[person_email] = student_name
     print(f"Added to local cache name: {student_name}")
 
-    # Maintain only the last 10 unique entries
-    if len(local_cache) > 10:
+    # Maintain only the last local_cache_size unique entries
+    if len(local_cache) > local_cache_size:
         local_cache.popitem(last=False)  # Remove the oldest entry
 
 def clear_cache():
@@ -116,14 +358,76 @@ def clear_cache():
     global local_cache
     local_cache.clear()
 
-def register_face(user_id, image: Image,):
+def register_face(user_id, image: np.ndarray,):
+    return register_faces(user_id, [image])
+
+def register_faces(user_id, images) -> int:
+    """
+    Registers a user from a set of captures in one gallery change, replacing any earlier registration
+    Arguments:
+        user_id: email of the user
+        images: list of np.ndarray
+    Returns:
+        templates: number of images a face was found in, None when there was none
+    """
     print("registering face now")
-    boxes, embeddings = face_recognizer.get_face_location_and_embeddings(image)
-    # Get largest face location and embedding
-    largest_box, largest_embedding = face_recognizer.get_largest_face_location_and_embedding(boxes, embeddings)
-    if largest_embedding is None:
-        print("largest_embedding is None")
+    embeddings, found = get_face_recognizer().get_largest_face_embeddings(images)
+    if not found:
+        print("No face found in the captures")
+        return None
+    return store_templates(user_id, embeddings)
+
+def store_templates(user_id, embeddings) -> int:
+    """ Replaces the gallery entry of a user with the templates of their capture embeddings, returns how many there were """
+    from modules.faiss_utils import aggregate_templates
+    # The change is journaled and checkpointed in the background
+    get_faiss().replace(user_id, aggregate_templates(embeddings, enrollment_templates))
+    return len(embeddings)
+
+def capture_registration_step(user_id, subject, step: int, image) -> int:
+    """
+    Embeds one capture step of a registration and keeps the embedding in memory until the registration is finished,
+    every capture is read and embedded exactly once
+    Arguments:
+        user_id: email of the user
+        subject: subject the registration is for
+        step: number of the capture step, step 0 starts the registration over
+        image: np.ndarray (H, W, 3) RGB
+    Returns:
+        captured: number of steps of the registration with a face, None when this capture has no face
+    """
+    embeddings, found = get_face_recognizer().get_largest_face_embeddings([image])
+    if not found:
+        print("No face found in the capture")
         return None
-    # Save the updated index and IDs
-    faiss.update_index([largest_embedding], [user_id])
-    return True
\ No newline at end of file
+    with registrations_lock:
+        if step == 0:
+            pending_registrations.pop((user_id, subject), None)
+        steps = pending_registrations.setdefault((user_id, subject), {})
+        steps[step] = embeddings[0]
+        return len(steps)
+
+def finish_registration(user_id, subject) -> int:
+    """
+    Registers the captured steps of a registration in one gallery change, replacing any earlier registration
+    Arguments:
+        user_id: email of the user
+        subject: subject the registration is for
+    Returns:
+        templates: number of captures registered, None when no registration is in progress
+    """
+    with registrations_lock:
+        steps = pending_registrations.pop((user_id, subject), None)
+    if not steps:
+        return None
+    return store_templates(user_id, np.stack([steps[step] for step in sorted(steps)]))
+
+def remove_face(user_id) -> bool:
+    """
+    Removes the registered face vectors of a user from the FAISS index
+    Arguments:
+        user_id: email of the user
+    Returns:
+        removed: False when the user had no registered face
+    """
+    return get_faiss().remove(user_id)
\ No newline at end of file
@@ -3,17 +3,42 @@ from flask_cors import CORS
 from flask_session import Session
 from flask_socketio import SocketIO
 from modules.firebase_utils import FirebaseDatabase
-from modules.utils import process_image_and_mark_attendance, face_recognizer, register_face, clear_cache
+from modules.utils import (process_image_and_mark_attendance, mark_attendance_for_faces, identify_tracked_faces,
+                           faces_to_embed, previous_faces, get_face_recognizer, get_faiss, warm_up,
+                           remove_face, clear_cache, remove_face_tracker, start_roster, end_roster, get_tracking_stats,
+                           get_motion_gate_stats, capture_registration_step, finish_registration,
+                           registration_steps)
+from modules.inference_scheduler import InferenceScheduler
+from modules.inference_workers import InferenceWorkerPool
 from modules.camera_selection import video_path
 from pyngrok import ngrok
 from threading import Lock
+import hmac
+import json
 import os
 import logging
 import time
-import cv2
+import urllib.request
 
 FILE_STORAGE_DIR = 'documents'
 
+# API_ONLY=1 serves only the REST routes, torch, cv2, the models and the FAISS gallery are never loaded. The face
+# recognition server stays the only process writing the gallery, face removals are sent to it at FACE_SERVER_URL
+api_only = os.getenv("API_ONLY", "0") == "1"
+face_server_url = os.getenv("FACE_SERVER_URL", "").rstrip("/")
+# Set on both servers, without it the face recognition server only takes gallery changes from its own host
+internal_api_token = os.getenv("INTERNAL_API_TOKEN", "")
+
+# INFERENCE_WORKERS > 0 moves recognition into a pool of worker processes. They are forked first, before Firebase,
+# the gallery and the threads below exist, and load the models and a read-only gallery themselves
+inference_workers = int(os.getenv("INFERENCE_WORKERS", 0))
+inference_pool = None
+if not api_only and inference_workers > 0:
+    inference_pool = InferenceWorkerPool(
+        inference_workers,
+        threads_per_worker=int(os.getenv("INFERENCE_WORKER_THREADS", max(1, (os.cpu_count() or 1) // inference_workers))),
+    ).start()
+
 class Config:
     SECRET_KEY = 'supersecretkey'
     SESSION_COOKIE_SECURE = True
@@ -34,7 +59,12 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 3600
 Session(app)  # Initialize session management
 
 # Initialize Firebase Database
-firebase_db = FirebaseDatabase()
+firebase_db = FirebaseDatabase(
+    cache_ttl=float(os.getenv("FIREBASE_CACHE_TTL", 300)),
+    cache_size=int(os.getenv("FIREBASE_CACHE_SIZE", 5000)),
+    flush_records=int(os.getenv("ATTENDANCE_FLUSH_RECORDS", 50)),
+    flush_ms=float(os.getenv("ATTENDANCE_FLUSH_MS", 500)),
+)
 
 connected_clients = set()
 
@@ -52,6 +82,60 @@ def reset_frame_count():
 import threading
 threading.Thread(target=reset_frame_count, daemon=True).start()
 
+# Frames from all clients are batched through one scheduler unless INFERENCE_SCHEDULER=0
+use_inference_scheduler = os.getenv("INFERENCE_SCHEDULER", "1") != "0"
+inference_scheduler = None
+
+if not api_only:
+    if inference_pool is None:
+        # Load the models before serving instead of on the first frame
+        warm_up()
+    else:
+        # The workers hold the models, this process writes the gallery and only decodes and draws frames. FaceNet is
+        # loaded here on the first registration.
+        get_faiss()
+    inference_scheduler = InferenceScheduler(
+        get_face_recognizer(),
+        lambda client_id, img, boxes, embeddings, teacher_id: mark_attendance_for_faces(
+            img, boxes, identify_tracked_faces(embeddings, client_id, teacher_id), firebase_db, teacher_id),
+        select_faces=faces_to_embed,
+        reuse_faces=previous_faces,
+        max_batch_size=int(os.getenv("INFERENCE_MAX_BATCH_SIZE", 8)),
+        max_wait_ms=float(os.getenv("INFERENCE_MAX_WAIT_MS", 20)),
+    )
+    if inference_pool is None and use_inference_scheduler:
+        inference_scheduler.start()
+
+def reload_worker_galleries():
+    """ Makes the inference workers pick up a registration or removal """
+    if inference_pool:
+        if get_faiss().mmap:
+            # Workers map the checkpoint files, write one first so they do not have to copy the gallery to replay
+            get_faiss().checkpoint()
+        inference_pool.reload_index()
+
+def face_recognition_disabled():
+    return jsonify({"error": "Face recognition is disabled in API-only mode"}), 503
+
+def remove_face_on_face_server(student_email) -> bool:
+    """
+    Asks the face recognition server to remove the face vectors of a student
+    Arguments:
+        student_email: email of the student
+    Returns:
+        removed: False when the student had no registered face
+    """
+    if not face_server_url:
+        raise RuntimeError("FACE_SERVER_URL is not set")
+    forwarded = urllib.request.Request(
+        f"{face_server_url}/internal/faces/remove",
+        data=json.dumps({"email": student_email}).encode("utf-8"),
+        headers={"Content-Type": "application/json", "X-Internal-Token": internal_api_token},
+        method="POST",
+    )
+    with urllib.request.urlopen(forwarded, timeout=10) as response:
+        return json.load(response)["removed"]
+
 # @app.before_request
 # def log_session_data():
 #     print("Session data before request:", session)
@@ -205,6 +289,16 @@ def remove_student():
             return jsonify({"error": "Student email is required"}), 400
 
         firebase_db.remove_student(student_email)
+        # Drop the student's face vectors too, the gallery is only ever changed by the face recognition server
+        if api_only:
+            try:
+                remove_face_on_face_server(student_email)
+            except Exception as e:
+                print(f"Error removing the face of {student_email} on the face recognition server: {e}")
+                return jsonify({"error": f"Student '{student_email}' was removed, but their face could not be "
+                                         "removed from the face recognition server"}), 502
+        elif remove_face(student_email):
+            reload_worker_galleries()
         return jsonify({"message": f"Student with email '{student_email}' has been removed successfully."}), 200
 
     except ValueError as e:
@@ -213,6 +307,22 @@ def remove_student():
         print(f"Error removing student: {e}")
         return jsonify({"error": "Failed to remove student from the database"}), 500
 
+@app.route('/internal/faces/remove', methods=['POST'])
+def remove_face_internal():
+    """ Face removals forwarded by API-only servers """
+    if api_only:
+        return face_recognition_disabled()
+    if internal_api_token:
+        allowed = hmac.compare_digest(request.headers.get('X-Internal-Token', ''), internal_api_token)
+    else:
+        allowed = request.remote_addr in ('127.0.0.1', '::1')
+    if not allowed:
+        return jsonify({"error": "Forbidden"}), 403
+    removed = remove_face(request.json['email'])
+    if removed:
+        reload_worker_galleries()
+    return jsonify({"removed": removed}), 200
+
 # 4. Enroll Student in Subject
 @app.route('/enroll', methods=['POST'])
 def enroll_student():
@@ -223,6 +333,9 @@ def enroll_student():
         return jsonify({"error": "No subjects provided"}), 400
 
     try:
+        # A registration ended before its last capture step is registered from the steps it has
+        if not api_only and finish_registration(student_email, subject_name):
+            reload_worker_galleries()
         firebase_db.enroll_student_in_subject(student_email=student_email, subject_name=data['subject'])
         return jsonify({"message": f"Subjects added to {student_email} successfully."}), 200
     except Exception as e:
@@ -236,14 +349,22 @@ def start_attendance():
     email = session['email']
     attendance_session_id = firebase_db.start_attendance_session(subject_id=data['subjectId'], teacher_id=teacher_id, email=email)
     session['AttendanceSessionId'] = attendance_session_id
+    if not api_only:
+        # Only the students enrolled in the subject can be marked, match the session's faces against them alone
+        roster = firebase_db.get_session_roster(teacher_id).emails()
+        registered = start_roster(teacher_id, roster)
+        if inference_pool:
+            inference_pool.set_roster(teacher_id, roster)
+        print(f"Roster for {data['subjectId']}: {len(roster)} students, {registered} with a registered face")
     return jsonify({"message": "Attendance session started"}), 201
 
 # 6. Mark Attendance
 @app.route('/attendance/mark', methods=['POST'])
 def mark_attendance():
     data = request.json
-    firebase_db.mark_attendance(session_id=data['sessionId'], student_id=data['studentId'])
-    return jsonify({"message": "Attendance marked"}), 201
+    if firebase_db.mark_attendance(session_id=data['sessionId'], student_id=data['studentId']):
+        return jsonify({"message": "Attendance marked"}), 201
+    return jsonify({"message": "Attendance already marked or session not active"}), 200
 
 def save_image_locally(image, filename):
     try:
@@ -262,6 +383,10 @@ def capture_face_image():
     app.logger.debug(f"Request form: {request.form}")
     if 'email' not in session:
         return jsonify({"error": "User not logged in"}), 401
+    if api_only:
+        return face_recognition_disabled()
+    import cv2
+    import numpy as np
     try:
         if 'image' not in request.files:
             return jsonify({"error": "No image file provided"}), 400
@@ -271,20 +396,24 @@ def capture_face_image():
         # Construct a unique filename based on user_id, subject, and step
         email = session['email']
         filename = f"{email}_{subject}_step{step}.jpg"
-        image_path = save_image_locally(image.read(), filename)
-        # Save the image to the database
-        if image_path.split("_")[-1] == "step0.jpg":
-            # Read image from path in bgr
+        image_bytes = image.read()
+        image_path = save_image_locally(image_bytes, filename)
+        # Every capture step is embedded once and kept until the last step registers them all together
+        if step.isdigit():
+            # Decode the uploaded bytes instead of reading the saved file back
             try:
                 print("Processing image...")
-                image = cv2.imread(image_path)
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                print("registering face now")
-                if register_face(session['email'],image) is None:
+                image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+                captured = capture_registration_step(email, subject, int(step), cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+                if captured is None:
                     return jsonify({"error": "Could Not register Face"}), 400
+                if int(step) >= registration_steps - 1:
+                    templates = finish_registration(email, subject)
+                    reload_worker_galleries()
+                    print(f"Image captured successfully, registered from {templates} captures")
                 else:
-                    print("Image captured successfully")
-                    return jsonify({"message": "Image captured successfully", "path": image_path}), 201
+                    print(f"Image captured successfully, {captured} captures of the registration so far")
+                return jsonify({"message": "Image captured successfully", "path": image_path}), 201
             except Exception as e:
                 print(f"Error processing image: {e}")   
                 return jsonify({"error": "Error processing image: " + str(e)}), 400
@@ -303,6 +432,9 @@ def end_attendance():
     firebase_db.end_attendance_session(session_id=session_id)
     session.pop('AttendanceSessionId',None)
     clear_cache()
+    end_roster(session['user_id'])
+    if inference_pool:
+        inference_pool.end_roster(session['user_id'])
     return jsonify({"message": "Attendance session ended"}), 200
 
 @app.route('/attendance/student', methods=['GET'])
@@ -322,6 +454,20 @@ def get_attendance_summary():
         print(f"Error fetching attendance data: {e}")
         return jsonify({"error": str(e)}), 500
     
+@app.route('/inference/stats', methods=['GET'])
+def get_inference_stats():
+    if api_only:
+        return face_recognition_disabled()
+    return jsonify({
+        **(inference_pool.stats() if inference_pool else inference_scheduler.stats()),
+        "tracking": get_tracking_stats(),
+        "motion_gate": get_motion_gate_stats(),
+    }), 200
+
+@app.route('/database/stats', methods=['GET'])
+def get_database_stats():
+    return jsonify({"cache": firebase_db.cache_stats(), "attendance_writes": firebase_db.attendance_writes.stats()}), 200
+
 @app.route('/logout', methods=['POST'])
 def logout():
     session.clear()  # Clear all session data
@@ -344,22 +490,63 @@ def handle_stream_disconnect():
     print(f'Client disconnected from /stream with SID: {request.sid}')  # Log the client SID on disconnec
 
 
-@socketio.on('binary_frame')
-def handle_frame(data):
+def emit_processed_frame(sid, result):
     global frame_count
-    # print("Frame received from frontend")
-    img = face_recognizer.convert_binary_to_rgb(data)
+    processed_frame_data, attendance_status = result
+
+    # Send the processed frame and embeddings back to the client that sent it
+    socketio.emit('processed_frame', {'frame': processed_frame_data, 'attendance_status': attendance_status}, to=sid)
 
-    # Process the frame
-    processed_frame_data, attendance_status = process_image_and_mark_attendance(img, firebase_db, session)
-    
-    # Send the processed frame and embeddings to the client
-    socketio.emit('processed_frame', {'frame': processed_frame_data, 'attendance_status': attendance_status})
-    
     # Increment the frame count
     with lock:
         frame_count += 1
 
+def emit_frame_error(sid, message):
+    # Only the client that sent the frame hears about it, the other frames of its batch are processed as usual
+    socketio.emit('frame_error', {'error': message}, to=sid)
+
+@socketio.on('binary_frame')
+def handle_frame(data):
+    # print("Frame received from frontend")
+    if api_only:
+        return
+    if inference_pool:
+        teacher_id = session.get('user_id')
+        try:
+            img = get_face_recognizer().decode_frame(data)
+        except Exception as e:
+            print(f"Error decoding frame for client {request.sid}: {e}")
+            emit_frame_error(request.sid, str(e))
+            return
+        inference_pool.submit(
+            request.sid,
+            img,
+            lambda sid, img, boxes, person_ids: emit_processed_frame(
+                sid, mark_attendance_for_faces(img, boxes, person_ids, firebase_db, teacher_id)),
+            roster_id=teacher_id,
+        )
+        return
+    if use_inference_scheduler:
+        inference_scheduler.submit(request.sid, data, session.get('user_id'), emit_processed_frame, emit_frame_error)
+        return
+
+    try:
+        img = get_face_recognizer().decode_frame(data)
+    except Exception as e:
+        print(f"Error decoding frame for client {request.sid}: {e}")
+        emit_frame_error(request.sid, str(e))
+        return
+
+    # Process the frame
+    emit_processed_frame(request.sid, process_image_and_mark_attendance(img, firebase_db, session, request.sid))
+
+@socketio.on('disconnect')
+def handle_frame_client_disconnect():
+    # Drop the face tracks of the stream that went away
+    remove_face_tracker(request.sid)
+    if inference_pool:
+        inference_pool.drop_client(request.sid)
+
 # @socketio.on('ip_cam_frame')
 # def handle_opencv_frame():
 #     global frame_count